@@ -158,6 +158,8 @@ def start():
             st.markdown(f'**Cumulative: ${state.cumulative_cost:.2f}**')
             st.markdown(f'Data query: ${state.estimated_cost_data:.2f}')
             st.markdown(f'Doc query: ${state.estimated_cost_doc:.2f}')
+            if state.history_tokens_doc:
+                st.caption(f'Doc query history: {state.history_tokens_doc} prompt tokens')
             st.markdown(f'Graph query: ${state.estimated_cost_graph:.2f}')
 
         st.markdown('#### Global Settings')
@@ -165,6 +167,8 @@ def start():
             reset_app_state()
             app_llm_data_query.get_llm_data_query_response.clear()
             app_llm_docs_query.get_llm_doc_query_response.clear()
+            app_llm_docs_query.answer_cache().clear()
+            app_llm_docs_query.streamed_answers().clear()
             app_llm_knowlege_graph_gen.get_llm_graph_data_response.clear()
             st.experimental_rerun()
         st.button('Clear OpenAI API key', on_click=_clear_openai_api_key_cb, type='primary', help='Clear OpenAI API key (optional)')
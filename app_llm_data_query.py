@@ -1,73 +1,79 @@
 import os
+import copy
 import sqlite3
 import pandas as pd
-# from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 from langchain.callbacks import get_openai_callback
 from langchain.llms import OpenAI
 from langchain.utilities.sql_database import SQLDatabase
 from langchain_experimental.sql import SQLDatabaseChain
+import openai
 import retry
 import logging
 
 logging.basicConfig(level=logging.ERROR)
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import (add_script_run_ctx, get_script_run_ctx)
 
 from globals import (
-    DB_FILE, OPENAI_MODELS_COMPLETIONS, 
+    DB_FILE, DATA_DB_READERS, DATA_DB_MAX_TABLES, DATA_PREVIEW_ROWS, SQL_TIME_BUDGET, SQL_PAGE_ROWS,
+    OPENAI_MODELS_COMPLETIONS, 
     DEFAULT_MODEL_CONFIG, LANG_MODEL_PRICING
 )
 from app_state import (state, init_app_state, _set_state_cb)
 init_app_state() # ensure all state variables are initialized
 
+from data_ingest import (
+    upload_fingerprint, ingest_csv, ingest_excel, preview
+)
+from data_excel import workbook_sheets
+from data_db import (SQLitePool, dataset_table)
+from data_index_advisor import (IndexAdvisor, sql_from_steps)
+from data_plan_cache import (SQLPlanCache, schema_fingerprint)
+from data_sql_exec import (run_cancellable, fetch_page, count_rows, interrupted)
+from data_profile import (load_profile, table_info)
+from data_schema_link import SchemaLinker
+from docs_embeddings import get_embed_model
+from common import AppError
+
 # DATA -------------------------------------------------------------------------
 
-@st.cache_data(persist='disk')
-def csv_to_df(excel_file):
-    df = pd.read_csv(excel_file)
-    return df
-
-@st.cache_data(persist='disk')
-def excel_to_df(excel_file):
-    # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_excel.html
-    # New in Pandas version 1.3.0.
-    #   The engine xlrd now only supports old-style .xls files. When engine=None, the following logic will be used to determine the engine:
-    #   If path_or_buffer is an OpenDocument format (.odf, .ods, .odt), then odf will be used.
-    #   Otherwise if path_or_buffer is an xls format, xlrd will be used.
-    #   Otherwise if path_or_buffer is in xlsb format, pyxlsb will be used.
-    #   Otherwise openpyxl will be used.
-    #
-    # import openpyxl
-    # df = pd.read_excel(excel_file, engine=openpyxl)
-    #
-    # Therefore... do not need to provide "engine" when using a "path_or_buffer"
-    df = pd.read_excel(excel_file, engine='openpyxl')
-    return df
-
-def prepare_data(df):
-    df.columns = [x.replace(' ', '_').lower() for x in df.columns]
-    return df
+@st.cache_resource()
+def db_pool():
+    return SQLitePool(DB_FILE)
+
+@st.cache_resource()
+def index_advisor():
+    return IndexAdvisor(db_pool())
+
+@st.cache_resource()
+def plan_cache():
+    return SQLPlanCache()
 
 @st.cache_resource()
-def db_connection():
-    return sqlite3.connect(DB_FILE , check_same_thread=False)
+def schema_linker():
+    return SchemaLinker(get_embed_model())
 
 @st.cache_resource()
+def reader_engine():
+    # one pool of read-only connections for all tables, so sessions don't wait for each other
+    return create_engine(
+        'sqlite://', poolclass=QueuePool, pool_size=DATA_DB_READERS, max_overflow=0,
+        creator=db_pool().connect_reader,
+    )
+
+@st.cache_resource(max_entries=DATA_DB_MAX_TABLES)
 def sql_database(table):
-    # create db engine
-    # eng = create_engine(
-    #     url=f'sqlite:///file:{DB_FILE}&cache=shared',
-    #     poolclass=StaticPool, # single connection for requests
-    #     creator=lambda: db_connection(),
-    # )
-    # db = SQLDatabase(engine=eng)
-
-    db = SQLDatabase.from_uri(
-        database_uri = f'sqlite:///file:{DB_FILE}&cache=shared',
+    with db_pool().reader() as conn:
+        profile = load_profile(conn, table)
+    db = SQLDatabase(
+        reader_engine(),
         include_tables=[table],         # we include only one table to save tokens in the prompt :)
-        sample_rows_in_table_info=2,    # we only need 2 rows to get the table info
-        engine_args={'poolclass': StaticPool, 'creator': lambda: db_connection()},
+        # the table's profile (computed at load) is its schema context, rather than sample rows queried per question
+        sample_rows_in_table_info=0 if profile else 2,
+        custom_table_info={table: table_info(table, profile)} if profile else None,
     )
     return db
 
@@ -94,8 +100,7 @@ def get_llm(
         streaming=streaming,
     )
 
-@retry.retry(tries=2, delay=5, backoff=3, jitter=(1, 5), max_delay=60, logger=logging.getLogger("LLM DATA QUERY (get_llm_data_query_response)"))
-def get_llm_data_query_response(query, table, model_name=DEFAULT_MODEL_CONFIG['completions_model'], intermediate_steps=False, limit=3):
+def data_query_chain(table, model_name, limit, table_info=None):
     model_config = {
         'model_name': model_name,
         'temperature': 0,      # override settings = do not halucinate!
@@ -103,22 +108,31 @@ def get_llm_data_query_response(query, table, model_name=DEFAULT_MODEL_CONFIG['c
         'max_tokens': 2000,    # override settings
     }
     llm = get_llm(**model_config)
+
+    db = sql_database(table)
+    if table_info:
+        # the question's own schema context, on a copy sharing the cached database's engine
+        db = copy.copy(db)
+        db._custom_table_info = {table: table_info}
     
     # create SQLDatabaseChain LLM connection
-    db_chain = SQLDatabaseChain.from_llm(
-        llm=llm, db=sql_database(table), verbose=True,
+    return SQLDatabaseChain.from_llm(
+        llm=llm, db=db, verbose=True,
         # use_query_checker=True,
-        return_intermediate_steps=intermediate_steps,
+        # always returned: the index advisor needs the SQL the chain ran
+        return_intermediate_steps=True,
         top_k=limit
     )
+
+# only API errors are retried: a failed or stopped query would fail (or be stopped) again
+@retry.retry(exceptions=openai.APIError, tries=2, delay=5, backoff=3, jitter=(1, 5), max_delay=60, logger=logging.getLogger("LLM DATA QUERY (get_llm_data_query_response)"))
+def get_llm_data_query_response(query, table, model_name=DEFAULT_MODEL_CONFIG['completions_model'], limit=3, table_info=None):
+    db_chain = data_query_chain(table, model_name, limit, table_info=table_info)
     
     # run query and display result
     with get_openai_callback() as token_counter:
         if query:
-            if state.intermediate_steps: 
-                result = db_chain(query)
-            else:
-                result = db_chain.run(query)
+            result = db_chain(query)
 
     print('---- Data SQL Query ----', '\n',
           'LLM Prompt Tokens:', token_counter.prompt_tokens, '\n',
@@ -133,6 +147,105 @@ def get_llm_data_query_response(query, table, model_name=DEFAULT_MODEL_CONFIG['c
 
     return result
 
+def link_schema(question, table, profile):
+    """(table info, schema linking stats) for the question, or (None, None) to give the chain the whole table"""
+    if profile is None:
+        return None, None
+    try:
+        return schema_linker().link(table, profile, question, state.completions_model)
+    except Exception as ex:
+        if interrupted():
+            raise
+        print('---- Schema Linking ----', '\n', f'Failed, using all columns: {ex}')
+        return None, None
+
+def answer_data_query(question, query, table, schema, profile):
+    # the same question of a table with the same schema runs the SQL generated before,
+    # with no LLM call: its result is the answer, shown by the pager
+    plan_key = (question, state.completions_model, schema, state.limit)
+    cached_sql = plan_cache().lookup(*plan_key, table)
+    if cached_sql:
+        try:
+            # the first page (and the row count) is read now, so a failing plan is found
+            # and the page shows at once
+            read_result_page(table, cached_sql, 0)
+            print('---- Data SQL Query ----', '\n', 'Cached SQL Plan, no LLM call:', cached_sql)
+            return {'result': None, 'intermediate_steps': [{'sql_cmd': cached_sql}], 'schema_link': None, 'cached': True}
+        except sqlite3.Error as ex:
+            if interrupted():
+                raise
+            print('---- Data SQL Query ----', '\n', f'Cached SQL plan failed, discarded: {ex}')
+            plan_cache().discard(*plan_key)
+    # on wide tables, only the columns relevant to the question go into the prompt
+    info, schema_link = link_schema(question, table, profile)
+    result = get_llm_data_query_response(
+        query, table,
+        model_name=state.completions_model,
+        limit=state.limit,
+        table_info=info,
+    )
+    result['schema_link'] = schema_link
+    if sql_from_steps(result['intermediate_steps']):
+        plan_cache().store(*plan_key, table, sql_from_steps(result['intermediate_steps']))
+    return result
+
+# tables are named by their content, so a query's result never changes
+# (both run under the calling thread's query budget, see show_result_pages)
+@st.cache_data(max_entries=100, show_spinner=False)
+def result_page(table, sql, page, page_size=SQL_PAGE_ROWS):
+    """(column names, rows of the 0-based `page`) of the result of `sql` over `table`"""
+    with db_pool().reader() as conn:
+        return fetch_page(conn, sql, page, page_size)
+
+@st.cache_data(max_entries=100, show_spinner=False)
+def result_rows(table, sql):
+    """Rows in the result of `sql` over `table`"""
+    with db_pool().reader() as conn:
+        return count_rows(conn, sql)
+
+def read_result_page(table, sql, page):
+    columns, rows = result_page(table, sql, page)
+    return columns, rows, result_rows(table, sql)
+
+def show_result_pages(table, sql):
+    """The rows of the query result, a page at a time"""
+    # the page is set through session state (reset to 1 for a new result), so the widget has no default value
+    page = st.number_input('Results page', min_value=1, step=1, key='number_input_data_result_page') - 1
+    # read in the background, within the query time budget, so it can be cancelled
+    running = st.empty()
+    with running.container():
+        st.button('Cancel', key='button_cancel_data_result_page')
+        status = st.empty()
+    try:
+        columns, rows, total = run_cancellable(
+            read_result_page, table, sql, page,
+            seconds=SQL_TIME_BUDGET,
+            on_wait=lambda elapsed: status.caption(f'Reading results... {elapsed:.0f}s'),
+            prepare_thread=lambda thread: add_script_run_ctx(thread, get_script_run_ctx()),
+        )
+    except AppError as ex:
+        running.empty()
+        st.warning(ex.error)
+        return
+    except sqlite3.Error as ex:
+        running.empty()
+        st.warning(f'The query result could not be read: {ex}')
+        return
+    running.empty()
+    st.dataframe(pd.DataFrame(rows, columns=columns), hide_index=True)
+    if rows:
+        st.caption(f'Rows {page * SQL_PAGE_ROWS + 1:,}-{page * SQL_PAGE_ROWS + len(rows):,} of {total:,}.')
+    else:
+        st.caption(f'{total:,} rows.')
+
+def index_advice_caption(advice):
+    if advice['index'] is None:
+        return f"Index advisor: {advice['status']}."
+    caption = f"Index advisor: {advice['status']} index on ({', '.join(advice['columns'])})"
+    if advice.get('before_ms') is not None:
+        caption += f", query {advice['before_ms']:.1f}ms before, {advice['after_ms']:.1f}ms after"
+    return caption + '.'
+
 # DATA CHAT PAGE ----------------------------------------------------------------
 
 def main(title):
@@ -160,19 +273,46 @@ def main(title):
     if excel_file is None:
         return
         
+    # commit data to sql (only when the upload changed, not on every rerun)
+    # each dataset has its own table, so sessions don't overwrite each other's data
+    pool = db_pool()
+    fingerprint = upload_fingerprint(excel_file)
     if excel_file.type in ['application/vnd.ms-excel', 'application/octet-stream', 'text/csv']:
-        df = csv_to_df(excel_file)
-        # state.db_table = excel_file.name.replace('.csv', '').replace(' ', '_').lower()
+        state.db_table = dataset_table(fingerprint)
+        # streamed into the table in chunks, never held in memory as a whole
+        progress_bar = st.progress(0.0, text='Loading data...')
+        with pool.writer() as conn:
+            load_stats = ingest_csv(
+                conn, state.db_table, excel_file, fingerprint, size_bytes=excel_file.size,
+                progress=lambda rows, fraction: progress_bar.progress(fraction, text=f'Loading data... {rows:,} rows')
+            )
+        progress_bar.empty()
     else: # 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        df = excel_to_df(excel_file)
-        # state.db_table = excel_file.name.replace('.xlsx', '').replace(' ', '_').lower()
-
-    if st.checkbox('Show Data', value=False):
-        st.dataframe(df)
+        # the workbook is converted once (all sheets, in parallel), then read from the conversion cache
+        with st.spinner('Converting workbook...'):
+            sheets = workbook_sheets(excel_file, fingerprint)
+        sheet_name = sheets[0]['name']
+        if len(sheets) > 1:
+            sheet_name = st.selectbox('Sheet', options=[sheet['name'] for sheet in sheets], key='selectbox_data_sheet')
+        state.db_table = dataset_table(f'{fingerprint}:{sheet_name}')
+        with pool.writer() as conn:
+            load_stats = ingest_excel(
+                conn, state.db_table, excel_file, fingerprint, sheet_name=sheet_name, size_bytes=excel_file.size
+            )
+    pool.touch(state.db_table)
+    if not load_stats['skipped']:
+        pool.gc_tables()
+    st.caption(
+        f"{load_stats['rows']:,} rows ({load_stats['mb']:.1f} MB) "
+        + ('already loaded.' if load_stats['skipped'] else f"loaded in {load_stats['seconds']:.2f}s.")
+    )
 
-    # commit data to sql
-    data = prepare_data(df)
-    data.to_sql(state.db_table, db_connection(), if_exists='replace', index=False)
+    with pool.reader() as conn:
+        if st.checkbox('Show Data', value=False):
+            st.dataframe(preview(conn, state.db_table, DATA_PREVIEW_ROWS))
+            st.caption(f"First {min(DATA_PREVIEW_ROWS, load_stats['rows']):,} of {load_stats['rows']:,} rows.")
+        schema = schema_fingerprint(conn, state.db_table)
+        profile = load_profile(conn, state.db_table)
 
     st.subheader('Query Data')
     with st.form(key='data_chat_form', clear_on_submit=False):
@@ -197,20 +337,56 @@ def main(title):
         )
 
     if apply_query and state.query and state.openai_api_key:
-        query = state.query + f' Strictly use only these data columns "{list(data.columns)}". ' + \
+        # the columns (and their values) are described by the table info in the chain's prompt
+        query = state.query + ' Strictly use only the data columns of the table info. ' + \
             'Do not wrap the SQL statement in quotes. Do not embelish the answer with any additional text.'
-        result = get_llm_data_query_response(
-            query, state.db_table,
-            model_name=state.completions_model,
-            intermediate_steps=state.intermediate_steps, 
-            limit=state.limit
-        )
+        # runs in the background, within the query time budget, so it can be cancelled
+        running = st.empty()
+        with running.container():
+            st.button('Cancel query', key='button_cancel_data_query')
+            status = st.empty()
+        try:
+            result = run_cancellable(
+                answer_data_query, state.query, query, state.db_table, schema, profile,
+                seconds=SQL_TIME_BUDGET,
+                on_wait=lambda elapsed: status.caption(f'Running query... {elapsed:.0f}s'),
+                prepare_thread=lambda thread: add_script_run_ctx(thread, get_script_run_ctx()),
+            )
+        except AppError as ex:
+            result = None
+            st.error(ex.error)
+        running.empty()
+        if result is not None:
+            sql = sql_from_steps(result['intermediate_steps'])
+            # frequently filtered and grouped columns get indexes, built in the background
+            advice = index_advisor().observe(state.db_table, sql)
+            state.data_result = {
+                'table': state.db_table, 'sql': sql, 'answer': result['result'],
+                'intermediate_steps': result['intermediate_steps'], 'advice': advice,
+                'cached': result.get('cached', False), 'schema_link': result.get('schema_link'),
+            }
+            state['number_input_data_result_page'] = 1
+    elif apply_query and not state.query:
+        st.info('Please enter a query above.')
+
+    # the last result stays on the page (e.g. while paging through it)
+    data_result = state.data_result
+    if data_result and data_result['table'] == state.db_table:
+        if data_result['cached']:
+            st.caption('Answered by the SQL generated for this question before (no LLM call).')
+        schema_link = data_result['schema_link']
+        if schema_link and schema_link['tokens_saved']:
+            st.caption(
+                f"Schema linking: {schema_link['columns']} of {schema_link['total_columns']} columns sent, "
+                f"{schema_link['tokens_saved']:,} prompt tokens saved."
+            )
         if state.intermediate_steps:
             with st.expander('Intermediate Steps', expanded=False):
                 st.write(state.completions_model)
-                st.write(result['intermediate_steps'])
-            st.text(result['result'])
-        else:
-            st.text(result)
-    elif apply_query and not state.query:
-        st.info('Please enter a query above.')
\ No newline at end of file
+                st.write(data_result['intermediate_steps'])
+                st.write({'query plan': data_result['advice']['plan']})
+            st.caption(index_advice_caption(data_result['advice']))
+        if data_result['answer'] is not None:
+            st.text(data_result['answer'])
+        if data_result['sql']:
+            show_result_pages(data_result['table'], data_result['sql'])
\ No newline at end of file
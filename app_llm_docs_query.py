@@ -3,14 +3,11 @@ import json
 from langchain.prompts import PromptTemplate
 
 import tiktoken
-from llama_index.callbacks import CallbackManager, TokenCountingHandler
-from llama_index.node_parser import SimpleNodeParser
 from llama_index.vector_stores import WeaviateVectorStore
-from llama_index import (
-    VectorStoreIndex, SimpleDirectoryReader, 
-    StorageContext, ServiceContext, 
-    load_index_from_storage
-)
+from llama_index import VectorStoreIndex
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.query_engine import RetrieverQueryEngine
+from llama_index.llms import OpenAI
 import weaviate
 
 import streamlit as st
@@ -19,10 +16,19 @@ from app_state import (state, init_app_state, _set_state_cb)
 init_app_state() # ensure all state variables are initialized
 
 from globals import (
-    VECTOR_STORE, OPENAI_MODELS_COMPLETIONS, 
+    VECTOR_STORE, DOCS_DIR, WEAVIATE_IMPORT_WORKERS, ANN_NPROBE, ANN_MIN_VECTORS, HYBRID_TOP_K, PAGE_TOP_K, SEMANTIC_CACHE_THRESHOLD, OPENAI_MODELS_COMPLETIONS, 
     DEFAULT_MODEL_CONFIG, LANG_MODEL_PRICING
 )
-from common import scrape_articles
+from scraper_async import scrape_articles_concurrent
+from docs_registry import (IndexRegistry, persist_dir, answers_fingerprint)
+from docs_indexer import (
+    index_documents, index_articles, article_chunk_ids, load_local_index, load_numpy_index, WEAVIATE_CLASS
+)
+from docs_ann import recall_report
+from docs_answer_cache import (SemanticAnswerCache, StreamedAnswers)
+from docs_embeddings import (get_embed_model, CacheAwareTokenCountingHandler)
+from docs_history import budget_history
+from single_flight import SingleFlight
 
 # DOCS CHAT PAGE ----------------------------------------------------------------
 
@@ -35,86 +41,220 @@ if VECTOR_STORE == 'Weaviate':
         auth_client_secret=auth_config,
         additional_headers={
             "X-OpenAI-Api-Key": state.openai_api_key,
-        }
+        },
+        # pooled HTTP connections, shared by the bulk import workers
+        additional_config=weaviate.Config(connection_config=weaviate.ConnectionConfig(
+            session_pool_maxsize=max(20, WEAVIATE_IMPORT_WORKERS * 2)
+        ))
     )
 
-@st.cache_data(ttl=60*60, show_spinner=False)
-def get_llm_doc_query_response(
-    query_prompt, model_name: str = DEFAULT_MODEL_CONFIG['completions_model'], 
-    _service_context=ServiceContext.from_defaults()
-):
-    # load index
+@st.cache_resource(show_spinner=False)
+def index_registry():
+    # shared by all sessions in this process
+    return IndexRegistry(embed_model=get_embed_model())
+
+def _load_index(store_type, service_context):
     # LOCAL STORE
-    if VECTOR_STORE == 'Local':
-        # rebuild storage context
-        storage_context = StorageContext.from_defaults(persist_dir='./storage')
-        index = load_index_from_storage(storage_context)
+    if store_type == 'Local':
+        # rebuild storage context (and apply the delta of articles added since)
+        index = load_local_index(persist_dir(store_type), service_context)
 
     # WEAVIATE CLOUD STORE
-    elif VECTOR_STORE == 'Weaviate':
-        vector_store = WeaviateVectorStore(weaviate_client = wc, index_name="Documents", text_key="content")
+    elif store_type == 'Weaviate':
+        vector_store = WeaviateVectorStore(weaviate_client = wc, index_name=WEAVIATE_CLASS, text_key="content")
         # set up the index
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=_service_context)
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=service_context)
+
+    # NUMPY (MEMORY-MAPPED) LOCAL STORE
+    elif store_type == 'Numpy':
+        index = load_numpy_index(persist_dir(store_type), service_context)
 
     else:
-        raise ValueError(f'Unknown vector store {VECTOR_STORE}')
+        raise ValueError(f'Unknown vector store {store_type}')
+
+    return index
+
+@st.cache_resource(show_spinner=False)
+def summary_llm(model_name):
+    # the conversation history is summarized by the selected model (whose prices the cost is estimated with);
+    # its tokens are counted with the session's, through the registry's callback manager
+    return OpenAI(model=model_name, temperature=0, callback_manager=index_registry().service_context.callback_manager)
+
+@st.cache_resource(show_spinner=False)
+def answer_cache():
+    # on disk, so shared by all workers
+    return SemanticAnswerCache()
+
+@st.cache_resource(show_spinner=False)
+def streamed_answers():
+    # st.cache_data can't cache a token stream, so the full text of streamed answers is kept here
+    return StreamedAnswers()
+
+def _query_engine(nprobe, hybrid=False, streaming=False, node_ids=None):
+    # get (shared) query engine over the index
+    # NOTE: nprobe is the number of IVF lists scanned by the Numpy store's ANN index (0 = exact search)
+    engine_kwargs = {'vector_store_kwargs': {'nprobe': nprobe}} if VECTOR_STORE == 'Numpy' else {}
+    if node_ids:
+        # only these chunks (e.g. of one scraped page) are retrieved; BM25 covers the whole index, so no hybrid
+        index = index_registry().index(VECTOR_STORE, _load_index)
+        retriever = VectorIndexRetriever(index, similarity_top_k=PAGE_TOP_K, node_ids=list(node_ids), **engine_kwargs)
+        return RetrieverQueryEngine.from_args(retriever, service_context=index.service_context, streaming=streaming)
+    if streaming:
+        engine_kwargs['streaming'] = True
+    return index_registry().query_engine(VECTOR_STORE, _load_index, hybrid=hybrid, **engine_kwargs)
+
+def retrieval_settings(nprobe, hybrid):
+    # answers are cached per retrieval settings, as they change the chunks an answer is written from
+    return f"{'hybrid' if hybrid else 'dense'}:nprobe={nprobe}"
+
+def _semantic_lookup(semantic_key, model_name, index_fingerprint, retrieval, semantic_threshold):
+    # a similar enough question (`semantic_key`) has the same answer
+    embedding = index_registry().service_context.embed_model.get_query_embedding(semantic_key)
+    hit = answer_cache().lookup(model_name, index_fingerprint, retrieval, embedding, threshold=semantic_threshold)
+    if hit:
+        response, similarity, cached_question = hit
+        print('---- Document Q&A  ----', '\n', f'Semantic cache hit ({similarity:.3f}): "{cached_question}"')
+        return response, embedding
+    return None, embedding
+
+# concurrent identical questions (from any session in this process) share one LLM call
+doc_query_flight = SingleFlight('Document Q&A')
+
+def answer_key(query_prompt, model_name, index_fingerprint, nprobe, hybrid, node_ids):
+    # the same for streamed and non-streamed calls, so they share answers and flights
+    return (query_prompt, model_name, index_fingerprint, nprobe, hybrid, node_ids)
+
+def _query_answer(query_prompt, model_name, index_fingerprint, nprobe, hybrid, semantic_key, semantic_threshold, node_ids):
+    if semantic_key:
+        response, embedding = _semantic_lookup(
+            semantic_key, model_name, index_fingerprint, retrieval_settings(nprobe, hybrid), semantic_threshold
+        )
+        if response is not None:
+            return response
 
-    # get query engine over the index
-    query_engine = index.as_query_engine()
     # query the index
-    response = query_engine.query(query_prompt)
+    response = _query_engine(nprobe, hybrid=hybrid, node_ids=node_ids).query(query_prompt)
     response = response.response.replace('•', '*')
+
+    if semantic_key:
+        answer_cache().store(
+            model_name, index_fingerprint, retrieval_settings(nprobe, hybrid), semantic_key, embedding, response
+        )
     return response
 
+# NOTE: `index_fingerprint` is only used as a cache key, so cached answers expire when the index changes
+# `node_ids` (a tuple) restricts retrieval to those chunks
+@st.cache_data(ttl=60*60, show_spinner=False)
+def get_llm_doc_query_response(
+    query_prompt, model_name: str = DEFAULT_MODEL_CONFIG['completions_model'], 
+    index_fingerprint: str = None, nprobe: int = 0, hybrid: bool = True,
+    semantic_key: str = None, semantic_threshold: float = SEMANTIC_CACHE_THRESHOLD, node_ids: tuple = None
+):
+    key = answer_key(query_prompt, model_name, index_fingerprint, nprobe, hybrid, node_ids)
+    # an answer that was just streamed
+    response = streamed_answers().get(key)
+    if response is not None:
+        return response
+    # or one being answered, streamed or not
+    return doc_query_flight.do(
+        key, _query_answer,
+        query_prompt, model_name, index_fingerprint, nprobe, hybrid, semantic_key, semantic_threshold, node_ids
+    )
+
+def stream_llm_doc_query_response(
+    query_prompt, model_name: str = DEFAULT_MODEL_CONFIG['completions_model'], 
+    index_fingerprint: str = None, nprobe: int = 0, hybrid: bool = True,
+    semantic_key: str = None, semantic_threshold: float = SEMANTIC_CACHE_THRESHOLD, node_ids: tuple = None
+):
+    """
+    Same as `get_llm_doc_query_response`, but yields the answer as it is generated.
+    The full answer is kept, so a following `get_llm_doc_query_response` call with the
+    same arguments returns (and caches) it without querying again.
+    """
+    key = answer_key(query_prompt, model_name, index_fingerprint, nprobe, hybrid, node_ids)
+    response = streamed_answers().get(key)
+    if response is None and semantic_key:
+        response, embedding = _semantic_lookup(
+            semantic_key, model_name, index_fingerprint, retrieval_settings(nprobe, hybrid), semantic_threshold
+        )
+    if response is not None:
+        streamed_answers().put(key, response)
+        yield response
+        return
+
+    # wait for an identical call in flight (streamed or not), rather than streaming a second answer
+    future, response = doc_query_flight.lead_or_wait(key)
+    if future is None:
+        yield response
+        return
+
+    try:
+        # query the index
+        streaming_response = _query_engine(nprobe, hybrid=hybrid, streaming=True, node_ids=node_ids).query(query_prompt)
+        tokens = []
+        for token in streaming_response.response_gen:
+            tokens.append(token)
+            yield token.replace('•', '*')
+        response = ''.join(tokens).replace('•', '*')
+
+        streamed_answers().put(key, response)
+        if semantic_key:
+            answer_cache().store(
+                model_name, index_fingerprint, retrieval_settings(nprobe, hybrid), semantic_key, embedding, response
+            )
+    except BaseException as ex:
+        doc_query_flight.finish(key, future, error=ex)
+        raise
+    doc_query_flight.finish(key, future, result=response)
+
 def main(title, user_input_confirmed=False):
     # Count token usage for cost estimation
-    token_counter = TokenCountingHandler(
+    token_counter = CacheAwareTokenCountingHandler(
         tokenizer=tiktoken.encoding_for_model(state.completions_model).encode,
         verbose=False  # set to true to see usage printed to the console
     )
-    callback_manager = CallbackManager([token_counter])
-    service_context = ServiceContext.from_defaults(callback_manager=callback_manager)
-    
-    def _index_documents():
-        # load the documents 
-        documents = SimpleDirectoryReader('docs').load_data()
+    registry = index_registry()
+    service_context = registry.service_context
 
+    def _index_documents():
         # LOCAL STORE
         # NOTE: Disallow if cloud deployment (temporary fix for public demo and/or if you 
         # don't have required file permissions or disk space)
-        if not json.loads(st.secrets['IS_CLOUD_DEPLOYMENT']) and VECTOR_STORE == 'Local':
-            # construct an index over these documents... saved in memory
-            index = VectorStoreIndex.from_documents(documents, show_progress=True, service_context=service_context)
-            # save index on disk
-            index.storage_context.persist(persist_dir='./storage')
-
-        # WEAVIATE CLOUD STORE
-        elif VECTOR_STORE == 'Weaviate':
-            wc.schema.delete_class("Documents")
-            class_obj = {
-                "class": "Documents",
-                "vectorizer": "text2vec-openai",
-                "moduleConfig": {
-                    "text2vec-openai": {},
-                    "generative-openai": {}
-                }
-            }
-            wc.schema.create_class(class_obj)
-            # chunk up the documents into nodes 
-            parser = SimpleNodeParser.from_defaults(chunk_size=1024, chunk_overlap=20)
-            nodes = parser.get_nodes_from_documents(documents, show_progress=True)
-            # construct vector store
-            vector_store = WeaviateVectorStore(weaviate_client=wc, index_name="Documents", text_key="content")
-            # setting up the storage for the embeddings
-            storage_context = StorageContext.from_defaults(vector_store = vector_store)
-            # set up the index
-            index = VectorStoreIndex(nodes, storage_context=storage_context, show_progress=True, service_context=service_context)
+        if json.loads(st.secrets['IS_CLOUD_DEPLOYMENT']) and VECTOR_STORE in ['Local', 'Numpy']:
+            raise ValueError(f'Vector store {VECTOR_STORE} is not available in cloud deployments')
 
-        else:
-            raise ValueError(f'Unknown vector store {VECTOR_STORE}')
+        # only new or changed chunks are embedded; the current index keeps serving until committed
+        index, stats = index_documents(VECTOR_STORE, service_context, docs_dir=DOCS_DIR, weaviate_client=wc)
+        if index is not None:
+            # swap the new index in for all sessions
+            registry.publish(VECTOR_STORE, index)
+            # answers over the old index are stale
+            answer_cache().invalidate(keep_fingerprint=answers_fingerprint(VECTOR_STORE))
 
         print('---- Document Q&A  ----', '\n',
+              'Indexing Stats: ', stats, '\n',
+              'Indexing Embedding Tokens: ', token_counter.total_embedding_token_count, '\n',
+              'Embedding Cache Hit Rate: ', f'{token_counter.embedding_cache_hit_rate:.1%}', '\n',
+              'Embedding Tokens Saved: ', token_counter.embedding_tokens_saved, '\n')
+        return stats
+
+    def _index_articles(articles):
+        if json.loads(st.secrets['IS_CLOUD_DEPLOYMENT']) and VECTOR_STORE in ['Local', 'Numpy']:
+            raise ValueError(f'Vector store {VECTOR_STORE} is not available in cloud deployments')
+
+        # a page scraped before is only embedded again if its text changed
+        answers_before = answers_fingerprint(VECTOR_STORE)
+        index, stats = index_articles(VECTOR_STORE, service_context, articles, weaviate_client=wc)
+        if index is not None:
+            registry.publish(VECTOR_STORE, index)
+            # a new page leaves other answers valid; answers may have used the old text of a changed page
+            if answers_fingerprint(VECTOR_STORE) != answers_before:
+                answer_cache().invalidate(keep_fingerprint=answers_fingerprint(VECTOR_STORE))
+
+        print('---- Document Q&A  ----', '\n',
+              'Article Indexing Stats: ', stats, '\n',
               'Indexing Embedding Tokens: ', token_counter.total_embedding_token_count, '\n')
+        return stats
 
     with st.sidebar:
         st.markdown(f'#### {title} Settings')
@@ -125,24 +265,96 @@ def main(title, user_input_confirmed=False):
             help='Allowed models. Accuracy, speed, token consumption and costs will vary.',
             key='selectbox_docs_completions_model_name'
         )
+        nprobe = 0
+        if VECTOR_STORE == 'Numpy':
+            nprobe = st.number_input(
+                'ANN lists to probe', value=ANN_NPROBE, min_value=0, max_value=256, step=1,
+                help='Approximate search over large indexes: more lists is slower but has better recall. 0 = exact search.',
+                key='number_input_ann_nprobe'
+            )
+            if st.button('ANN recall report'):
+                vector_store = registry.index(VECTOR_STORE, _load_index).vector_store
+                if vector_store.ann_index is None:
+                    st.info(f'No ANN index yet: one is built when there are {ANN_MIN_VECTORS} or more chunks.')
+                else:
+                    with st.spinner('Measuring recall...'):
+                        st.dataframe(recall_report(vector_store.vectors, vector_store.ann_index), hide_index=True)
+        hybrid = st.checkbox(
+            'Hybrid search (BM25 + vectors)', value=True,
+            help=f'Fuse keyword (BM25) and vector search results, so exact terms match. {HYBRID_TOP_K} chunks are sent to the LLM.'
+        )
+        index_pages = st.checkbox(
+            'Index scraped pages', value=True,
+            help='Add web pages you ask about to the document index, and answer from their most relevant chunks.'
+        )
         include_history = st.checkbox('Include history in prompts', value=False)
+        stream_answers = st.checkbox(
+            'Stream answers', value=True,
+            help='Show the answer as it is generated, rather than when it is complete.'
+        )
+        use_semantic_cache = st.checkbox(
+            'Reuse answers to similar questions', value=True,
+            help='Answer from the semantic cache when a previous question was similar enough (not used with history).'
+        )
+        semantic_threshold = st.slider(
+            'Question similarity threshold', min_value=0.80, max_value=1.0, value=SEMANTIC_CACHE_THRESHOLD, step=0.01,
+            disabled=not use_semantic_cache
+        )
+        if doc_query_flight.suppressed:
+            st.caption(f'{doc_query_flight.suppressed} duplicate LLM calls suppressed (shared with concurrent sessions).')
         if st.button('Clear history'):
             state.questions = []
             state.past = []
+            state.history_summary = ''
+            state.history_summarized = 0
         # NOTE: Hide indexing button if cloud deployment (temporary fix for public demo)
         if not json.loads(st.secrets['IS_CLOUD_DEPLOYMENT']) and st.button('Index documents'):
-            with st.spinner("Indexing..."):
-                _index_documents()
+            with st.spinner("Indexing..."), registry.track_tokens(token_counter):
+                stats = _index_documents()
+            st.caption(
+                f"Indexed {stats['files_changed']} changed and {stats['files_removed']} removed files "
+                f"({stats['chunks_added']} chunks added, {stats['chunks_deleted']} deleted) in {stats['seconds']:.1f}s. "
+                f"Embedding cache hit rate {token_counter.embedding_cache_hit_rate:.0%}, "
+                f"{token_counter.embedding_tokens_saved} tokens saved."
+            )
+            if 'objects_per_second' in stats:
+                st.caption(
+                    f"Weaviate import: {stats['objects_per_second']:.1f} objects/s"
+                    + (f", {stats['objects_failed']} objects failed." if stats['objects_failed'] else '.')
+                )
 
     # GPT completion models can not handle web sites, so we scrape the URL in the user input
     user_input = state.user_input
+    page_node_ids = None
     if user_input.strip().startswith('http'):
-        scraped_texts = scrape_articles([user_input])['text']
-        user_input = scraped_texts[0] if scraped_texts else user_input
-        user_input = user_input.replace('\n', ' ').replace('\r', '') if user_input else user_input
+        articles = scrape_articles_concurrent([user_input])
+        if index_pages and articles['text']:
+            # index the page's chunks (with its URL, date and author), and answer from them only
+            try:
+                with registry.track_tokens(token_counter):
+                    _index_articles(articles)
+                page_node_ids = tuple(article_chunk_ids(VECTOR_STORE, articles['url'][0])) or None
+            except ValueError as ex:
+                print('---- Document Q&A  ----', '\n', 'Scraped page not indexed: ', ex)
+        if page_node_ids:
+            title = articles['title'][0] or articles['url'][0]
+            user_input = f'The web page "{title}" ({articles["url"][0]})'
+        else:
+            # the page text goes into the prompt as it is
+            scraped_texts = articles['text']
+            user_input = scraped_texts[0] if scraped_texts else user_input
+            user_input = user_input.replace('\n', ' ').replace('\r', '') if user_input else user_input
 
+    state.history_tokens_doc = 0
     if include_history:
-        context = '\n\n'.join([f'| Question: "{q}" | Answer: "{a}" |' for q, a in zip(state.questions, state.past)])
+        # recent turns verbatim, older ones summarized, within the history token budget
+        # NOTE: the current question's own turn is left out, so the prompt (and cached answer) stays the same on reruns
+        with registry.track_tokens(token_counter):
+            context, state.history_tokens_doc, state.history_summary, state.history_summarized = budget_history(
+                list(zip(state.questions, state.past)), state.history_summary, state.history_summarized,
+                summarize=lambda prompt: summary_llm(state.completions_model).complete(prompt).text,
+                model_name=state.completions_model, exclude_question=state.user_input
+            )
         refinement = \
             'Finally, return results in markdown text, include bullet point format where appropriate. ' + \
             'Add additional web links at the end of the response if this is useful.'
@@ -157,26 +369,52 @@ def main(title, user_input_confirmed=False):
         prompt = PromptTemplate(input_variables=['doc_query', 'refinement'], template=prompt_template)
         query_prompt = prompt.format(doc_query=user_input, refinement=refinement)
 
+    query_kwargs = {
+        'model_name': state.completions_model,
+        'index_fingerprint': answers_fingerprint(VECTOR_STORE),
+        'nprobe': nprobe,
+        'hybrid': hybrid,
+        # answers that depend on the conversation history can't be reused for other sessions,
+        # and a page's answer is not another (similar looking) URL's
+        'semantic_key': state.user_input if use_semantic_cache and not include_history and not page_node_ids else None,
+        'semantic_threshold': semantic_threshold,
+        'node_ids': page_node_ids,
+    }
+
+    answer_area = None
     if user_input_confirmed and state.user_input:
         with st.spinner("Generating query answer..."):
             try:
-                response = get_llm_doc_query_response(query_prompt, model_name=state.completions_model, _service_context=service_context)
+                with registry.track_tokens(token_counter):
+                    if stream_answers:
+                        st.subheader('🙋🏽 Answer')
+                        answer_area = st.empty()
+                        response = ''
+                        for token in stream_llm_doc_query_response(query_prompt, **query_kwargs):
+                            response += token
+                            answer_area.markdown(response + '▌')
+                    else:
+                        response = get_llm_doc_query_response(query_prompt, **query_kwargs)
                 print('---- Document Q&A  ----', '\n',
                       'Embedding Tokens: ', token_counter.total_embedding_token_count, '\n',
+                      'Embedding Tokens Saved (cache): ', token_counter.embedding_tokens_saved, '\n',
                       'LLM Prompt Tokens: ', token_counter.prompt_llm_token_count, '\n',
                       'LLM Completion Tokens: ', token_counter.completion_llm_token_count, '\n',
-                      'Total LLM Token Count: ', token_counter.total_llm_token_count)
+                      'Total LLM Token Count: ', token_counter.total_llm_token_count, '\n',
+                      'History Tokens: ', state.history_tokens_doc)
             except Exception as ex:
                 st.warning(f'Index does not exist. Please index some documents.')
                 st.error(str(ex))
                 return
 
     if state.user_input:
-        st.subheader('🙋🏽 Answer')
+        if answer_area is None:
+            st.subheader('🙋🏽 Answer')
+            answer_area = st.empty()
         with st.spinner("Generating query answer..."):
             try:
                 # This will use cached response!
-                response = get_llm_doc_query_response(query_prompt, model_name=state.completions_model, _service_context=service_context)
+                response = get_llm_doc_query_response(query_prompt, **query_kwargs)
             except Exception as ex:
                 st.warning(f'Index does not exist. Please index some documents.')
                 st.error(str(ex))
@@ -187,7 +425,7 @@ def main(title, user_input_confirmed=False):
             state.generated.append((state.user_input, response))
             state.past.append(response)
 
-        st.markdown(response)
+        answer_area.markdown(response)
 
         with st.expander('View conversation history', expanded=False):
             st.markdown('\n\n'.join([f'---\n**Question**\n\n{q}\n\n**Answer**\n\n{a}' for q, a in zip(state.questions, state.past)]))
@@ -12,6 +12,8 @@ from globals import (
     DEFAULT_MODEL_CONFIG, LANG_MODEL_PRICING
 )
 from common import SafeFormatter
+from single_flight import (SingleFlight, single_flight)
+from scraper_async import scrape_articles_concurrent
 
 from app_state import (state, _set_state_cb, init_app_state, reset_app_state)
 init_app_state() # ensure all state variables are initialized
@@ -33,7 +35,11 @@ def correct_json(response_data):
     )))
     return response_data
 
+# concurrent identical requests (from any session in this process) share one LLM call
+graph_query_flight = SingleFlight('Knowledge Graph')
+
 @st.cache_data(ttl=60*60, show_spinner=False)
+@single_flight(graph_query_flight)
 def get_llm_graph_data_response(user_input, model_name=DEFAULT_MODEL_CONFIG['chat_model']):
     if not user_input:
         return None
@@ -159,9 +165,16 @@ def main(title, user_input_confirmed=False, response=None):
             help='Allowed models. Accuracy, speed, token consumption and costs will vary.',
             key='selectbox_graph_chat_model_name'
         )
-
-    # GPT chat models can handle web sites, so we can keep URLs in the user input
-    user_input = state.user_input if state.user_input.strip().startswith('http') else response
+        if graph_query_flight.suppressed:
+            st.caption(f'{graph_query_flight.suppressed} duplicate LLM calls suppressed (shared with concurrent sessions).')
+
+    # The API can't browse web sites, so URLs are scraped (the page cache makes this cheap
+    # on reruns, and the Document Q&A page has usually just fetched the same URL)
+    if state.user_input.strip().startswith('http'):
+        scraped_texts = scrape_articles_concurrent([state.user_input])['text']
+        user_input = scraped_texts[0] if scraped_texts else state.user_input
+    else:
+        user_input = response
     user_input = user_input.replace('\n', ' ').replace('\r', '') if user_input else user_input
 
     if user_input_confirmed and user_input:
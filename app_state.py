@@ -43,10 +43,17 @@ def build_initial_state():
         'query': '',
         'intermediate_steps': True,
         'db_table': DB_TABLE,
+        'data_result': None,
+        'number_input_data_result_page': 1,
         'generated': [],
         'past': [],
         'questions': [],
     
+        # DOCS PAGE STATE
+        'history_summary': '',
+        'history_summarized': 0,
+        'history_tokens_doc': 0,
+
         # KNOWLEDGE GRAPH PAGE STATE
         'user_input': '',
 
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+
+import lxml.html
+
+from common import parse_date_str
+from scraper_dates import DateExtractor
+
+# PUBLISH DATE EXTRACTION BENCHMARK --------------------------------------------
+#
+# Compares the previous fallback chain (a fresh BeautifulSoup parse, datefinder over the
+# full text, then htmldate's extensive search on the HTML string) with the single-parse,
+# cost-ordered DateExtractor, over the saved pages in data/html_fixtures.
+#
+#   python bench_date_extraction.py [fixtures dir] [rounds]
+
+FIXTURES_DIR = os.path.join('data', 'html_fixtures')
+
+def legacy_get_publish_date(html, text):
+    from bs4 import BeautifulSoup
+    import datefinder
+    import htmldate
+
+    soup = BeautifulSoup(html, features="lxml")
+    para = soup.find('p', attrs={'class': 'newsdate'})
+    if para:
+        return parse_date_str(para.next)
+    try:
+        return datefinder.find_dates(text).__next__()
+    except:
+        pass
+    htmldt = htmldate.find_date(html, extensive_search=True, original_date=True)
+    if htmldt:
+        return parse_date_str(htmldt)
+    return None
+
+def load_fixtures(fixtures_dir):
+    with open(os.path.join(fixtures_dir, 'expected.json'), 'r') as f:
+        expected = json.load(f)
+    fixtures = []
+    for name, page in expected.items():
+        with open(os.path.join(fixtures_dir, name), 'r', encoding='utf-8') as f:
+            html = f.read()
+        # stand-in for newspaper's article.text
+        text = lxml.html.fromstring(html).text_content()
+        fixtures.append({'name': name, 'url': page['url'], 'date': page['date'], 'html': html, 'text': text})
+    return fixtures
+
+def _correct(date, expected):
+    return (date.date().isoformat() if date else None) == expected
+
+def main(fixtures_dir=FIXTURES_DIR, rounds=20):
+    fixtures = load_fixtures(fixtures_dir)
+    extractor = DateExtractor()
+    totals = {'legacy': 0.0, 'engine': 0.0}
+    correct = {'legacy': 0, 'engine': 0}
+
+    print(f'{"page":<22}{"expected":<12}{"legacy":<12}{"ms":>8}   {"engine":<12}{"ms":>8}')
+    for fixture in fixtures:
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            legacy = legacy_get_publish_date(fixture['html'], fixture['text'])
+        legacy_ms = (time.perf_counter() - t_start) * 1000 / rounds
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            # the engine's cost includes its one parse of the page
+            engine = extractor.extract(html=fixture['html'], text=fixture['text'], url=fixture['url'])
+        engine_ms = (time.perf_counter() - t_start) * 1000 / rounds
+
+        totals['legacy'] += legacy_ms
+        totals['engine'] += engine_ms
+        correct['legacy'] += _correct(legacy, fixture['date'])
+        correct['engine'] += _correct(engine, fixture['date'])
+        print(f'{fixture["name"]:<22}{str(fixture["date"]):<12}'
+              f'{legacy.date().isoformat() if legacy else "-":<12}{legacy_ms:>8.2f}   '
+              f'{engine.date().isoformat() if engine else "-":<12}{engine_ms:>8.2f}')
+
+    print('\nTotal ms per corpus pass: legacy {:.2f}, engine {:.2f} ({:.1f}x)'.format(
+        totals['legacy'], totals['engine'], totals['legacy'] / totals['engine'] if totals['engine'] else 0))
+    print(f'Correct dates: legacy {correct["legacy"]}/{len(fixtures)}, engine {correct["engine"]}/{len(fixtures)}\n')
+    print(f'{"strategy":<20}{"attempts":>9}{"hits":>6}{"hit rate":>10}{"mean ms":>9}')
+    for row in extractor.stats.report():
+        print(f'{row["strategy"]:<20}{row["attempts"]:>9}{row["hits"]:>6}{row["hit_rate"]:>10.2f}{row["mean_ms"]:>9.3f}')
+
+if __name__ == '__main__':
+    main(
+        sys.argv[1] if len(sys.argv) > 1 else FIXTURES_DIR,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
@@ -44,72 +44,54 @@ def print_magenta(msg):
 
 # https://newspaper.readthedocs.io/en/latest/user_guide/quickstart.html
 import newspaper
-# https://www.crummy.com/software/BeautifulSoup/
-from bs4 import BeautifulSoup
-import htmldate
 import dateutil
-import datefinder
 import random
 import time
 
+HEADERS = { 'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:78.0) Gecko/20100101 Firefox/78.0',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+            'Referer' : 'https://google.com/' }
+REQUEST_TIMEOUT = 10
+
+def article_record(article):
+    """Fields of a downloaded, parsed and nlp()'d newspaper article (one `articles_dict` row)"""
+    if article.publish_date == None:
+        publish_date = alternative_get_publish_date(article)
+    else:
+        publish_date = parse_date_str(str(article.publish_date))
+    
+    if publish_date:
+        article_text = f'Published: {publish_date.strftime("%d %B %Y")}\n\n{article.text}'
+    else:
+        article_text = article.text
+    article_text = article_text.replace('\n\n','\n').replace('\r\n','\n')
+
+    # print(f'{article.title}\n{article.authors}\n{article.publish_date}\n{article_text[:20]}\n\
+    #     {article.keywords}\n{article.summary}\n{article.url}')
+
+    return {'title': article.title, 'author': article.authors, 'date': publish_date,
+            'text': article_text, 'keywords': article.keywords, 'summary': article.summary,
+            'url': article.url}
+
+def articles_dict(records):
+    # NOTE: Could use this dict object to return a Pandas dataframe instead!
+    return {key: [record[key] for record in records]
+            for key in ['title', 'author', 'date', 'text', 'keywords', 'summary', 'url']}
+
 def scrape_articles(source_urls):
-    article_titles = []
-    article_authors = []
-    article_dates = []
-    article_texts = []
-    article_keywords = []
-    article_summaries = []
-    article_urls = []
-
-    articles_dict = \
-        {'title':article_titles, 'author':article_authors, 'date':article_dates, \
-          'text':article_texts, 'keywords':article_keywords, 'summary':article_summaries, \
-          'url':article_urls }
+    records = []
 
     def _newspaper_scraper_helper(url):
-        HEADERS = { 'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:78.0) Gecko/20100101 Firefox/78.0',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                    'Referer' : 'https://google.com/' }
         config = newspaper.Config()
         config.headers = HEADERS
-        config.request_timeout = 10
+        config.request_timeout = REQUEST_TIMEOUT
 
         article = newspaper.Article(url=url, language='en')
         article.download()
         article.parse()
         article.nlp()
 
-        article_titles.append(article.title)
-        article_authors.append(article.authors)
-
-        if article.publish_date == None:
-            publish_date = alternative_get_publish_date(article)
-        else:
-            publish_date = parse_date_str(str(article.publish_date))
-        article_dates.append(publish_date)
-        
-        if publish_date:
-            article_text = f'Published: {publish_date.strftime("%d %B %Y")}\n\n{article.text}'
-        else:
-            article_text = article.text
-        article_text = article_text.replace('\n\n','\n').replace('\r\n','\n')
-        article_texts.append(article_text)
-        
-        article_keywords.append(article.keywords)
-        article_summaries.append(article.summary)
-        article_urls.append(article.url)
-
-        # print(f'{article.title}\n{article.authors}\n{article.publish_date}\n{article_text[:20]}\n\
-        #     {article.keywords}\n{article.summary}\n{article.url}')
-
-        articles_dict = \
-            {'title':article_titles, 'author':article_authors, 'date':article_dates, \
-             'text':article_texts, 'keywords':article_keywords, 'summary':article_summaries, \
-             'url':article_urls }
-            
-        # NOTE: Could use this dict object to return a Pandas dataframe instead!
-        
-        return articles_dict
+        records.append(article_record(article))
 
     # for testing
     '''
@@ -134,33 +116,16 @@ def scrape_articles(source_urls):
             print('!!Newspaper Exception!!', '\n', e)
             continue
 
-    return articles_dict
+    return articles_dict(records)
 
-# if newspaper can't find, then use bs4, datafinder, htmldate
+# if newspaper can't find, then use selectors, the URL, htmldate and datefinder
 def alternative_get_publish_date(article):
-    # try bs4
-    soup = BeautifulSoup(article.html, features="lxml")
-    # class=newsdate is specific to one site I was scraping (you can change this to suit your needs)
-    para = soup.find('p', attrs={'class': 'newsdate'})
-    if para:
-        datetime_obj = parse_date_str(para.next)
-        return datetime_obj
-
-    # try datefinder
-    try:
-        datefndrdt = datefinder.find_dates(article.text)
-        datetime_obj = datefndrdt.__next__()
-        return datetime_obj
-    except:
-        pass
-
-    # try htmldate
-    htmldt = htmldate.find_date(article.html, extensive_search=True, original_date=True)
-    if htmldt:
-        datetime_obj = parse_date_str(htmldt)
-        return datetime_obj
-
-    return None
+    # NOTE: imported here, as scraper_dates uses parse_date_str
+    from scraper_dates import default_date_extractor
+    # reuse newspaper's (unmodified) parse of the page rather than parsing it again
+    return default_date_extractor().extract(
+        html=article.html, text=article.text, url=article.url, tree=article.clean_doc
+    )
 
 def parse_date_str(date_str):
     if date_str:
@@ -0,0 +1,108 @@
+import time
+import queue
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from globals import (
+    DB_FILE, DATA_DB_READERS, DATA_DB_BUSY_TIMEOUT, DATA_TABLE_PREFIX, DATA_DB_MAX_TABLES, DATA_TABLE_MIN_IDLE,
+    DATA_TABLE_TOUCH_INTERVAL
+)
+from data_ingest import (INGEST_LOG_TABLE, ensure_ingest_log, quote_identifier)
+from data_sql_exec import install_progress_handler
+from data_profile import (PROFILE_TABLE, ensure_profile_table)
+
+# DATA CHAT DATABASE -----------------------------------------------------------
+#
+# Each uploaded dataset gets its own table, named by the hash of its content, so
+# sessions never overwrite each other's data (and sessions uploading the same file
+# share one table). The database runs in WAL mode: one writer connection, used under a
+# lock for loads, and a pool of read-only connections, so queries run in parallel with
+# each other and with a load. Reader connections honour query budgets (see
+# data_sql_exec.py). Tables unused for a while are dropped, least recently used first,
+# once there are more than DATA_DB_MAX_TABLES.
+
+USAGE_TABLE = '_table_usage'
+
+def dataset_table(fingerprint):
+    """Table name of the dataset with this fingerprint"""
+    return f'{DATA_TABLE_PREFIX}{hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]}'
+
+class SQLitePool:
+    def __init__(self, path=DB_FILE, readers=DATA_DB_READERS, busy_timeout=DATA_DB_BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute(f'CREATE TABLE IF NOT EXISTS {USAGE_TABLE} (table_name TEXT PRIMARY KEY, last_used REAL NOT NULL)')
+        self._touched = {}       # table -> time of its last usage record, written by this process
+        self._readers = queue.LifoQueue()
+        for _ in range(readers):
+            self._readers.put(self.connect_reader())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        # WAL readers don't block the writer, and the writer doesn't block readers
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def connect_reader(self):
+        """A new read-only connection (e.g. for an SQLAlchemy pool), subject to query budgets"""
+        conn = self._connect()
+        conn.execute('PRAGMA query_only=ON')
+        install_progress_handler(conn)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    # TABLE LIFETIME -----------------------------------------------------------
+
+    def touch(self, table, interval=DATA_TABLE_TOUCH_INTERVAL):
+        """Record that `table` is in use; at most every `interval` seconds, as each rerun touches it"""
+        now = time.time()
+        with self.writer() as conn:
+            if now - self._touched.get(table, 0.0) < interval:
+                return
+            conn.execute(f'INSERT OR REPLACE INTO {USAGE_TABLE} (table_name, last_used) VALUES (?, ?)', (table, now))
+            conn.commit()
+            self._touched[table] = now
+
+    def gc_tables(self, max_tables=DATA_DB_MAX_TABLES, min_idle=DATA_TABLE_MIN_IDLE):
+        """Drop the least recently used dataset tables beyond `max_tables`, if idle for `min_idle` seconds"""
+        with self.writer() as conn:
+            ensure_ingest_log(conn)
+            ensure_profile_table(conn)
+            tables = [name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND substr(name, 1, ?) = ?",
+                (len(DATA_TABLE_PREFIX), DATA_TABLE_PREFIX)
+            )]
+            last_used = dict(conn.execute(f'SELECT table_name, last_used FROM {USAGE_TABLE}').fetchall())
+            # tables without a usage record are the oldest
+            tables.sort(key=lambda name: last_used.get(name, 0.0), reverse=True)
+            dropped = [
+                name for name in tables[max_tables:]
+                if last_used.get(name, 0.0) < time.time() - min_idle
+            ]
+            for name in dropped:
+                conn.execute(f'DROP TABLE IF EXISTS {quote_identifier(name)}')
+                conn.execute(f'DELETE FROM {USAGE_TABLE} WHERE table_name = ?', (name,))
+                conn.execute(f'DELETE FROM {INGEST_LOG_TABLE} WHERE table_name = ?', (name,))
+                conn.execute(f'DELETE FROM {PROFILE_TABLE} WHERE table_name = ?', (name,))
+                self._touched.pop(name, None)
+            conn.commit()
+        if dropped:
+            print('---- Data DB ----', '\n', f'Dropped {len(dropped)} unused tables: {dropped}')
+        return dropped
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from globals import (CACHE_DIR, EXCEL_MAX_WORKERS, EXCEL_CACHE_MAX_FILES)
+
+# EXCEL CONVERSION CACHE -------------------------------------------------------
+#
+# `pd.read_excel` builds the whole workbook in memory before pandas sees a cell, and
+# did so on every load. Instead, a workbook is converted once per file content hash:
+# its sheets are streamed row by row (openpyxl read-only mode), in parallel worker
+# processes, into a columnar cache (one .npz of column arrays per sheet). Later loads,
+# by any session, read the cache and never open the XLSX. The least recently used
+# workbooks are dropped beyond EXCEL_CACHE_MAX_FILES.
+#
+# Columns are stored typed, so loading them unpickles nothing: numbers and booleans as
+# their numeric dtype, dates as datetime64, and anything else as text (the UTF-8 of
+# the column's cells, with their character offsets and a null mask).
+
+_EXCEL_CACHE_DIR = os.path.join(CACHE_DIR, 'excel-v2')     # v1 held pickled object arrays
+_SHEETS_FILE = 'sheets.json'
+
+def _cache_dir(file_hash, cache_dir=_EXCEL_CACHE_DIR):
+    return os.path.join(cache_dir, file_hash)
+
+def _header(row):
+    # as pandas names them: blank headers 'Unnamed: i', repeats 'name.1', 'name.2', ...
+    names = []
+    seen = {}
+    for i, value in enumerate(row):
+        name = f'Unnamed: {i}' if value is None else str(value)
+        n = seen.get(name, 0)
+        seen[name] = n + 1
+        names.append(f'{name}.{n}' if n else name)
+    return names
+
+# SHEET PARSER (runs in worker processes) --------------------------------------
+
+def _convert_sheet(path, sheet_name, out_path):
+    """Stream one sheet into a .npz of column arrays; returns (column names, rows)"""
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return [], 0
+        names = _header(header)
+        columns = [[] for _ in names]
+        blank_run = 0
+        for row in rows:
+            if all(value is None for value in row):
+                blank_run += 1
+                continue
+            # blank rows inside the data are kept, trailing ones are not
+            for _ in range(blank_run):
+                for column in columns:
+                    column.append(None)
+            blank_run = 0
+            for column, value in zip(columns, row):
+                column.append(value)
+            for column in columns[len(row):]:
+                column.append(None)
+    finally:
+        workbook.close()
+
+    arrays = {}
+    for i, values in enumerate(columns):
+        arrays.update(_column_arrays(f'c{i}', values))
+    np.savez(out_path, **arrays)
+    return names, len(columns[0]) if columns else 0
+
+def _column_arrays(key, values):
+    """The typed arrays a column's cells are stored as (see `_column`)"""
+    series = pd.Series(values, dtype=object)
+    # numbers stored as text are numbers, as `pd.read_excel` reads them (an empty column is all NaN)
+    numeric = pd.to_numeric(series, errors='coerce')
+    if numeric.notna().sum() == series.notna().sum() and numeric.dtype.kind in 'biuf':
+        return {key: numeric.to_numpy()}
+    inferred = series.infer_objects()
+    if inferred.dtype.kind == 'M':
+        return {key: inferred.to_numpy(dtype='datetime64[ns]')}
+    null = series.isna().to_numpy()
+    texts = ['' if is_null else str(value) for value, is_null in zip(values, null)]
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    return {
+        f'{key}_text': np.frombuffer(''.join(texts).encode('utf-8'), dtype=np.uint8),
+        f'{key}_offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        f'{key}_null': null,
+    }
+
+def _column(arrays, key):
+    """A column read back from its typed arrays (text as an object column, None for nulls)"""
+    if key in arrays.files:
+        return arrays[key]
+    text = arrays[f'{key}_text'].tobytes().decode('utf-8')
+    offsets = arrays[f'{key}_offsets']
+    values = np.array([text[start:end] for start, end in zip(offsets[:-1], offsets[1:])], dtype=object)
+    values[arrays[f'{key}_null']] = None
+    return values
+
+# CACHE ------------------------------------------------------------------------
+
+def _evict(cache_dir, max_files):
+    entries = sorted(
+        (os.path.getmtime(os.path.join(cache_dir, name)), name) for name in os.listdir(cache_dir)
+        if os.path.isfile(os.path.join(cache_dir, name, _SHEETS_FILE))
+    )
+    for _, name in entries[:max(0, len(entries) - max_files)]:
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+def convert_workbook(excel_file, file_hash, cache_dir=_EXCEL_CACHE_DIR, max_workers=EXCEL_MAX_WORKERS):
+    """Convert every sheet of `excel_file` (an uploaded file) into the cache. Returns the sheets' info."""
+    import openpyxl
+    t_start = time.time()
+    out_dir = _cache_dir(file_hash, cache_dir)
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        # workers open the workbook from disk, rather than each getting a copy of its bytes
+        path = os.path.join(tmp_dir, 'source.xlsx')
+        with open(path, 'wb') as f:
+            f.write(excel_file.getbuffer())
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        sheet_names = workbook.sheetnames
+        workbook.close()
+
+        tasks = [(path, name, os.path.join(tmp_dir, f'sheet_{i}.npz')) for i, name in enumerate(sheet_names)]
+        if len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(_convert_sheet, *zip(*tasks)))
+        else:
+            results = [_convert_sheet(*task) for task in tasks]
+        os.remove(path)
+
+        sheets = [
+            {'name': name, 'file': os.path.basename(out_path), 'columns': columns, 'rows': rows}
+            for (_, name, out_path), (columns, rows) in zip(tasks, results)
+        ]
+        with open(os.path.join(tmp_dir, _SHEETS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(sheets, f)
+        # another process may have converted the same workbook meanwhile
+        if os.path.isdir(out_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    print('---- Excel Conversion ----', '\n',
+          f'{len(sheets)} sheets ({sum(sheet["rows"] for sheet in sheets)} rows) converted in {time.time() - t_start:.2f}s')
+    _evict(cache_dir, EXCEL_CACHE_MAX_FILES)
+    return sheets
+
+def workbook_sheets(excel_file, file_hash, cache_dir=_EXCEL_CACHE_DIR):
+    """Info (name, columns, rows) of each sheet of the workbook, converting it if not yet cached"""
+    path = os.path.join(_cache_dir(file_hash, cache_dir), _SHEETS_FILE)
+    if not os.path.isfile(path):
+        return convert_workbook(excel_file, file_hash, cache_dir)
+    # marks the workbook as recently used
+    os.utime(os.path.dirname(path))
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_sheet(excel_file, file_hash, sheet_name=None, cache_dir=_EXCEL_CACHE_DIR):
+    """A sheet (by default the first) of the workbook as a DataFrame, read from the cache"""
+    sheets = workbook_sheets(excel_file, file_hash, cache_dir)
+    sheet = next((sheet for sheet in sheets if sheet['name'] == sheet_name), sheets[0])
+    with np.load(os.path.join(_cache_dir(file_hash, cache_dir), sheet['file'])) as arrays:
+        return pd.DataFrame({name: _column(arrays, f'c{i}') for i, name in enumerate(sheet['columns'])})
@@ -0,0 +1,197 @@
+import re
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from globals import (
+    INDEX_ADVISOR_MIN_QUERIES, INDEX_ADVISOR_MIN_ROWS, INDEX_ADVISOR_MAX_COLUMNS, INDEX_ADVISOR_UNUSED_SECONDS
+)
+from data_ingest import (quote_identifier, table_columns)
+from data_sql_exec import query_budget
+
+# SQLITE INDEX ADVISOR ---------------------------------------------------------
+#
+# Dataset tables are written without indexes, so the SQL the LLM generates scans the
+# whole table. The advisor looks at each query the chain ran (from its intermediate
+# steps): if EXPLAIN QUERY PLAN shows a full scan, the columns the query filters or
+# joins on (equality first, then one range column) and groups by are a candidate index.
+# Once the same candidate has been seen INDEX_ADVISOR_MIN_QUERIES times, the index is
+# built in the background, covering the query's other columns when there are few
+# enough. The query is timed before and after. Advisor indexes that no query plan
+# has used for INDEX_ADVISOR_UNUSED_SECONDS are dropped.
+
+INDEX_PREFIX = 'auto_idx_'
+
+_CLAUSE_RE = re.compile(r'\b(select|from|where|on|group\s+by|order\s+by|having|limit|join)\b', re.IGNORECASE)
+_IDENTIFIER = r'(?:\w+\.)?("[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)'
+_PREDICATE_RE = re.compile(_IDENTIFIER + r'\s*(==|=|<=|>=|<>|!=|<|>|\bnot\s+in\b|\bin\b|\bis\b|\bbetween\b|\blike\b)', re.IGNORECASE)
+_TOKEN_RE = re.compile(_IDENTIFIER)
+_USES_INDEX_RE = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+
+def sql_from_steps(intermediate_steps):
+    """The SQL that SQLDatabaseChain ran, from its intermediate steps (or None)"""
+    for step in intermediate_steps or []:
+        if isinstance(step, dict) and 'sql_cmd' in step:
+            # the chain strips an echoed 'SQLQuery:' prefix only after recording the step
+            return step['sql_cmd'].split('SQLQuery:')[-1].strip()
+    return None
+
+def _unquote(name):
+    return name[1:-1] if name[:1] in '"`[' else name
+
+def _clauses(sql):
+    # (clause keyword, clause text) pairs, e.g. ('where', 'a = 1 AND b > 2')
+    parts = _CLAUSE_RE.split(sql)
+    return [(re.sub(r'\s+', ' ', parts[i].lower()), parts[i + 1]) for i in range(1, len(parts) - 1, 2)]
+
+def candidate_columns(sql, columns):
+    """(index key columns, all columns of the table the query references)"""
+    by_name = {column.lower(): column for column in columns}
+    equality, ranges, grouping = [], [], []
+    for keyword, text in _clauses(sql):
+        if keyword in ('where', 'on', 'having'):
+            for name, operator in _PREDICATE_RE.findall(text):
+                column = by_name.get(_unquote(name).lower())
+                if column:
+                    (equality if operator.lower() in ('=', '==', 'in', 'is') else ranges).append(column)
+        elif keyword in ('group by', 'order by'):
+            grouping.extend(by_name[_unquote(name).lower()] for name in _TOKEN_RE.findall(text) if _unquote(name).lower() in by_name)
+    key = list(dict.fromkeys(equality + ranges[:1] + grouping))
+    referenced = list(dict.fromkeys(
+        by_name[_unquote(name).lower()] for name in _TOKEN_RE.findall(sql) if _unquote(name).lower() in by_name
+    ))
+    return key, referenced
+
+def _index_name(table, columns):
+    return INDEX_PREFIX + hashlib.sha256(f'{table}:{columns}'.encode('utf-8')).hexdigest()[:16]
+
+class IndexAdvisor:
+    def __init__(
+        self, pool, min_queries=INDEX_ADVISOR_MIN_QUERIES, min_rows=INDEX_ADVISOR_MIN_ROWS,
+        max_columns=INDEX_ADVISOR_MAX_COLUMNS, unused_seconds=INDEX_ADVISOR_UNUSED_SECONDS
+    ):
+        self.pool = pool
+        self.min_queries = min_queries
+        self.min_rows = min_rows
+        self.max_columns = max_columns
+        self.unused_seconds = unused_seconds
+        self._lock = threading.Lock()
+        self._seen = {}       # (table, key columns) -> queries that wanted the index
+        self._indexes = {}    # index name -> {'table', 'columns', 'status', 'before_ms', 'after_ms', 'last_used'}
+        # one index is built at a time, off the request path
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # indexes built before a restart are dropped too, if no query uses them
+        with self.pool.reader() as conn:
+            for name, table in conn.execute(
+                "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' AND substr(name, 1, ?) = ?",
+                (len(INDEX_PREFIX), INDEX_PREFIX)
+            ):
+                self._indexes[name] = {
+                    'table': table, 'columns': [], 'status': 'created',
+                    'before_ms': None, 'after_ms': None, 'last_used': time.time(),
+                }
+
+    def _plan(self, sql):
+        # a pooled connection may answer from its statement cache, with a plan from before an index was built
+        conn = self.pool.connect_reader()
+        try:
+            return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+        finally:
+            conn.close()
+
+    def _time_ms(self, sql):
+        t_start = time.perf_counter()
+        with self.pool.reader() as conn, query_budget():
+            conn.execute(sql).fetchall()
+        return (time.perf_counter() - t_start) * 1000
+
+    def _build(self, name, table, columns, sql):
+        try:
+            before_ms = self._time_ms(sql)
+            with self.pool.writer() as conn:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS {name} ON {quote_identifier(table)} '
+                    f'({", ".join(quote_identifier(column) for column in columns)})'
+                )
+                conn.execute(f'ANALYZE {name}')
+                conn.commit()
+            after_ms = self._time_ms(sql)
+            with self._lock:
+                self._indexes[name].update(status='created', before_ms=before_ms, after_ms=after_ms, last_used=time.time())
+            print('---- Index Advisor ----', '\n', f'{name} on {table}{tuple(columns)}: {before_ms:.1f}ms -> {after_ms:.1f}ms')
+        except Exception as ex:
+            with self._lock:
+                self._indexes[name]['status'] = f'failed: {ex}'
+            print('---- Index Advisor ----', '\n', f'{name} on {table} failed: {ex}')
+
+    def _drop_unused(self, table):
+        now = time.time()
+        with self._lock:
+            unused = [
+                name for name, index in self._indexes.items()
+                if index['table'] == table and index['status'] == 'created' and now - index['last_used'] > self.unused_seconds
+            ]
+            for name in unused:
+                self._indexes[name]['status'] = 'dropped'
+        for name in unused:
+            with self.pool.writer() as conn:
+                conn.execute(f'DROP INDEX IF EXISTS {name}')
+                conn.commit()
+            print('---- Index Advisor ----', '\n', f'Dropped unused index {name} on {table}')
+
+    def observe(self, table, sql):
+        """
+        Record a query run against `table`, maybe scheduling an index for it. Returns
+        the advice for the query: its plan and the status (and timings) of its index.
+        """
+        advice = {'plan': [], 'index': None, 'columns': [], 'status': 'no index needed'}
+        if not sql:
+            return advice
+        try:
+            advice['plan'] = self._plan(sql)
+        except Exception as ex:
+            advice['status'] = f'not planned: {ex}'
+            return advice
+
+        now = time.time()
+        with self._lock:
+            for detail in advice['plan']:
+                for name in _USES_INDEX_RE.findall(detail):
+                    if name in self._indexes:
+                        self._indexes[name]['last_used'] = now
+        self._drop_unused(table)
+
+        with self.pool.reader() as conn:
+            columns = table_columns(conn, table)
+            rows = conn.execute(f'SELECT MAX(rowid) FROM {quote_identifier(table)}').fetchone()[0] or 0
+        key, referenced = candidate_columns(sql, columns)
+        if not key:
+            return advice
+        # with few enough columns, the index answers the query without reading the table
+        index_columns = key + [column for column in referenced if column not in key]
+        if len(index_columns) > self.max_columns:
+            index_columns = key[:self.max_columns]
+        name = _index_name(table, index_columns)
+        advice.update(index=name, columns=index_columns)
+
+        full_scan = any(detail.startswith('SCAN ') and 'USING' not in detail for detail in advice['plan'])
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is not None and index['status'] != 'dropped':
+                advice.update({k: index[k] for k in ('status', 'before_ms', 'after_ms')})
+                return advice
+            if not full_scan or rows < self.min_rows:
+                advice['status'] = 'no index needed'
+                return advice
+            seen = self._seen[(table, name)] = self._seen.get((table, name), 0) + 1
+            if seen < self.min_queries:
+                advice['status'] = f'candidate ({seen}/{self.min_queries} queries)'
+                return advice
+            self._indexes[name] = {
+                'table': table, 'columns': index_columns, 'status': 'building',
+                'before_ms': None, 'after_ms': None, 'last_used': now,
+            }
+        self._executor.submit(self._build, name, table, index_columns, sql)
+        advice.update(status='building', before_ms=None, after_ms=None)
+        return advice
@@ -0,0 +1,197 @@
+import time
+import hashlib
+
+import pandas as pd
+
+from globals import (SQLITE_BULK_CACHE_KB, CSV_CHUNK_ROWS, CSV_SCHEMA_SAMPLE_ROWS)
+from data_excel import load_sheet
+
+# DATA INGEST ------------------------------------------------------------------
+#
+# Streamlit reruns the page on every interaction, so the uploaded data must not be
+# written to SQLite on every run. Uploads are fingerprinted (sha256 of the file bytes)
+# and each table's fingerprint is logged in the database: a table is only (re)written
+# when the upload it holds changed. A load drops and refills the table in a single
+# transaction, with bulk-load pragmas, so readers see the old or the new data, never
+# half of it. Load stats (rows, seconds, MB) are logged with the fingerprint.
+#
+# CSV uploads are streamed into the table in chunks, so memory is bounded by the chunk
+# size rather than the file size. The table schema is inferred once, from a sample of
+# the first rows, and text columns stay text in every chunk. The page previews the
+# data with a LIMIT query instead of holding the whole frame. Excel sheets are read
+# from their converted columnar cache (see data_excel.py). The table is profiled as it
+# is written (see data_profile.py), and the profile is committed with it.
+
+INGEST_LOG_TABLE = '_ingest_log'
+
+def upload_fingerprint(uploaded_file):
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+def column_name(name):
+    return str(name).replace(' ', '_').lower()
+
+def quote_identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+def sql_type(dtype):
+    """SQLite column type of a pandas dtype (as `DataFrame.to_sql` maps them)"""
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+def _column_values(series):
+    # python scalars sqlite3 can bind (NaN is stored as NULL)
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    elif pd.api.types.is_bool_dtype(series.dtype):
+        series = series.astype('Int64')
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def ensure_ingest_log(conn):
+    conn.execute(
+        f'CREATE TABLE IF NOT EXISTS {INGEST_LOG_TABLE} ('
+        'table_name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, rows INTEGER NOT NULL, '
+        'seconds REAL NOT NULL, mb REAL NOT NULL, loaded REAL NOT NULL)'
+    )
+
+def load_stats(conn, table):
+    """Stats of the last load into `table` (incl. the upload fingerprint), or None"""
+    ensure_ingest_log(conn)
+    row = conn.execute(
+        f'SELECT fingerprint, rows, seconds, mb, loaded FROM {INGEST_LOG_TABLE} WHERE table_name = ?', (table,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {'table': table, 'fingerprint': row[0], 'rows': row[1], 'seconds': row[2], 'mb': row[3], 'loaded': row[4]}
+
+def _bulk_pragmas(conn):
+    """Set bulk-load pragmas; returns the synchronous setting to restore"""
+    synchronous = conn.execute('PRAGMA synchronous').fetchone()[0]
+    # the table is rebuilt from the upload if a crash loses it, so durability can wait for the commit
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA cache_size=-{SQLITE_BULK_CACHE_KB}')
+    return synchronous
+
+def _create_table(conn, table, columns, dtypes):
+    definition = ', '.join(f'{quote_identifier(col)} {sql_type(dtype)}' for col, dtype in zip(columns, dtypes))
+    conn.execute(f'DROP TABLE IF EXISTS {quote_identifier(table)}')
+    conn.execute(f'CREATE TABLE {quote_identifier(table)} ({definition})')
+
+def _insert_rows(conn, table, df):
+    placeholders = ', '.join('?' * len(df.columns))
+    rows = zip(*[_column_values(df[col]) for col in df.columns])
+    conn.executemany(f'INSERT INTO {quote_identifier(table)} VALUES ({placeholders})', rows)
+
+def write_table(conn, table, df, profiler=None):
+    """Replace `table` with the rows of `df`, in the caller's transaction; returns the row count"""
+    _create_table(conn, table, df.columns, df.dtypes)
+    _insert_rows(conn, table, df)
+    if profiler:
+        profiler.update(df)
+    return len(df)
+
+def write_csv_table(
+    conn, table, csv_file, chunk_rows=CSV_CHUNK_ROWS, sample_rows=CSV_SCHEMA_SAMPLE_ROWS, progress=None, profiler=None
+):
+    """
+    Replace `table` with the rows of `csv_file`, read `chunk_rows` at a time, in the
+    caller's transaction. `progress(rows, fraction)` is called after each chunk. Returns the row count.
+    """
+    csv_file.seek(0, 2)
+    size = csv_file.tell()
+    csv_file.seek(0)
+    sample = pd.read_csv(csv_file, nrows=sample_rows)
+    csv_file.seek(0)
+    raw_sample = pd.read_csv(csv_file, nrows=sample_rows, dtype=str)
+    csv_file.seek(0)
+    # columns that are text in the sample stay text, whatever a chunk holds; so do numbers
+    # written with leading zeros (codes such as "007"), which would lose the zeros as numbers
+    text_columns = {
+        col: str for col in sample.columns
+        if sql_type(sample[col].dtype) == 'TEXT' or raw_sample[col].str.match(r'[+-]?0\d').any()
+    }
+    columns = [column_name(col) for col in sample.columns]
+    _create_table(conn, table, columns, [object if col in text_columns else sample[col].dtype for col in sample.columns])
+
+    rows = 0
+    for chunk in pd.read_csv(csv_file, chunksize=chunk_rows, dtype=text_columns):
+        chunk.columns = columns
+        _insert_rows(conn, table, chunk)
+        if profiler:
+            profiler.update(chunk)
+        rows += len(chunk)
+        if progress:
+            progress(rows, min(1.0, csv_file.tell() / size) if size else 1.0)
+    return rows
+
+def _load(conn, table, fingerprint, size_bytes, write):
+    # runs `write(conn, profiler)` (which returns the row count) unless `table` already holds this upload;
+    # `conn` must not be used by anyone else meanwhile (see SQLitePool.writer)
+    from data_profile import (TableProfiler, save_profile, load_profile)   # data_profile builds on this module
+    stats = load_stats(conn, table)
+    # tables loaded before profiling are loaded again, to profile them
+    if stats is not None and stats['fingerprint'] == fingerprint and load_profile(conn, table) is not None:
+        return {**stats, 'skipped': True}
+
+    t_start = time.time()
+    synchronous = _bulk_pragmas(conn)
+    conn.execute('BEGIN')
+    try:
+        profiler = TableProfiler()
+        rows = write(conn, profiler)
+        save_profile(conn, table, profiler.profile())
+        stats = {
+            'table': table, 'fingerprint': fingerprint, 'rows': rows,
+            'seconds': time.time() - t_start, 'mb': size_bytes / (1024 * 1024), 'loaded': time.time(),
+        }
+        conn.execute(
+            f'INSERT OR REPLACE INTO {INGEST_LOG_TABLE} (table_name, fingerprint, rows, seconds, mb, loaded) '
+            'VALUES (:table, :fingerprint, :rows, :seconds, :mb, :loaded)', stats
+        )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute(f'PRAGMA synchronous={synchronous}')
+
+    print('---- Data Ingest ----', '\n',
+          f"{stats['rows']} rows ({stats['mb']:.1f} MB) loaded into {table} in {stats['seconds']:.2f}s")
+    return {**stats, 'skipped': False}
+
+def ingest_dataframe(conn, table, df, fingerprint, size_bytes=0):
+    """
+    Load `df` (the data of the upload with this `fingerprint`) into `table`, unless the
+    table already holds it. Returns the load stats, with 'skipped' True if nothing was written.
+    """
+    return _load(conn, table, fingerprint, size_bytes, lambda conn, profiler: write_table(conn, table, df, profiler))
+
+def ingest_csv(conn, table, csv_file, fingerprint, size_bytes=0, progress=None, **kwargs):
+    """As `ingest_dataframe`, streaming the rows of `csv_file` (see `write_csv_table`)"""
+    return _load(
+        conn, table, fingerprint, size_bytes,
+        lambda conn, profiler: write_csv_table(conn, table, csv_file, progress=progress, profiler=profiler, **kwargs)
+    )
+
+def ingest_excel(conn, table, excel_file, file_hash, sheet_name=None, size_bytes=0):
+    """As `ingest_dataframe`, for a sheet (by default the first) of the workbook `excel_file`"""
+    def _write(conn, profiler):
+        df = load_sheet(excel_file, file_hash, sheet_name)
+        df.columns = [column_name(col) for col in df.columns]
+        return write_table(conn, table, df, profiler)
+    # the table holds one sheet of the file
+    return _load(conn, table, f'{file_hash}:{sheet_name or ""}', size_bytes, _write)
+
+# TABLE ACCESS -----------------------------------------------------------------
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})')]
+
+def preview(conn, table, limit):
+    """The first `limit` rows of `table`, as a DataFrame"""
+    return pd.read_sql_query(f'SELECT * FROM {quote_identifier(table)} LIMIT ?', conn, params=(limit,))
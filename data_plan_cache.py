@@ -0,0 +1,84 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+
+from globals import (CACHE_DIR, SQL_PLAN_CACHE_MAX_ENTRIES)
+from data_ingest import quote_identifier
+
+# NL-TO-SQL PLAN CACHE ---------------------------------------------------------
+#
+# The SQL the LLM generated for a question is cached against the normalized question,
+# the model, the table's schema fingerprint (column names and types) and the results
+# limit. Asking the same question of a table with the same schema, in any session and
+# on re-uploads of updated data, runs the cached SQL directly and shows its result.
+# There is no LLM call (nor schema linking).
+# A schema change changes the fingerprint, so SQL written for the old schema is never
+# reused. The SQL is stored with the table name abstracted, since tables are named by
+# their content. The cache is a SQLite file, and the least recently used entries are
+# evicted beyond a size bound.
+
+_TABLE_PLACEHOLDER = '__table__'
+
+def normalize_question(question):
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?.!').strip().lower()
+
+def schema_fingerprint(conn, table):
+    columns = [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})')]
+    return hashlib.sha256(repr(columns).encode('utf-8')).hexdigest()
+
+def _key(question, model, schema, limit):
+    return hashlib.sha256(f'{normalize_question(question)}\x00{model}\x00{schema}\x00{limit}'.encode('utf-8')).hexdigest()
+
+class SQLPlanCache:
+    def __init__(self, path=os.path.join(CACHE_DIR, 'sql_plans.sqlite3'), max_entries=SQL_PLAN_CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS plans ('
+            'key TEXT PRIMARY KEY, question TEXT NOT NULL, model TEXT NOT NULL, schema TEXT NOT NULL, '
+            'sql TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def lookup(self, question, model, schema, limit, table):
+        """The cached SQL for the question, written for `table`, or None"""
+        key = _key(question, model, schema, limit)
+        with self._lock:
+            row = self._conn.execute('SELECT sql FROM plans WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE plans SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return row[0].replace(_TABLE_PLACEHOLDER, table)
+
+    def store(self, question, model, schema, limit, table, sql):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO plans (key, question, model, schema, sql, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (_key(question, model, schema, limit), normalize_question(question), model, schema,
+                 re.sub(rf'\b{re.escape(table)}\b', _TABLE_PLACEHOLDER, sql), now, now)
+            )
+            # least recently used beyond max_entries
+            self._conn.execute(
+                'DELETE FROM plans WHERE key IN (SELECT key FROM plans ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def discard(self, question, model, schema, limit):
+        """Forget a cached plan (e.g. its SQL failed)"""
+        with self._lock:
+            self._conn.execute('DELETE FROM plans WHERE key = ?', (_key(question, model, schema, limit),))
+            self._conn.commit()
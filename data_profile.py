@@ -0,0 +1,138 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from globals import (PROFILE_TOP_VALUES, PROFILE_MAX_DISTINCT)
+from data_ingest import (quote_identifier, sql_type)
+
+# TABLE PROFILE ----------------------------------------------------------------
+#
+# A compact profile of each dataset table, computed once while it is loaded (chunk by
+# chunk, with vectorized pandas operations): per column its type, null rate, number of
+# distinct values, min/max and most frequent values. It is stored next to the table and
+# given to the SQL chain as the table's schema, in place of the CREATE TABLE statement
+# and sample rows the chain would otherwise query for every question.
+#
+# Distinct values are tracked up to PROFILE_MAX_DISTINCT per column; beyond that the
+# count is a lower bound and the top values are approximate.
+
+PROFILE_TABLE = '_table_profiles'
+
+def _scalar(value):
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(pd.Timestamp(value))
+    return value.item() if isinstance(value, np.generic) else value
+
+class TableProfiler:
+    def __init__(self, top_values=PROFILE_TOP_VALUES, max_distinct=PROFILE_MAX_DISTINCT):
+        self.top_values = top_values
+        self.max_distinct = max_distinct
+        self.rows = 0
+        self.columns = None
+        self._types = {}
+        self._nulls = None
+        self._min = {}
+        self._max = {}
+        self._counts = {}       # column -> value counts (a Series), up to max_distinct values
+        self._truncated = set()
+
+    def update(self, df):
+        """Add a chunk of the table's rows (with the table's column names)"""
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self._types = {col: sql_type(df[col].dtype) for col in df.columns}
+            self._nulls = pd.Series(0, index=df.columns)
+        self.rows += len(df)
+        self._nulls = self._nulls.add(df.isna().sum(), fill_value=0)
+
+        ordered = [col for col in df.columns if self._types[col] in ('INTEGER', 'REAL', 'TIMESTAMP')]
+        for col in ordered:
+            values = df[col]
+            if not pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_datetime64_any_dtype(values.dtype):
+                # a chunk with text in a numeric column: compare what is numeric
+                values = pd.to_numeric(values, errors='coerce')
+            low, high = values.min(), values.max()
+            if pd.notna(low):
+                self._min[col] = low if col not in self._min else min(self._min[col], low)
+                self._max[col] = high if col not in self._max else max(self._max[col], high)
+
+        for col in df.columns:
+            counts = df[col].value_counts(sort=False)
+            merged = counts if col not in self._counts else self._counts[col].add(counts, fill_value=0)
+            if len(merged) > self.max_distinct:
+                merged = merged.nlargest(self.max_distinct)
+                self._truncated.add(col)
+            self._counts[col] = merged
+
+    def profile(self):
+        columns = []
+        for col in self.columns or []:
+            counts = self._counts[col]
+            nulls = int(self._nulls[col])
+            columns.append({
+                'name': col,
+                'type': self._types[col],
+                'null_rate': round(nulls / self.rows, 4) if self.rows else 0.0,
+                'distinct': len(counts),
+                'distinct_exact': col not in self._truncated,
+                'min': _scalar(self._min[col]) if col in self._min else None,
+                'max': _scalar(self._max[col]) if col in self._max else None,
+                'top': [[_scalar(value), int(n)] for value, n in counts.nlargest(self.top_values).items()],
+            })
+        return {'rows': self.rows, 'columns': columns}
+
+# STORAGE ----------------------------------------------------------------------
+
+def ensure_profile_table(conn):
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {PROFILE_TABLE} (table_name TEXT PRIMARY KEY, profile TEXT NOT NULL)')
+
+def save_profile(conn, table, profile):
+    """Store the profile of `table`, in the caller's transaction"""
+    ensure_profile_table(conn)
+    conn.execute(f'INSERT OR REPLACE INTO {PROFILE_TABLE} (table_name, profile) VALUES (?, ?)', (table, json.dumps(profile)))
+
+def load_profile(conn, table):
+    try:
+        row = conn.execute(f'SELECT profile FROM {PROFILE_TABLE} WHERE table_name = ?', (table,)).fetchone()
+    except Exception:
+        # no table has been profiled yet
+        return None
+    return json.loads(row[0]) if row else None
+
+# SCHEMA CONTEXT ---------------------------------------------------------------
+
+_MAX_LITERAL_CHARS = 40
+
+def _literal(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    if isinstance(value, str):
+        return f"'{value[:_MAX_LITERAL_CHARS]}{'...' if len(value) > _MAX_LITERAL_CHARS else ''}'"
+    return str(value)
+
+def column_info(column):
+    """The column's definition and notes, e.g. ('"year" INTEGER', '2015..2030, 3% null')"""
+    notes = []
+    if column['min'] is not None:
+        notes.append(f"{_literal(column['min'])}..{_literal(column['max'])}")
+    else:
+        distinct = f"{column['distinct']}{'' if column['distinct_exact'] else '+'} distinct"
+        examples = ', '.join(_literal(value) for value, _ in column['top'])
+        notes.append(f'{distinct}, e.g. {examples}' if examples else distinct)
+    if column['null_rate']:
+        notes.append(f"{column['null_rate']:.0%} null")
+    return f"{quote_identifier(column['name'])} {column['type']}", ', '.join(notes)
+
+def table_info(table, profile, columns=None):
+    """Schema context for the SQL chain: the table's profile (of `columns` only, if given)"""
+    selected = [
+        column for column in profile['columns']
+        if columns is None or column['name'] in columns
+    ]
+    lines = []
+    for i, column in enumerate(selected):
+        definition, notes = column_info(column)
+        lines.append(f"  {definition}{',' if i < len(selected) - 1 else ''} -- {notes}")
+    lines = '\n'.join(lines)
+    return f"CREATE TABLE {quote_identifier(table)} (\n{lines}\n)\n/* {profile['rows']} rows */"
@@ -0,0 +1,99 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from globals import (
+    SCHEMA_LINK_MIN_COLUMNS, SCHEMA_LINK_TOP_COLUMNS, SCHEMA_LINK_KEY_COLUMNS, DATA_DB_MAX_TABLES
+)
+from data_profile import (column_info, table_info)
+from docs_history import count_tokens
+
+# SCHEMA LINKING ---------------------------------------------------------------
+#
+# On wide tables (exports with hundreds of columns) the schema context alone is
+# thousands of prompt tokens per question. Each column is described by its name and
+# profile (see data_profile.py) and embedded once per dataset; the embeddings are
+# cached by text, so a restart or a re-upload embeds nothing again. A question is
+# embedded and only the SCHEMA_LINK_TOP_COLUMNS most similar columns, the columns it
+# names and the table's key columns are given to the SQL chain. Tables with fewer than
+# SCHEMA_LINK_MIN_COLUMNS columns are given whole.
+
+_KEY_NAME_RE = re.compile(r'(^|_)(id|key|code)$')
+
+def column_description(column):
+    """Text embedded for a column, e.g. 'unit price (REAL): 0.5..99, 2% null'"""
+    _, notes = column_info(column)
+    return f"{column['name'].replace('_', ' ')} ({column['type']}): {notes}"
+
+def key_columns(profile, max_columns=SCHEMA_LINK_KEY_COLUMNS):
+    """Columns named like keys, or holding unique integers or text, in table order"""
+    keys = [
+        column['name'] for column in profile['columns']
+        if _KEY_NAME_RE.search(column['name'])
+        or (column['type'] in ('INTEGER', 'TEXT') and column['distinct_exact'] and column['distinct'] == profile['rows'] > 1)
+    ]
+    return keys[:max_columns]
+
+def named_columns(profile, question):
+    """Columns the question names (underscores read as spaces)"""
+    words = re.findall(r'\w+', question.lower())
+    text = f" {' '.join(words)} "
+    return [
+        column['name'] for column in profile['columns']
+        if f" {column['name'].replace('_', ' ')} " in text
+    ]
+
+class SchemaLinker:
+    def __init__(
+        self, embed_model, min_columns=SCHEMA_LINK_MIN_COLUMNS, top_columns=SCHEMA_LINK_TOP_COLUMNS,
+        max_tables=DATA_DB_MAX_TABLES
+    ):
+        self.embed_model = embed_model
+        self.min_columns = min_columns
+        self.top_columns = top_columns
+        self.max_tables = max_tables
+        self._lock = threading.Lock()
+        self._vectors = OrderedDict()     # table -> (column names, unit-norm column embeddings)
+
+    def _column_vectors(self, table, profile):
+        with self._lock:
+            if table in self._vectors:
+                self._vectors.move_to_end(table)
+                return self._vectors[table]
+        names = [column['name'] for column in profile['columns']]
+        vectors = np.asarray(
+            self.embed_model.get_text_embedding_batch([column_description(column) for column in profile['columns']]),
+            dtype=np.float32
+        )
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._vectors[table] = (names, vectors)
+            while len(self._vectors) > self.max_tables:
+                self._vectors.popitem(last=False)
+        return names, vectors
+
+    def link(self, table, profile, question, model_name):
+        """
+        The table info for the question: its relevant columns only, on wide tables.
+        Returns (table info, {'columns', 'total_columns', 'tokens', 'tokens_saved'}).
+        """
+        full_info = table_info(table, profile)
+        total = len(profile['columns'])
+        if total < self.min_columns:
+            tokens = count_tokens(full_info, model_name)
+            return full_info, {'columns': total, 'total_columns': total, 'tokens': tokens, 'tokens_saved': 0}
+
+        names, vectors = self._column_vectors(table, profile)
+        query = np.asarray(self.embed_model.get_query_embedding(question), dtype=np.float32)
+        scores = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+        top = [names[i] for i in np.argsort(-scores)[:self.top_columns]]
+        selected = set(top + named_columns(profile, question) + key_columns(profile))
+        info = table_info(table, profile, columns=selected)
+
+        tokens = count_tokens(info, model_name)
+        tokens_saved = count_tokens(full_info, model_name) - tokens
+        print('---- Schema Linking ----', '\n',
+              f'{len(selected)} of {total} columns of {table}, {tokens} schema tokens ({tokens_saved} saved)')
+        return info, {'columns': len(selected), 'total_columns': total, 'tokens': tokens, 'tokens_saved': tokens_saved}
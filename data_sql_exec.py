@@ -0,0 +1,107 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from globals import (SQL_TIME_BUDGET, SQL_PROGRESS_OPS, SQL_PAGE_ROWS)
+from common import AppError
+
+# BOUNDED SQL EXECUTION --------------------------------------------------------
+#
+# SQL written by the LLM can run for ever (a cartesian join over a large table). Reader
+# connections get a progress handler that interrupts the statement running on them
+# once the calling thread's budget (wall-clock seconds, set with `query_budget`) is
+# spent, or its cancel event is set. `run_cancellable` runs a query in a background
+# thread under a budget while the page keeps polling: if Streamlit stops the run
+# (e.g. the Cancel button was pressed), the query is cancelled. Results are read a
+# page at a time, with LIMIT and OFFSET over the query, and counted with COUNT(*), so
+# neither reads the rows of other pages into Python.
+
+_budget = threading.local()
+
+@contextmanager
+def query_budget(seconds=SQL_TIME_BUDGET, cancel=None):
+    """Interrupt SQL run by this thread after `seconds`, or once `cancel` (an Event) is set"""
+    _budget.deadline = time.monotonic() + seconds
+    _budget.cancel = cancel
+    _budget.reason = None
+    try:
+        yield
+    except Exception as ex:
+        # the interrupted statement surfaces as the driver's (or SQLAlchemy's) 'interrupted' error
+        if _budget.reason == 'timeout':
+            raise AppError(error=f'The query took longer than {seconds}s and was stopped', status_code=408) from ex
+        if _budget.reason == 'cancelled':
+            raise AppError(error='The query was cancelled', status_code=499) from ex
+        raise
+    finally:
+        _budget.deadline = None
+        _budget.cancel = None
+
+def interrupted():
+    """Whether this thread's query budget stopped a statement (its error is re-raised as an AppError)"""
+    return getattr(_budget, 'reason', None) is not None
+
+def _progress_handler():
+    deadline = getattr(_budget, 'deadline', None)
+    if deadline is not None and time.monotonic() > deadline:
+        _budget.reason = 'timeout'
+        return 1
+    cancel = getattr(_budget, 'cancel', None)
+    if cancel is not None and cancel.is_set():
+        _budget.reason = 'cancelled'
+        return 1
+    return 0
+
+def install_progress_handler(conn, every=SQL_PROGRESS_OPS):
+    """Apply query budgets to statements run on `conn` (checked every `every` VM instructions)"""
+    conn.set_progress_handler(_progress_handler, every)
+
+def run_cancellable(fn, *args, seconds=SQL_TIME_BUDGET, on_wait=None, poll_seconds=0.2, prepare_thread=None, **kwargs):
+    """
+    Run `fn(*args, **kwargs)` in a thread, under a query budget, and return its result.
+    `on_wait(elapsed seconds)` is called while it runs. If the caller stops waiting (any
+    exception, incl. Streamlit stopping the script), the query is cancelled.
+    `prepare_thread(thread)` is called before the thread starts.
+    """
+    cancel = threading.Event()
+    outcome = {}
+
+    def _run():
+        try:
+            with query_budget(seconds, cancel):
+                outcome['result'] = fn(*args, **kwargs)
+        except BaseException as ex:
+            outcome['error'] = ex
+
+    thread = threading.Thread(target=_run, daemon=True)
+    if prepare_thread:
+        prepare_thread(thread)
+    t_start = time.monotonic()
+    thread.start()
+    try:
+        while thread.is_alive():
+            if on_wait:
+                on_wait(time.monotonic() - t_start)
+            thread.join(poll_seconds)
+    finally:
+        cancel.set()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+def _subquery(sql):
+    # the SQL as a subquery (the LLM may end it with a semicolon)
+    return sql.strip().rstrip(';').strip()
+
+def count_rows(conn, sql):
+    """Rows in the result of `sql`, counted by SQLite (none are read)"""
+    return conn.execute(f'SELECT COUNT(*) FROM ({_subquery(sql)})').fetchone()[0]
+
+def fetch_page(conn, sql, page=0, page_size=SQL_PAGE_ROWS):
+    """(column names, rows) of the 0-based `page` of the result of `sql`"""
+    cursor = conn.execute(f'SELECT * FROM ({_subquery(sql)}) LIMIT ? OFFSET ?', (page_size, page * page_size))
+    try:
+        columns = [column[0] for column in cursor.description]
+        return columns, cursor.fetchall()
+    finally:
+        cursor.close()
@@ -0,0 +1,146 @@
+import os
+import time
+
+import numpy as np
+
+from globals import (ANN_MIN_VECTORS, ANN_KMEANS_ITERATIONS)
+
+# IVF APPROXIMATE NEAREST NEIGHBOUR INDEX ---------------------------------------
+#
+# Spherical k-means partitions the (normalized) vectors into `n_lists` inverted lists.
+# A query is scored against the centroids first, and only the rows in the `nprobe`
+# closest lists are scanned exactly. `nprobe` trades recall for latency; use
+# `recall_report()` to pick it with data. Files are persisted next to the vectors.
+
+CENTROIDS_FILE = 'ivf_centroids.npy'
+ROWS_FILE = 'ivf_rows.npy'
+OFFSETS_FILE = 'ivf_offsets.npy'
+
+_BLOCK_ROWS = 65536
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _nearest_centroid(vectors, centroids):
+    # blockwise, so a memory-mapped matrix is never materialized in full
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), _BLOCK_ROWS):
+        assign[i:i + _BLOCK_ROWS] = np.argmax(np.asarray(vectors[i:i + _BLOCK_ROWS]) @ centroids.T, axis=1)
+    return assign
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def train_kmeans(vectors, n_lists, iterations=ANN_KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means centroids, trained on a sample of up to 256 vectors per list"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * 256)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest_centroid(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=n_lists)
+        # re-seed empty lists from random sample vectors
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+class IVFIndex:
+    def __init__(self, centroids, rows, offsets):
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, n_lists=None):
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        centroids = train_kmeans(vectors, n_lists)
+        assign = _nearest_centroid(vectors, centroids)
+        rows = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))]).astype(np.int64)
+        return cls(centroids, rows, offsets)
+
+    def save(self, persist_dir):
+        np.save(os.path.join(persist_dir, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(persist_dir, ROWS_FILE), self.rows)
+        np.save(os.path.join(persist_dir, OFFSETS_FILE), self.offsets)
+
+    @classmethod
+    def load(cls, persist_dir):
+        """The persisted index in `persist_dir`, or None if there isn't one"""
+        if not os.path.isfile(os.path.join(persist_dir, CENTROIDS_FILE)):
+            return None
+        return cls(
+            np.load(os.path.join(persist_dir, CENTROIDS_FILE)),
+            np.load(os.path.join(persist_dir, ROWS_FILE), mmap_mode='r'),
+            np.load(os.path.join(persist_dir, OFFSETS_FILE)),
+        )
+
+    def search(self, vectors, q, k, nprobe):
+        """Rows and scores of the (approximate) top `k` vectors for normalized query `q`"""
+        probe = _top_k(self.centroids @ q, nprobe)
+        rows = np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        # ascending rows make the memory-mapped reads sequential
+        rows.sort()
+        scores = np.asarray(vectors[rows]) @ q
+        top = _top_k(scores, k)
+        return rows[top], scores[top]
+
+def build_ann_index(vectors, persist_dir, min_vectors=ANN_MIN_VECTORS):
+    """Build and persist an IVF index for `vectors` if there are enough of them to need one"""
+    if vectors is None or len(vectors) < min_vectors:
+        return None
+    t_start = time.time()
+    ivf = IVFIndex.build(vectors)
+    ivf.save(persist_dir)
+    print('---- ANN Index ----', '\n',
+          f'IVF index with {ivf.n_lists} lists over {len(vectors)} vectors built in {time.time() - t_start:.1f}s')
+    return ivf
+
+# RECALL REPORT ----------------------------------------------------------------
+
+def _exact_search(vectors, q, k):
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for i in range(0, len(vectors), _BLOCK_ROWS):
+        scores[i:i + _BLOCK_ROWS] = np.asarray(vectors[i:i + _BLOCK_ROWS]) @ q
+    return _top_k(scores, k)
+
+def recall_report(vectors, ivf, k=10, nprobes=(1, 2, 4, 8, 16, 32), n_queries=100, seed=0):
+    """
+    recall@k and mean latency of IVF search at each nprobe, against exact search.
+    Queries are (slightly perturbed) vectors sampled from the index itself.
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False))])
+    queries = _normalize(sample + rng.normal(scale=0.01, size=sample.shape).astype(np.float32))
+
+    t_start = time.time()
+    truth = [set(_exact_search(vectors, q, k).tolist()) for q in queries]
+    exact_ms = (time.time() - t_start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > ivf.n_lists:
+            break
+        t_start = time.time()
+        found = [set(ivf.search(vectors, q, k, nprobe)[0].tolist()) for q in queries]
+        ann_ms = (time.time() - t_start) * 1000 / len(queries)
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+        report.append({
+            'nprobe': nprobe, f'recall@{k}': round(float(recall), 3),
+            'ann_ms': round(ann_ms, 2), 'exact_ms': round(exact_ms, 2),
+        })
+    return report
@@ -0,0 +1,154 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from globals import (
+    CACHE_DIR, SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES
+)
+
+# SEMANTIC ANSWER CACHE --------------------------------------------------------
+#
+# Answers are cached against the embedding of the question that produced them, so a
+# differently worded question with the same meaning (cosine similarity >= threshold)
+# reuses the answer instead of paying for retrieval and a completion. Entries are
+# partitioned by model, index fingerprint (so re-indexing invalidates them) and
+# retrieval settings (e.g. hybrid or dense, and nprobe: they change which chunks an
+# answer was written from), expire after a TTL, and the least recently used are evicted beyond a size bound.
+# The cache is a SQLite file, so it survives restarts and is shared by all workers.
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SemanticAnswerCache:
+    def __init__(
+        self, path=os.path.join(CACHE_DIR, 'answers.sqlite3'),
+        threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, max_entries=SEMANTIC_CACHE_MAX_ENTRIES
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._partitions = {}   # (model, fingerprint, retrieval) -> (version, ids, normalized embeddings matrix)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            'id INTEGER PRIMARY KEY, model TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+            'question TEXT NOT NULL, embedding BLOB NOT NULL, answer TEXT NOT NULL, '
+            'created REAL NOT NULL, last_used REAL NOT NULL, retrieval TEXT NOT NULL DEFAULT \'\')'
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(answers)')]
+        if 'retrieval' not in columns:
+            # answers cached before retrieval settings were recorded match no partition, and expire
+            self._conn.execute("ALTER TABLE answers ADD COLUMN retrieval TEXT NOT NULL DEFAULT ''")
+            self._conn.execute('DROP INDEX IF EXISTS answers_partition')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS answers_partition ON answers (model, fingerprint, retrieval)')
+        self._conn.commit()
+
+    def _version(self):
+        # data_version only changes for commits made by *other* connections
+        return (self._conn.execute('PRAGMA data_version').fetchone()[0], self._writes)
+
+    def _partition(self, model, fingerprint, retrieval):
+        version = self._version()
+        cached = self._partitions.get((model, fingerprint, retrieval))
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        rows = self._conn.execute(
+            'SELECT id, embedding FROM answers WHERE model = ? AND fingerprint = ? AND retrieval = ?',
+            (model, fingerprint, retrieval)
+        ).fetchall()
+        ids = [row_id for row_id, _ in rows]
+        matrix = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows]) if rows else None
+        self._partitions[(model, fingerprint, retrieval)] = (version, ids, matrix)
+        return ids, matrix
+
+    def lookup(self, model, fingerprint, retrieval, embedding, threshold=None):
+        """The cached (answer, similarity, question) for the most similar question, or None"""
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            ids, matrix = self._partition(model, fingerprint, retrieval)
+            if matrix is not None:
+                similarities = matrix @ _normalize(embedding)
+                # best unexpired match above the threshold
+                for i in np.argsort(-similarities):
+                    if similarities[i] < threshold:
+                        break
+                    row = self._conn.execute(
+                        'SELECT question, answer FROM answers WHERE id = ? AND created >= ?', (ids[i], time.time() - self.ttl)
+                    ).fetchone()
+                    if row:
+                        self._conn.execute('UPDATE answers SET last_used = ? WHERE id = ?', (time.time(), ids[i]))
+                        self._conn.commit()
+                        self.hits += 1
+                        return row[1], float(similarities[i]), row[0]
+            self.misses += 1
+            return None
+
+    def store(self, model, fingerprint, retrieval, question, embedding, answer):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO answers (model, fingerprint, retrieval, question, embedding, answer, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (model, fingerprint, retrieval, question, _normalize(embedding).tobytes(), answer, now, now)
+            )
+            # expire, then evict least recently used beyond the size bound
+            self._conn.execute('DELETE FROM answers WHERE created < ?', (now - self.ttl,))
+            self._conn.execute(
+                'DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+            self._writes += 1
+
+    def invalidate(self, keep_fingerprint=None):
+        """Drop entries for every index fingerprint except `keep_fingerprint` (all entries if None)"""
+        with self._lock:
+            self._conn.execute('DELETE FROM answers WHERE fingerprint IS NOT ?', (keep_fingerprint,))
+            self._conn.commit()
+            self._writes += 1
+            self._partitions.clear()
+
+    def clear(self):
+        self.invalidate()
+
+# STREAMED ANSWERS -------------------------------------------------------------
+
+class StreamedAnswers:
+    """Bounded, expiring in-process store of the full text of streamed answers"""
+    def __init__(self, ttl=60*60, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (created, answer)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time() - self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, answer):
+        with self._lock:
+            self._entries[key] = (time.time(), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
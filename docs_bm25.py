@@ -0,0 +1,195 @@
+import os
+import re
+import gzip
+import json
+from collections import Counter
+
+import numpy as np
+
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.query_engine import RetrieverQueryEngine
+from llama_index.schema import (TextNode, NodeWithScore)
+
+from globals import (BM25_K1, BM25_B, HYBRID_CANDIDATES, HYBRID_TOP_K, RRF_K)
+
+# BM25 INVERTED INDEX ----------------------------------------------------------
+#
+# A lexical index over the same chunks as the vector index, so exact terms (method
+# names, acronyms) that embeddings blur still match. Postings are kept in CSR form:
+# per-term offsets into flat (chunk, term frequency) arrays, saved as one `.npz`, plus
+# the vocabulary and the chunk texts (gzipped JSON) so lexical-only hits can be used
+# without a round trip to the vector store. The indexer updates it incrementally and
+# persists it next to the vector index, so both are swapped in together.
+
+TERMS_FILE = 'bm25_terms.json'
+POSTINGS_FILE = 'bm25_postings.npz'
+NODES_FILE = 'bm25_nodes.json.gz'
+
+_TOKEN_RE = re.compile(r'\w+')
+_STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have if in into is it its of on or '
+    'that the their then there these they this to was were will with'.split()
+)
+
+def tokenize(text):
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS]
+
+class BM25Index:
+    def __init__(self, terms, offsets, postings_doc, postings_tf, doc_len, nodes):
+        self.terms = terms                  # term -> term id
+        self.offsets = offsets              # term id -> slice of the postings arrays
+        self.postings_doc = postings_doc    # chunk row of each posting
+        self.postings_tf = postings_tf      # term frequency of each posting
+        self.doc_len = doc_len              # chunk row -> length in tokens
+        self.nodes = nodes                  # chunk row -> {'id', 'text', 'metadata'}
+        self.avg_doc_len = float(doc_len.mean()) if len(doc_len) else 0.0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def empty(cls):
+        return cls({}, np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32),
+                   np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), [])
+
+    @classmethod
+    def _from_triples(cls, vocab, term_ids, doc_ids, tfs, doc_len, nodes):
+        # drop unused terms, then sort postings by (term, chunk)
+        used = np.unique(term_ids)
+        remap = np.full(len(vocab), -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        term_ids = remap[term_ids]
+        order = np.lexsort((doc_ids, term_ids))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(used)))]).astype(np.int64)
+        terms = {vocab[old]: new for new, old in enumerate(used.tolist())}
+        return cls(terms, offsets, doc_ids[order].astype(np.int32), tfs[order].astype(np.int32),
+                   np.asarray(doc_len, dtype=np.int32), nodes)
+
+    def _triples(self):
+        vocab = [None] * len(self.terms)
+        for term, term_id in self.terms.items():
+            vocab[term_id] = term
+        term_ids = np.repeat(np.arange(len(vocab), dtype=np.int64), np.diff(self.offsets))
+        return vocab, term_ids, self.postings_doc.astype(np.int64), self.postings_tf.astype(np.int64)
+
+    def update(self, nodes=(), delete_ids=()):
+        """A new index without the `delete_ids` chunks and with `nodes` added (or replaced)"""
+        replaced = set(delete_ids) | {node.node_id for node in nodes}
+        keep = np.array([node['id'] not in replaced for node in self.nodes], dtype=bool)
+        vocab, term_ids, doc_ids, tfs = self._triples()
+
+        # renumber the surviving chunks
+        new_row = np.cumsum(keep) - 1
+        live = keep[doc_ids] if len(doc_ids) else np.empty(0, dtype=bool)
+        term_ids, doc_ids, tfs = term_ids[live], new_row[doc_ids[live]], tfs[live]
+        doc_len = self.doc_len[keep].tolist()
+        kept_nodes = [node for node, kept in zip(self.nodes, keep) if kept]
+
+        term_index = {term: i for i, term in enumerate(vocab)}
+        new_terms, new_docs, new_tfs = [], [], []
+        for node in nodes:
+            row = len(kept_nodes)
+            counts = Counter(tokenize(node.get_content()))
+            for term, tf in counts.items():
+                new_terms.append(term_index.setdefault(term, len(term_index)))
+                new_docs.append(row)
+                new_tfs.append(tf)
+            doc_len.append(sum(counts.values()))
+            kept_nodes.append({'id': node.node_id, 'text': node.get_content(), 'metadata': node.metadata})
+        vocab = list(term_index)
+
+        return self._from_triples(
+            vocab,
+            np.concatenate([term_ids, np.asarray(new_terms, dtype=np.int64)]),
+            np.concatenate([doc_ids, np.asarray(new_docs, dtype=np.int64)]),
+            np.concatenate([tfs, np.asarray(new_tfs, dtype=np.int64)]),
+            doc_len, kept_nodes,
+        )
+
+    def search(self, query_str, k, k1=BM25_K1, b=BM25_B):
+        """Chunk rows and BM25 scores of the top `k` chunks for `query_str`"""
+        n_docs = len(self.nodes)
+        scores = np.zeros(n_docs, dtype=np.float32)
+        for term in set(tokenize(query_str)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, tf = self.postings_doc[start:end], self.postings_tf[start:end]
+            idf = np.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1.0 - b + b * self.doc_len[docs] / self.avg_doc_len)
+            scores[docs] += idf * tf * (k1 + 1.0) / (tf + norm)
+        matched = np.flatnonzero(scores)
+        top = matched[np.argsort(-scores[matched])[:k]]
+        return top, scores[top]
+
+    def node(self, row):
+        node = self.nodes[row]
+        return TextNode(id_=node['id'], text=node['text'], metadata=node['metadata'])
+
+    def save(self, persist_dir):
+        with open(os.path.join(persist_dir, TERMS_FILE), 'w') as f:
+            json.dump(self.terms, f)
+        np.savez_compressed(
+            os.path.join(persist_dir, POSTINGS_FILE), offsets=self.offsets,
+            postings_doc=self.postings_doc, postings_tf=self.postings_tf, doc_len=self.doc_len
+        )
+        with gzip.open(os.path.join(persist_dir, NODES_FILE), 'wt', encoding='utf-8') as f:
+            json.dump(self.nodes, f)
+
+    @classmethod
+    def load(cls, persist_dir):
+        """The persisted index in `persist_dir`, or None if there isn't one"""
+        if not os.path.isfile(os.path.join(persist_dir, POSTINGS_FILE)):
+            return None
+        with open(os.path.join(persist_dir, TERMS_FILE), 'r') as f:
+            terms = json.load(f)
+        with np.load(os.path.join(persist_dir, POSTINGS_FILE)) as postings:
+            arrays = {name: postings[name] for name in postings.files}
+        with gzip.open(os.path.join(persist_dir, NODES_FILE), 'rt', encoding='utf-8') as f:
+            nodes = json.load(f)
+        return cls(terms, arrays['offsets'], arrays['postings_doc'], arrays['postings_tf'], arrays['doc_len'], nodes)
+
+# HYBRID RETRIEVAL -------------------------------------------------------------
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses vector and BM25 results with reciprocal rank fusion: each chunk scores
+    sum(1 / (rrf_k + rank)) over the result lists it appears in. Chunks found by both
+    rank first, so fewer of them need to be sent to the LLM.
+    """
+    def __init__(self, vector_retriever, bm25, candidates=HYBRID_CANDIDATES, top_k=HYBRID_TOP_K, rrf_k=RRF_K):
+        self._vector_retriever = vector_retriever
+        self._bm25 = bm25
+        self._candidates = candidates
+        self._top_k = top_k
+        self._rrf_k = rrf_k
+        super().__init__(callback_manager=vector_retriever.callback_manager)
+
+    def _retrieve(self, query_bundle):
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        rows, _ = self._bm25.search(query_bundle.query_str, self._candidates)
+
+        fused = {}
+        nodes = {}
+        for rank, node_with_score in enumerate(vector_nodes):
+            node_id = node_with_score.node.node_id
+            fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+            nodes[node_id] = node_with_score.node
+        for rank, row in enumerate(rows):
+            node_id = self._bm25.nodes[row]['id']
+            fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+            if node_id not in nodes:
+                nodes[node_id] = self._bm25.node(row)
+
+        top = sorted(fused, key=fused.get, reverse=True)[:self._top_k]
+        return [NodeWithScore(node=nodes[node_id], score=fused[node_id]) for node_id in top]
+
+def hybrid_query_engine(index, bm25, streaming=False, vector_store_kwargs=None, **engine_kwargs):
+    vector_retriever = index.as_retriever(
+        similarity_top_k=HYBRID_CANDIDATES, vector_store_kwargs=vector_store_kwargs or {}
+    )
+    retriever = HybridRetriever(vector_retriever, bm25)
+    return RetrieverQueryEngine.from_args(
+        retriever, service_context=index.service_context, streaming=streaming, **engine_kwargs
+    )
@@ -0,0 +1,221 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from llama_index.bridge.pydantic import (Field, PrivateAttr)
+from llama_index.callbacks import TokenCountingHandler
+from llama_index.callbacks.schema import (CBEventType, EventPayload)
+from llama_index.callbacks.token_counting import TokenCountingEvent
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.embeddings.base import BaseEmbedding
+
+from globals import (CACHE_DIR, EMBED_MODEL, EMBED_BATCH_SIZE, EMBED_MAX_CONCURRENCY)
+
+# EMBEDDING CACHE --------------------------------------------------------------
+
+# payload key for chunks served from the cache (ignored by other handlers)
+CACHE_HITS_PAYLOAD = 'embedding_cache_hits'
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """Persistent float32 embeddings keyed by (embedding model name, text hash)"""
+    def __init__(self, path=os.path.join(CACHE_DIR, 'embeddings.sqlite3')):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, '
+            'PRIMARY KEY (model, text_hash))'
+        )
+        self._conn.commit()
+
+    def get_many(self, model, hashes):
+        found = {}
+        with self._lock:
+            # stay well under SQLite's bound parameter limit
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self._conn.execute(
+                    f'SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({",".join("?" * len(batch))})',
+                    [model, *batch]
+                ).fetchall()
+                found.update({h: np.frombuffer(v, dtype=np.float32).tolist() for h, v in rows})
+        return [found.get(h) for h in hashes]
+
+    def put_many(self, model, hashes, vectors):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)',
+                [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in zip(hashes, vectors)]
+            )
+            self._conn.commit()
+
+# CACHED EMBEDDING MODEL -------------------------------------------------------
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model with the persistent cache. Cache misses are embedded in
+    batches of `embed_batch_size`, with up to `max_concurrency` batches in flight.
+    Callback events are raised on the calling thread, so token counting still works:
+    misses are reported as normal embedding chunks and hits under CACHE_HITS_PAYLOAD.
+    """
+    max_concurrency: int = Field(default=EMBED_MAX_CONCURRENCY, description='Max concurrent embedding batches.')
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(
+        self, embed_model, cache,
+        embed_batch_size=EMBED_BATCH_SIZE, max_concurrency=EMBED_MAX_CONCURRENCY,
+        callback_manager=None
+    ):
+        super().__init__(
+            model_name=embed_model.model_name, embed_batch_size=embed_batch_size,
+            max_concurrency=max_concurrency, callback_manager=callback_manager
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls):
+        return 'CachedEmbedding'
+
+    def _report_hits(self, texts):
+        with self.callback_manager.event(CBEventType.EMBEDDING, payload={EventPayload.SERIALIZED: self.to_dict()}) as event:
+            event.on_end(payload={EventPayload.CHUNKS: [], CACHE_HITS_PAYLOAD: texts})
+
+    def _report_misses(self, texts, embeddings):
+        with self.callback_manager.event(CBEventType.EMBEDDING, payload={EventPayload.SERIALIZED: self.to_dict()}) as event:
+            event.on_end(payload={EventPayload.CHUNKS: texts, EventPayload.EMBEDDINGS: embeddings})
+
+    def _embed(self, texts, report=False):
+        hashes = [text_hash(text) for text in texts]
+        embeddings = self._cache.get_many(self.model_name, hashes)
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if report and len(misses) < len(texts):
+            self._report_hits([text for text, embedding in zip(texts, embeddings) if embedding is not None])
+
+        batches = [misses[i:i + self.embed_batch_size] for i in range(0, len(misses), self.embed_batch_size)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+                results = pool.map(lambda batch: self._embed_model._get_text_embeddings([texts[i] for i in batch]), batches)
+                for batch, batch_embeddings in zip(batches, results):
+                    for i, embedding in zip(batch, batch_embeddings):
+                        embeddings[i] = embedding
+                    self._cache.put_many(self.model_name, [hashes[i] for i in batch], batch_embeddings)
+                    if report:
+                        self._report_misses([texts[i] for i in batch], batch_embeddings)
+        return embeddings
+
+    def get_text_embedding_batch(self, texts, show_progress=False, **kwargs):
+        return self._embed(list(texts), report=True)
+
+    def get_query_embedding(self, query):
+        # queries get their own cache partition, since some models embed them differently
+        query_key = f'{self.model_name}#query'
+        embedding = self._cache.get_many(query_key, [text_hash(query)])[0]
+        if embedding is not None:
+            self._report_hits([query])
+            return embedding
+        embedding = self._embed_model._get_query_embedding(query)
+        self._cache.put_many(query_key, [text_hash(query)], [embedding])
+        self._report_misses([query], [embedding])
+        return embedding
+
+    def _get_query_embedding(self, query):
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._embed([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed(texts)
+
+# LOCAL STAND-IN EMBEDDER ------------------------------------------------------
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Deterministic feature-hashing embedder. Needs no network or API key, so the
+    indexing pipeline can be run and tested offline (retrieval quality is poor).
+    """
+    dim: int = Field(default=256, description='Embedding dimension.')
+
+    def __init__(self, dim=256, **kwargs):
+        super().__init__(model_name=f'local-hash-{dim}', dim=dim, **kwargs)
+
+    @classmethod
+    def class_name(cls):
+        return 'HashEmbedding'
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r'\w+', text.lower()):
+            digest = hashlib.md5(token.encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.dim] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query):
+        return self._vector(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        return self._vector(text)
+
+    def _get_text_embeddings(self, texts):
+        return [self._vector(text) for text in texts]
+
+def get_embed_model(name=EMBED_MODEL, cache=None):
+    if name == 'openai':
+        embed_model = OpenAIEmbedding()
+    elif name == 'local':
+        embed_model = HashEmbedding()
+    else:
+        raise ValueError(f'Unknown embedding model {name}')
+    return CachedEmbedding(embed_model, cache or EmbeddingCache())
+
+# TOKEN COUNTING ---------------------------------------------------------------
+
+class CacheAwareTokenCountingHandler(TokenCountingHandler):
+    """TokenCountingHandler that also counts embedding cache hits and the tokens they saved"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.embedding_cache_hit_counts = []
+
+    def on_event_end(self, event_type, payload=None, event_id='', **kwargs):
+        super().on_event_end(event_type, payload=payload, event_id=event_id, **kwargs)
+        if event_type == CBEventType.EMBEDDING and payload and payload.get(CACHE_HITS_PAYLOAD):
+            for chunk in payload[CACHE_HITS_PAYLOAD]:
+                self.embedding_cache_hit_counts.append(TokenCountingEvent(
+                    event_id=event_id, prompt=chunk,
+                    prompt_token_count=self._token_counter.get_string_tokens(chunk),
+                    completion='', completion_token_count=0,
+                ))
+
+    @property
+    def embedding_tokens_saved(self):
+        return sum(ev.total_token_count for ev in self.embedding_cache_hit_counts)
+
+    @property
+    def embedding_cache_hit_rate(self):
+        hits = len(self.embedding_cache_hit_counts)
+        total = hits + len(self.embedding_token_counts)
+        return hits / total if total else 0.0
+
+    def reset_counts(self):
+        super().reset_counts()
+        self.embedding_cache_hit_counts = []
@@ -0,0 +1,82 @@
+from functools import lru_cache
+
+import tiktoken
+
+from globals import (HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_TOKENS)
+
+# TOKEN-BUDGETED CONVERSATION HISTORY ------------------------------------------
+#
+# The most recent turns go into the prompt verbatim, newest first, for as long as they
+# fit in the token budget (less what the summary uses). Turns that no longer fit are
+# folded into a running summary by the LLM, incrementally: only newly overflowed turns
+# are summarized, together with the previous summary. The summary and the number of
+# turns it covers are kept in session state by the caller.
+
+SUMMARY_PROMPT = (
+    'Progressively summarize the conversation below, adding to the previous summary. '
+    'Keep names, numbers and conclusions; drop pleasantries. Use at most {max_words} words.\n\n'
+    'Previous summary: {summary}\n\n'
+    'New conversation turns:\n{turns}\n\n'
+    'New summary:'
+)
+
+@lru_cache(maxsize=None)
+def _encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+def count_tokens(text, model_name):
+    return len(_encoding(model_name).encode(text))
+
+def format_turn(question, answer):
+    return f'| Question: "{question}" | Answer: "{answer}" |'
+
+def budget_history(
+    turns, summary, summarized, summarize, model_name,
+    exclude_question=None, budget=HISTORY_TOKEN_BUDGET, summary_tokens=HISTORY_SUMMARY_TOKENS
+):
+    """
+    Fit the conversation `turns` [(question, answer)] into `budget` tokens.
+
+    `summary` covers the first `summarized` turns. `summarize(prompt)` returns a
+    completion; it is only called when turns overflow the budget. The turn for
+    `exclude_question` (the question being answered) is left out.
+
+    Returns (context, context tokens, summary, summarized).
+    """
+    # newest turns verbatim, within what the (bounded) summary leaves of the budget
+    available = budget - summary_tokens
+    verbatim = []
+    cutoff = len(turns)
+    used = 0
+    for i in range(len(turns) - 1, summarized - 1, -1):
+        question, answer = turns[i]
+        if question == exclude_question:
+            cutoff = i
+            continue
+        tokens = count_tokens(format_turn(question, answer), model_name)
+        if used + tokens > available:
+            break
+        verbatim.insert(0, format_turn(question, answer))
+        used += tokens
+        cutoff = i
+
+    # fold the turns that overflowed into the summary
+    overflow = [turn for turn in turns[summarized:cutoff] if turn[0] != exclude_question]
+    if overflow:
+        prompt = SUMMARY_PROMPT.format(
+            max_words=int(summary_tokens * 0.75), summary=summary or '(none)',
+            turns='\n'.join(format_turn(question, answer) for question, answer in overflow)
+        )
+        try:
+            summary = summarize(prompt).strip()
+            print('---- Conversation History ----', '\n', f'Summarized {len(overflow)} turns')
+        except Exception as ex:
+            # the overflowed turns are dropped rather than failing the query
+            print('---- Conversation History ----', '\n', f'Summary update failed: {ex}')
+        summarized = cutoff
+
+    context = '\n\n'.join(([f'Summary of earlier conversation: {summary}'] if summary else []) + verbatim)
+    return context, count_tokens(context, model_name), summary, summarized
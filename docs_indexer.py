@@ -0,0 +1,419 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+
+from llama_index import (
+    Document, VectorStoreIndex, StorageContext, load_index_from_storage
+)
+from llama_index.node_parser import SimpleNodeParser
+from llama_index.indices.utils import embed_nodes
+from llama_index.schema import (TextNode, NodeRelationship, RelatedNodeInfo)
+from llama_index.vector_stores import WeaviateVectorStore
+
+from globals import (
+    DOCS_DIR, CHUNK_SIZE, CHUNK_OVERLAP, WEAVIATE_BULK_IMPORT, INDEX_DELTA_MIN_CHUNKS, INDEX_DELTA_MAX_FRACTION
+)
+from docs_registry import (persist_dir, new_persist_dir, commit_persist_dir, link_files, ANSWERS_VERSION_FILE)
+from docs_loader import load_documents
+from docs_vector_store import NumpyVectorStore
+from docs_ann import build_ann_index
+from docs_bm25 import BM25Index
+from docs_weaviate_ingest import WeaviateBulkImporter
+
+# INCREMENTAL DOCUMENT INDEXER -------------------------------------------------
+#
+# A manifest records the content hash of every indexed source file and the id and
+# hash of each of its chunks. Re-indexing only parses changed files, only embeds
+# chunks that weren't indexed before, and deletes chunks whose text or file has
+# gone. New chunks are added before stale ones are deleted, and the manifest (and
+# for Local, the CURRENT index pointer) is written last, so the old index stays
+# queryable until the new one is committed. The BM25 index over the same chunks is
+# updated alongside and persisted with the manifest.
+#
+# Scraped articles are indexed into the same index as sources of their own, keyed by
+# URL (and hashed by their text), with the URL, title, date and author as chunk
+# metadata. Re-scraping an unchanged page adds nothing; a rebuild from the docs
+# directory drops them. Adding a new page keeps the index's answers version (see
+# docs_registry.answers_fingerprint), so answers cached over the other sources are kept.
+#
+# Articles are committed append-only: the new version links the current index files
+# and adds a delta of the article chunks added and deleted since the index was last
+# written whole (for Numpy, see NumpyVectorStore.persist_delta). Once the delta
+# outgrows INDEX_DELTA_MIN_CHUNKS and INDEX_DELTA_MAX_FRACTION of the index, the next
+# commit writes the index whole, merging the delta in (and retraining the ANN index).
+
+MANIFEST_FILE = 'docs_manifest.json'
+LOCAL_DELTA_FILE = 'delta_nodes.json'
+WEAVIATE_CLASS = 'Documents'
+
+# fixed namespace so chunk ids are stable across runs (Weaviate needs UUID ids)
+_CHUNK_NAMESPACE = uuid.UUID('6f1c7e2a-4b0d-4d8e-9a57-1f3b2c9d8e40')
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# MANIFEST ---------------------------------------------------------------------
+
+def _empty_manifest():
+    return {'chunk_size': CHUNK_SIZE, 'chunk_overlap': CHUNK_OVERLAP, 'sources': {}}
+
+def load_manifest(store_type):
+    path = os.path.join(persist_dir(store_type), MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_dir):
+    os.makedirs(manifest_dir, exist_ok=True)
+    # the answers version is also written on its own, so it is read without parsing the manifest
+    for name, content in ((MANIFEST_FILE, json.dumps(manifest)), (ANSWERS_VERSION_FILE, manifest['answers_version'])):
+        path = os.path.join(manifest_dir, name)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+def directory_sources(docs_dir=DOCS_DIR):
+    """Map of manifest key (path relative to `docs_dir`) to file path"""
+    sources = {}
+    for root, _, files in os.walk(docs_dir):
+        for name in sorted(files):
+            # SimpleDirectoryReader skips hidden files too
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            sources[os.path.relpath(path, docs_dir).replace(os.sep, '/')] = path
+    return sources
+
+def assign_chunk_ids(source_key, nodes):
+    """
+    Give each node a stable id derived from its source and text, and return the
+    source's {chunk_id: chunk_hash} map. Each chunk is its own ref doc, so stale
+    chunks can be deleted individually with `delete_ref_doc`.
+    """
+    chunks = {}
+    occurrences = {}
+    for node in nodes:
+        chunk_hash = text_hash(node.get_content())
+        n = occurrences.get(chunk_hash, 0)
+        occurrences[chunk_hash] = n + 1
+        chunk_id = str(uuid.uuid5(_CHUNK_NAMESPACE, f'{source_key}:{chunk_hash}:{n}'))
+        node.id_ = chunk_id
+        node.relationships = {NodeRelationship.SOURCE: RelatedNodeInfo(node_id=chunk_id)}
+        chunks[chunk_id] = chunk_hash
+    return chunks
+
+# INDEX TARGETS ----------------------------------------------------------------
+
+def delta_is_small(delta_chunks, index_chunks):
+    """Whether a delta of `delta_chunks` added or deleted chunks is kept apart from the index"""
+    return delta_chunks <= max(INDEX_DELTA_MIN_CHUNKS, INDEX_DELTA_MAX_FRACTION * index_chunks)
+
+def _local_storage_files(local_persist_dir):
+    # the files StorageContext.persist writes (docstore.json, default__vector_store.json, ...)
+    return [name for name in os.listdir(local_persist_dir) if name.endswith('store.json')]
+
+def _load_local_delta(local_persist_dir):
+    """{'nodes': [node dicts, embedded], 'deleted': [chunk ids]} of the Local index's delta"""
+    path = os.path.join(local_persist_dir, LOCAL_DELTA_FILE)
+    if not os.path.isfile(path):
+        return {'nodes': [], 'deleted': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_local_index(local_persist_dir, service_context):
+    """The Local index, with its delta (article chunks added since it was written whole) applied"""
+    storage_context = StorageContext.from_defaults(persist_dir=local_persist_dir)
+    index = load_index_from_storage(storage_context, service_context=service_context)
+    delta = _load_local_delta(local_persist_dir)
+    # deleted chunks may be re-added (e.g. a page changed back), so deletes go first
+    for chunk_id in delta['deleted']:
+        index.delete_ref_doc(chunk_id, delete_from_docstore=True)
+    if delta['nodes']:
+        # the nodes keep their embeddings, so nothing is embedded again
+        index.insert_nodes([TextNode.from_dict(node) for node in delta['nodes']])
+    return index
+
+class _LocalTarget:
+    def __init__(self, service_context, fresh):
+        self.current_dir = persist_dir('Local')
+        self.delta = {'nodes': {}, 'deleted': set()}
+        if fresh or not os.path.isfile(os.path.join(self.current_dir, 'docstore.json')):
+            self.index = VectorStoreIndex([], service_context=service_context)
+            self.base_dir = None
+        else:
+            # a private copy: the registry's index keeps serving queries meanwhile
+            self.index = load_local_index(self.current_dir, service_context)
+            self.base_dir = self.current_dir
+            delta = _load_local_delta(self.current_dir)
+            self.delta = {'nodes': {node['id_']: node for node in delta['nodes']}, 'deleted': set(delta['deleted'])}
+
+    def upsert(self, nodes):
+        self.index.insert_nodes(nodes)
+        # inserted with their embeddings (see VectorStoreIndex._get_node_with_embedding)
+        for node in nodes:
+            embedded = node.copy()
+            embedded.embedding = self.index.vector_store.get(node.node_id)
+            self.delta['nodes'][node.node_id] = embedded.to_dict()
+
+    def delete(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            self.index.delete_ref_doc(chunk_id, delete_from_docstore=True)
+            self.delta['nodes'].pop(chunk_id, None)
+            self.delta['deleted'].add(chunk_id)
+
+    def commit(self, manifest, bm25, append=False):
+        new_dir = new_persist_dir('Local')
+        delta_chunks = len(self.delta['nodes']) + len(self.delta['deleted'])
+        if append and self.base_dir and delta_is_small(delta_chunks, len(self.index.docstore.docs)):
+            link_files(self.base_dir, new_dir, _local_storage_files(self.base_dir))
+            delta = {'nodes': list(self.delta['nodes'].values()), 'deleted': sorted(self.delta['deleted'])}
+            with open(os.path.join(new_dir, LOCAL_DELTA_FILE), 'w', encoding='utf-8') as f:
+                json.dump(delta, f)
+        else:
+            self.index.storage_context.persist(persist_dir=new_dir)
+        bm25.save(new_dir)
+        save_manifest(manifest, new_dir)
+        commit_persist_dir('Local', new_dir)
+        return self.index
+
+class _NumpyTarget:
+    def __init__(self, service_context, fresh):
+        self.service_context = service_context
+        self.vector_store = NumpyVectorStore.from_persist_dir(None if fresh else persist_dir('Numpy'))
+        self.index = VectorStoreIndex.from_vector_store(vector_store=self.vector_store, service_context=service_context)
+
+    def upsert(self, nodes):
+        self.index.insert_nodes(nodes)
+
+    def delete(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            self.index.delete_ref_doc(chunk_id)
+
+    def commit(self, manifest, bm25, append=False):
+        new_dir = new_persist_dir('Numpy')
+        store = self.vector_store
+        if append and store.num_committed() and delta_is_small(store.num_delta(), store.num_committed()):
+            # the new rows are scanned exactly (not by the ANN index) until the delta is merged
+            store.persist_delta(new_dir)
+        else:
+            build_ann_index(store.persist(new_dir), new_dir)
+        bm25.save(new_dir)
+        save_manifest(manifest, new_dir)
+        commit_persist_dir('Numpy', new_dir)
+        # serve the committed (memory-mapped) files, not the in-memory pending adds
+        return load_numpy_index(new_dir, self.service_context)
+
+def load_numpy_index(numpy_persist_dir, service_context):
+    vector_store = NumpyVectorStore.from_persist_dir(numpy_persist_dir)
+    return VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=service_context)
+
+class _WeaviateTarget:
+    def __init__(self, service_context, weaviate_client, fresh):
+        self.wc = weaviate_client
+        if self.wc.schema.exists(WEAVIATE_CLASS) and fresh:
+            # no manifest, so the existing chunk ids are unknown (one-off full rebuild)
+            self.wc.schema.delete_class(WEAVIATE_CLASS)
+        if not self.wc.schema.exists(WEAVIATE_CLASS):
+            class_obj = {
+                "class": WEAVIATE_CLASS,
+                "vectorizer": "text2vec-openai",
+                "moduleConfig": {
+                    "text2vec-openai": {},
+                    "generative-openai": {}
+                }
+            }
+            self.wc.schema.create_class(class_obj)
+        vector_store = WeaviateVectorStore(weaviate_client=self.wc, index_name=WEAVIATE_CLASS, text_key="content")
+        self.index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=service_context)
+        self.service_context = service_context
+
+    def upsert(self, nodes):
+        if not WEAVIATE_BULK_IMPORT:
+            self.index.insert_nodes(nodes)
+            return None
+        # embed (through the embedding cache) first, then bulk import the embedded nodes
+        embeddings = embed_nodes(nodes, self.service_context.embed_model)
+        embedded = [node.copy() for node in nodes]
+        for node in embedded:
+            node.embedding = embeddings[node.node_id]
+        return WeaviateBulkImporter(self.wc, WEAVIATE_CLASS, text_key="content").import_nodes(embedded)
+
+    def delete(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            self.index.delete_ref_doc(chunk_id)
+
+    def commit(self, manifest, bm25, append=False):
+        bm25.save(persist_dir('Weaviate'))
+        save_manifest(manifest, persist_dir('Weaviate'))
+        return self.index
+
+def _index_target(store_type, service_context, weaviate_client, fresh):
+    if store_type == 'Local':
+        return _LocalTarget(service_context, fresh)
+    elif store_type == 'Weaviate':
+        return _WeaviateTarget(service_context, weaviate_client, fresh)
+    elif store_type == 'Numpy':
+        return _NumpyTarget(service_context, fresh)
+    else:
+        raise ValueError(f'Unknown vector store {store_type}')
+
+# INDEXER ----------------------------------------------------------------------
+
+def _load_indexed(store_type):
+    """(manifest, BM25 index, fresh) of the `store_type` index; fresh if it must be rebuilt"""
+    manifest = load_manifest(store_type)
+    bm25 = BM25Index.load(persist_dir(store_type))
+    # an index built before BM25 was added is rebuilt once, to index its text
+    fresh = manifest is None or bm25 is None or \
+        manifest.get('chunk_size') != CHUNK_SIZE or manifest.get('chunk_overlap') != CHUNK_OVERLAP
+    if fresh:
+        return _empty_manifest(), BM25Index.empty(), True
+    return manifest, bm25, False
+
+def _chunk_source(parser, indexed, key, entry, documents, new_nodes, stale_ids, stats):
+    # chunk a changed source, keeping the chunks it already had indexed
+    nodes = parser.get_nodes_from_documents(documents)
+    chunks = assign_chunk_ids(key, nodes)
+    old_chunks = indexed.get(key, {}).get('chunks', {})
+    new_nodes.extend(node for node in nodes if node.node_id not in old_chunks)
+    stale_ids.extend(chunk_id for chunk_id in old_chunks if chunk_id not in chunks)
+    stats['chunks_unchanged'] += len(chunks.keys() & old_chunks.keys())
+    indexed[key] = {**entry, 'chunks': chunks}
+
+def _commit_changes(
+    store_type, service_context, weaviate_client, fresh, manifest, bm25, new_nodes, stale_ids, stats, append=False
+):
+    target = _index_target(store_type, service_context, weaviate_client, fresh)
+    # add before delete, so queries keep finding the old text until the new text is in
+    if new_nodes:
+        import_stats = target.upsert(new_nodes)
+        if import_stats:
+            stats['objects_per_second'] = import_stats['objects_per_second']
+            stats['objects_failed'] = import_stats['failed']
+    if stale_ids:
+        target.delete(stale_ids)
+    index = target.commit(manifest, bm25.update(new_nodes, stale_ids), append=append)
+
+    stats['chunks_added'] = len(new_nodes)
+    stats['chunks_deleted'] = len(stale_ids)
+    return index
+
+def _node_parser():
+    return SimpleNodeParser.from_defaults(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+def index_documents(store_type, service_context, docs_dir=DOCS_DIR, weaviate_client=None):
+    """
+    Bring the `store_type` index up to date with `docs_dir`. Returns the committed
+    index (None if nothing changed) and a dict of indexing stats.
+    """
+    t_start = time.time()
+    manifest, bm25, fresh = _load_indexed(store_type)
+    indexed = manifest['sources']
+
+    files = directory_sources(docs_dir)
+    hashes = {key: file_hash(path) for key, path in files.items()}
+    changed = [key for key in files if indexed.get(key, {}).get('hash') != hashes[key]]
+    removed = [key for key, source in indexed.items() if source.get('kind', 'file') == 'file' and key not in files]
+
+    stats = {
+        'files_changed': len(changed), 'files_removed': len(removed),
+        'files_unchanged': len(files) - len(changed),
+        'chunks_added': 0, 'chunks_deleted': 0, 'chunks_unchanged': 0, 'seconds': 0.0,
+    }
+    if not (fresh or changed or removed):
+        stats['seconds'] = time.time() - t_start
+        return None, stats
+
+    parser = _node_parser()
+    new_nodes = []
+    stale_ids = []
+    # files are chunked as they come out of the parser pool
+    for key, documents in load_documents({key: files[key] for key in changed}, hashes):
+        entry = {'kind': 'file', 'hash': hashes[key]}
+        _chunk_source(parser, indexed, key, entry, documents, new_nodes, stale_ids, stats)
+    for key in removed:
+        stale_ids.extend(indexed.pop(key)['chunks'])
+
+    # changed or removed text invalidates cached answers
+    manifest['answers_version'] = uuid.uuid4().hex
+    index = _commit_changes(store_type, service_context, weaviate_client, fresh, manifest, bm25, new_nodes, stale_ids, stats)
+    stats['seconds'] = time.time() - t_start
+    return index, stats
+
+# SCRAPED ARTICLES -------------------------------------------------------------
+
+def article_source_key(url):
+    return f'url:{url}'
+
+def article_chunk_ids(store_type, url):
+    """Ids of the indexed chunks of the article at `url` (empty if it isn't indexed)"""
+    manifest = load_manifest(store_type)
+    return sorted((manifest or {}).get('sources', {}).get(article_source_key(url), {}).get('chunks', {}))
+
+def article_metadata(article):
+    """Chunk metadata for one article (a row of `common.articles_dict`)"""
+    return {
+        'url': article['url'],
+        'title': article['title'] or '',
+        'date': article['date'].strftime('%Y-%m-%d') if article['date'] else '',
+        'author': ', '.join(article['author'] or []),
+    }
+
+def index_articles(store_type, service_context, articles, weaviate_client=None):
+    """
+    Add or update scraped `articles` (a `common.articles_dict`) in the existing
+    `store_type` index, one source per URL. Unchanged articles cost a manifest read.
+    Returns the committed index (None if nothing changed) and a dict of indexing stats.
+    """
+    t_start = time.time()
+    manifest, bm25, fresh = _load_indexed(store_type)
+    if fresh:
+        # a (re)build belongs to index_documents, which would drop these sources anyway
+        raise ValueError('Index documents first: scraped articles are added to the existing index')
+    indexed = manifest['sources']
+
+    # pages newspaper found no text in have nothing to index
+    rows = [dict(zip(articles, values)) for values in zip(*articles.values())]
+    rows = [article for article in rows if article['text'].strip()]
+    changed = [
+        article for article in rows
+        if indexed.get(article_source_key(article['url']), {}).get('hash') != text_hash(article['text'])
+    ]
+    stats = {
+        'articles_changed': len(changed), 'articles_unchanged': len(rows) - len(changed),
+        'chunks_added': 0, 'chunks_deleted': 0, 'chunks_unchanged': 0, 'seconds': 0.0,
+    }
+    if not changed:
+        stats['seconds'] = time.time() - t_start
+        return None, stats
+
+    # answers cached over the index stay valid if only new pages are added
+    if any(article_source_key(article['url']) in indexed for article in changed) or 'answers_version' not in manifest:
+        manifest['answers_version'] = uuid.uuid4().hex
+
+    parser = _node_parser()
+    new_nodes = []
+    stale_ids = []
+    for article in changed:
+        key = article_source_key(article['url'])
+        entry = {'kind': 'url', 'hash': text_hash(article['text'])}
+        documents = [Document(text=article['text'], metadata=article_metadata(article))]
+        _chunk_source(parser, indexed, key, entry, documents, new_nodes, stale_ids, stats)
+
+    # appended as a delta, so a few pages don't rewrite the index
+    index = _commit_changes(
+        store_type, service_context, weaviate_client, fresh, manifest, bm25, new_nodes, stale_ids, stats, append=True
+    )
+    stats['seconds'] = time.time() - t_start
+    return index, stats
@@ -0,0 +1,109 @@
+import os
+import json
+from concurrent.futures import (ProcessPoolExecutor, as_completed)
+
+from llama_index import (Document, SimpleDirectoryReader)
+
+from globals import (CACHE_DIR, LOADER_MAX_WORKERS, PDF_PAGES_PER_TASK)
+
+# PARALLEL DOCUMENT LOADER -----------------------------------------------------
+#
+# Files are parsed in a process pool, with large PDFs split into page ranges so one
+# big file doesn't hold up a single core. Each file's documents are yielded as soon
+# as all its parts are done, so the caller can chunk them while the rest are still
+# parsing. Extracted text is cached by file hash, so unchanged files are never
+# parsed again.
+
+_PARSER_VERSION = 1
+_TEXT_CACHE_DIR = os.path.join(CACHE_DIR, 'extracted')
+
+# PARSERS (run in worker processes) --------------------------------------------
+
+def _parse_pdf(path, start, end):
+    import pypdf
+    reader = pypdf.PdfReader(path)
+    labels = reader.page_labels
+    file_name = os.path.basename(path)
+    # same metadata as llama_index's PDFReader (one document per page)
+    return [
+        {'text': reader.pages[i].extract_text(), 'metadata': {'page_label': labels[i], 'file_name': file_name}}
+        for i in range(start, end)
+    ]
+
+def _parse_docx(path):
+    import docx2txt
+    return [{'text': docx2txt.process(path), 'metadata': {'file_name': os.path.basename(path)}}]
+
+def _parse_other(path):
+    documents = SimpleDirectoryReader(input_files=[path]).load_data()
+    return [{'text': doc.text, 'metadata': doc.metadata} for doc in documents]
+
+def _parse_task(path, page_range):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.pdf':
+        return _parse_pdf(path, *page_range)
+    elif ext == '.docx':
+        return _parse_docx(path)
+    return _parse_other(path)
+
+def _page_ranges(path, pages_per_task):
+    if os.path.splitext(path)[1].lower() != '.pdf':
+        return [None]
+    import pypdf
+    n_pages = len(pypdf.PdfReader(path).pages)
+    return [(start, min(start + pages_per_task, n_pages)) for start in range(0, n_pages, pages_per_task)] or [(0, 0)]
+
+# TEXT CACHE -------------------------------------------------------------------
+
+def _cache_path(content_hash):
+    return os.path.join(_TEXT_CACHE_DIR, f'{content_hash}.v{_PARSER_VERSION}.json')
+
+def _read_cached(content_hash):
+    path = _cache_path(content_hash)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_cached(content_hash, records):
+    os.makedirs(_TEXT_CACHE_DIR, exist_ok=True)
+    path = _cache_path(content_hash)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+    os.replace(tmp, path)
+
+def _to_documents(records):
+    return [Document(text=record['text'], metadata=record['metadata']) for record in records]
+
+# LOADER -----------------------------------------------------------------------
+
+def load_documents(files, hashes, max_workers=LOADER_MAX_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Yield `(key, documents)` for each `files` entry ({key: path}) as soon as it has
+    been parsed. `hashes` ({key: content hash}) keys the extracted text cache.
+    """
+    parts = {}
+    tasks = []
+    for key, path in files.items():
+        records = _read_cached(hashes[key])
+        if records is not None:
+            yield key, _to_documents(records)
+            continue
+        ranges = _page_ranges(path, pages_per_task)
+        parts[key] = [None] * len(ranges)
+        tasks.extend((key, i, path, page_range) for i, page_range in enumerate(ranges))
+
+    if not tasks:
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_parse_task, path, page_range): (key, i) for key, i, path, page_range in tasks}
+        for future in as_completed(futures):
+            key, i = futures[future]
+            parts[key][i] = future.result()
+            if all(part is not None for part in parts[key]):
+                # page ranges are re-assembled in order, so chunking stays deterministic
+                records = [record for part in parts.pop(key) for record in part]
+                _write_cached(hashes[key], records)
+                yield key, _to_documents(records)
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from llama_index import ServiceContext
+from llama_index.callbacks import CallbackManager
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+
+from globals import STORAGE_DIR
+from docs_bm25 import (BM25Index, hybrid_query_engine)
+
+# STORAGE LAYOUT ---------------------------------------------------------------
+
+# On-disk indexes (Local, Numpy) are written to a new versioned dir and committed by
+# atomically rewriting the CURRENT pointer file, so readers never see a half-written
+# index. Weaviate only keeps its indexing manifest on disk.
+_CURRENT_FILE = 'CURRENT'
+_VERSION_PREFIX = 'index-'
+_VERSIONS_KEPT = 2
+
+def _store_root(store_type):
+    # Local indexes have always lived directly in STORAGE_DIR
+    if store_type == 'Local':
+        return STORAGE_DIR
+    return os.path.join(STORAGE_DIR, store_type.lower())
+
+def persist_dir(store_type):
+    root = _store_root(store_type)
+    current = os.path.join(root, _CURRENT_FILE)
+    if os.path.isfile(current):
+        with open(current, 'r') as f:
+            return os.path.join(root, f.read().strip())
+    # legacy (unversioned) or manifest-only store
+    return root
+
+def new_persist_dir(store_type):
+    path = os.path.join(_store_root(store_type), f'{_VERSION_PREFIX}{time.time_ns()}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def commit_persist_dir(store_type, path):
+    """Make `path` the current `store_type` index, then remove all but the newest old versions"""
+    root = _store_root(store_type)
+    tmp = os.path.join(root, f'{_CURRENT_FILE}.tmp')
+    with open(tmp, 'w') as f:
+        f.write(os.path.basename(path))
+    os.replace(tmp, os.path.join(root, _CURRENT_FILE))
+
+    versions = sorted(name for name in os.listdir(root) if name.startswith(_VERSION_PREFIX))
+    for name in versions[:-_VERSIONS_KEPT]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+def link_files(from_dir, to_dir, names):
+    """Hard-link (or copy, where links aren't supported) the `names` files of `from_dir` into `to_dir`"""
+    # persisted files are never written again, so versions can share them
+    for name in names:
+        source = os.path.join(from_dir, name)
+        if not os.path.isfile(source):
+            continue
+        try:
+            os.link(source, os.path.join(to_dir, name))
+        except OSError:
+            shutil.copyfile(source, os.path.join(to_dir, name))
+
+# STORAGE FINGERPRINT ----------------------------------------------------------
+
+def storage_fingerprint(store_type):
+    """
+    Cheap fingerprint of the persisted index, built from the (name, size, mtime) of
+    the files in its persist dir. Any write by the indexer changes the fingerprint.
+    """
+    persist_dir_ = persist_dir(store_type)
+    if not os.path.isdir(persist_dir_):
+        return f'{store_type}:empty'
+    h = hashlib.sha1(f'{store_type}:{persist_dir_}'.encode('utf-8'))
+    for name in sorted(os.listdir(persist_dir_)):
+        path = os.path.join(persist_dir_, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            h.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+    return f'{store_type}:{h.hexdigest()}'
+
+# The answers fingerprint changes only when indexing changed or removed text that
+# answers may have been drawn from. Adding a new source (e.g. a scraped page) keeps it, so
+# cached answers over the rest of the index stay valid. The indexer writes it next to
+# the manifest.
+ANSWERS_VERSION_FILE = 'answers_version'
+
+def answers_fingerprint(store_type):
+    """Cache key of the answers over the `store_type` index (see ANSWERS_VERSION_FILE)"""
+    path = os.path.join(persist_dir(store_type), ANSWERS_VERSION_FILE)
+    if not os.path.isfile(path):
+        # an index built before answers versions were recorded
+        return storage_fingerprint(store_type)
+    with open(path, 'r') as f:
+        return f'{store_type}:answers:{f.read().strip()}'
+
+# TOKEN COUNTING ROUTER --------------------------------------------------------
+
+class _TokenCountingRouter(BaseCallbackHandler):
+    """
+    The shared service context outlives any one Streamlit session, so its callback
+    manager can't hold a session's TokenCountingHandler. This handler forwards events
+    to whichever handler is bound to the calling (script runner) thread.
+    """
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._local = threading.local()
+
+    @property
+    def handler(self):
+        return getattr(self._local, 'handler', None)
+
+    def bind(self, handler):
+        self._local.handler = handler
+
+    def on_event_start(self, event_type, payload=None, event_id='', parent_id='', **kwargs):
+        if self.handler:
+            return self.handler.on_event_start(event_type, payload=payload, event_id=event_id, parent_id=parent_id, **kwargs)
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id='', **kwargs):
+        if self.handler:
+            self.handler.on_event_end(event_type, payload=payload, event_id=event_id, **kwargs)
+
+    def start_trace(self, trace_id=None):
+        if self.handler:
+            self.handler.start_trace(trace_id)
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        if self.handler:
+            self.handler.end_trace(trace_id, trace_map)
+
+# INDEX REGISTRY ---------------------------------------------------------------
+
+class _Entry:
+    def __init__(self, fingerprint, index, bm25):
+        self.fingerprint = fingerprint
+        self.index = index
+        self.bm25 = bm25
+        self.query_engines = {}
+        self.lock = threading.Lock()
+
+class IndexRegistry:
+    """
+    Process-wide cache of loaded indexes and their query engines, keyed by store type
+    and storage fingerprint. All sessions share one loaded index; it is reloaded only
+    when the fingerprint changes, or swapped in directly by `publish()` after indexing.
+    """
+    def __init__(self, embed_model='default'):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._router = _TokenCountingRouter()
+        self.service_context = ServiceContext.from_defaults(
+            embed_model=embed_model, callback_manager=CallbackManager([self._router])
+        )
+        self.loads = 0
+
+    @contextmanager
+    def track_tokens(self, token_counter):
+        """Route token counting events raised on this thread to `token_counter`"""
+        previous = self._router.handler
+        self._router.bind(token_counter)
+        try:
+            yield token_counter
+        finally:
+            self._router.bind(previous)
+
+    def _entry(self, store_type, load_index):
+        fingerprint = storage_fingerprint(store_type)
+        entry = self._entries.get(store_type)
+        if entry is not None and entry.fingerprint == fingerprint:
+            return entry
+        with self._lock:
+            # another session may have loaded it while we waited
+            entry = self._entries.get(store_type)
+            if entry is None or entry.fingerprint != fingerprint:
+                print('---- Index Registry ----', '\n', f'Loading {store_type} index ({fingerprint})')
+                entry = _Entry(
+                    fingerprint, load_index(store_type, self.service_context), BM25Index.load(persist_dir(store_type))
+                )
+                self._entries[store_type] = entry
+                self.loads += 1
+        return entry
+
+    def index(self, store_type, load_index):
+        return self._entry(store_type, load_index).index
+
+    def bm25(self, store_type, load_index):
+        return self._entry(store_type, load_index).bm25
+
+    def query_engine(self, store_type, load_index, hybrid=False, **engine_kwargs):
+        """
+        Shared query engine over the `store_type` index. With `hybrid`, BM25 and vector
+        results are fused (falls back to vector-only if the index has no BM25 index).
+        """
+        entry = self._entry(store_type, load_index)
+        hybrid = hybrid and entry.bm25 is not None
+        key = json.dumps({'hybrid': hybrid, **engine_kwargs}, sort_keys=True, default=str)
+        query_engine = entry.query_engines.get(key)
+        if query_engine is None:
+            with entry.lock:
+                query_engine = entry.query_engines.get(key)
+                if query_engine is None:
+                    if hybrid:
+                        query_engine = hybrid_query_engine(entry.index, entry.bm25, **engine_kwargs)
+                    else:
+                        query_engine = entry.index.as_query_engine(**engine_kwargs)
+                    entry.query_engines[key] = query_engine
+        return query_engine
+
+    def publish(self, store_type, index):
+        """Atomically replace the cached index for `store_type` with a freshly built one"""
+        entry = _Entry(storage_fingerprint(store_type), index, BM25Index.load(persist_dir(store_type)))
+        with self._lock:
+            self._entries[store_type] = entry
+
+    def invalidate(self, store_type=None):
+        with self._lock:
+            if store_type is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(store_type, None)
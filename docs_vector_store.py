@@ -0,0 +1,280 @@
+import os
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+from llama_index.vector_stores.types import (VectorStore, VectorStoreQuery, VectorStoreQueryResult)
+from llama_index.vector_stores.utils import (node_to_metadata_dict, metadata_dict_to_node)
+
+from docs_ann import (IVFIndex, CENTROIDS_FILE, ROWS_FILE, OFFSETS_FILE)
+from docs_registry import link_files
+
+# NUMPY VECTOR STORE -----------------------------------------------------------
+#
+# Vectors live in one contiguous float32 matrix in a `.npy` file which is memory-mapped,
+# so loading is near-instant and the pages are shared (via the OS page cache) by every
+# Streamlit worker process. Node ids, ref doc ids and serialized nodes live in a SQLite
+# side table whose row ids are the matrix row numbers. Vectors are stored L2-normalized,
+# so a dot product is the cosine similarity.
+#
+# A persisted store is read-only: adds and deletes are held in memory and written out,
+# compacted, to a new directory by `persist()`. If an IVF index was built next to the
+# vectors, queries with `nprobe` > 0 (passed via `vector_store_kwargs`) use it.
+#
+# `persist_delta()` writes only the adds and deletes, as a delta next to (hard links
+# of) the persisted files, so a few new chunks cost a few rows, not a copy of the
+# matrix. Loading a store reads its delta back as pending adds and deletes: rows
+# the ANN index doesn't cover are scanned exactly, until a `persist()` merges them in.
+
+VECTORS_FILE = 'vectors.npy'
+NODES_FILE = 'nodes.sqlite3'
+DELTA_VECTORS_FILE = 'delta_vectors.npy'
+DELTA_NODES_FILE = 'delta_nodes.sqlite3'
+
+_COPY_ROWS = 65536
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class NumpyVectorStore(VectorStore):
+    stores_text = True
+    is_embedding_query = True
+
+    def __init__(self, vectors=None, conn=None, ivf=None, persist_dir=None):
+        self._vectors = vectors         # committed (memory-mapped) matrix, or None
+        self._conn = conn               # committed side table, or None
+        self._ivf = ivf                 # ANN index over the committed matrix, or None
+        self._persist_dir = persist_dir # where the committed files are
+        self._lock = threading.Lock()
+        self._deleted_rows = set()      # committed rows deleted since load
+        self._pending = {}              # node_id -> (ref_doc_id, vector, serialized node)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        """Open a persisted store (an empty store if `persist_dir` holds none)"""
+        vectors_path = os.path.join(persist_dir, VECTORS_FILE) if persist_dir else None
+        if not (vectors_path and os.path.isfile(vectors_path)):
+            return cls()
+        vectors = np.load(vectors_path, mmap_mode='r')
+        conn = sqlite3.connect(f'file:{os.path.join(persist_dir, NODES_FILE)}?mode=ro', uri=True, check_same_thread=False)
+        store = cls(vectors, conn, IVFIndex.load(persist_dir), persist_dir)
+        store._load_delta()
+        return store
+
+    def _load_delta(self):
+        delta_path = os.path.join(self._persist_dir, DELTA_NODES_FILE)
+        if not os.path.isfile(delta_path):
+            return
+        conn = sqlite3.connect(f'file:{delta_path}?mode=ro', uri=True)
+        try:
+            self._deleted_rows.update(row for (row,) in conn.execute('SELECT row FROM deleted'))
+            pending = conn.execute('SELECT node_id, ref_doc_id, node FROM pending ORDER BY seq').fetchall()
+        finally:
+            conn.close()
+        if pending:
+            vectors = np.load(os.path.join(self._persist_dir, DELTA_VECTORS_FILE))
+            for (node_id, ref_doc_id, node), vector in zip(pending, vectors):
+                self._pending[node_id] = (ref_doc_id, vector, node)
+
+    @property
+    def vectors(self):
+        return self._vectors
+
+    @property
+    def ann_index(self):
+        return self._ivf
+
+    @property
+    def client(self):
+        return None
+
+    # NOTE: not __len__, as llama_index tests vector stores for truthiness
+    def num_vectors(self):
+        committed = 0 if self._vectors is None else self._vectors.shape[0]
+        return committed - len(self._deleted_rows) + len(self._pending)
+
+    def num_committed(self):
+        return 0 if self._vectors is None else self._vectors.shape[0]
+
+    def num_delta(self):
+        """Adds and deletes not merged into the committed files"""
+        return len(self._pending) + len(self._deleted_rows)
+
+    def _committed_rows(self, column, values):
+        if self._conn is None or not values:
+            return []
+        rows = []
+        with self._lock:
+            for i in range(0, len(values), 500):
+                batch = values[i:i + 500]
+                rows.extend(row for (row,) in self._conn.execute(
+                    f'SELECT row FROM nodes WHERE {column} IN ({",".join("?" * len(batch))})', batch
+                ))
+        return rows
+
+    def add(self, nodes, **add_kwargs):
+        # re-added nodes replace their committed versions
+        self._deleted_rows.update(self._committed_rows('node_id', [node.node_id for node in nodes]))
+        vectors = _normalize([node.get_embedding() for node in nodes])
+        for node, vector in zip(nodes, vectors):
+            metadata = node_to_metadata_dict(node, remove_text=False, flat_metadata=False)
+            self._pending[node.node_id] = (node.ref_doc_id, vector, json.dumps(metadata))
+        return [node.node_id for node in nodes]
+
+    async def async_add(self, nodes, **kwargs):
+        return self.add(nodes, **kwargs)
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        self._deleted_rows.update(self._committed_rows('ref_doc_id', [ref_doc_id]))
+        for node_id in [node_id for node_id, pending in self._pending.items() if pending[0] == ref_doc_id]:
+            del self._pending[node_id]
+
+    async def adelete(self, ref_doc_id, **delete_kwargs):
+        self.delete(ref_doc_id, **delete_kwargs)
+
+    def _load_nodes(self, rows):
+        with self._lock:
+            found = dict(self._conn.execute(
+                f'SELECT row, node FROM nodes WHERE row IN ({",".join("?" * len(rows))})', [int(row) for row in rows]
+            ).fetchall())
+        return [metadata_dict_to_node(json.loads(found[int(row)])) for row in rows]
+
+    def _committed_candidates(self, q, top_k, nprobe, node_ids):
+        """(rows, scores) of the committed rows to rank, without deleted rows"""
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if self._vectors is None or not self._vectors.shape[0]:
+            return empty
+        deleted = np.fromiter(self._deleted_rows, dtype=np.int64, count=len(self._deleted_rows))
+        if node_ids is not None:
+            rows = np.setdiff1d(np.asarray(self._committed_rows('node_id', node_ids), dtype=np.int64), deleted)
+            return (rows, np.asarray(self._vectors[rows]) @ q) if len(rows) else empty
+        if nprobe and self._ivf is not None:
+            # the ANN index covers the committed matrix as it was persisted
+            rows, scores = self._ivf.search(self._vectors, q, top_k + len(deleted), nprobe)
+            live = ~np.isin(rows, deleted)
+            return rows[live], scores[live]
+        # vectorized scan of the memory-mapped matrix
+        scores = self._vectors @ q
+        if not len(deleted):
+            return np.arange(len(scores)), scores
+        keep = np.ones(len(scores), dtype=bool)
+        keep[deleted] = False
+        rows = np.flatnonzero(keep)
+        return rows, scores[rows]
+
+    def query(self, query: VectorStoreQuery, nprobe=0, **kwargs):
+        if query.filters is not None:
+            raise ValueError('Metadata filters are not supported by the Numpy vector store')
+        if query.query_embedding is None or self.num_vectors() == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        q = _normalize(query.query_embedding)
+        # only the given nodes (e.g. the chunks of one document) are searched
+        node_ids = list(set(query.node_ids)) if query.node_ids else None
+        rows, scores = self._committed_candidates(q, query.similarity_top_k, nprobe, node_ids)
+
+        # pending rows (e.g. the delta of pages added since the last merge) are scanned exactly
+        committed = self.num_committed()
+        pending = list(self._pending.items())
+        selected = [i for i, (node_id, _) in enumerate(pending) if node_ids is None or node_id in node_ids]
+        if selected:
+            rows = np.concatenate([rows, committed + np.asarray(selected, dtype=np.int64)])
+            scores = np.concatenate([scores, np.stack([pending[i][1][1] for i in selected]) @ q])
+        if not len(rows):
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        # partial sort: only the top k scores are ordered
+        top_k = min(query.similarity_top_k, len(rows))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        committed_top = [int(rows[i]) for i in top if rows[i] < committed]
+        nodes = dict(zip(committed_top, self._load_nodes(committed_top))) if committed_top else {}
+        for i in top:
+            if rows[i] >= committed:
+                nodes[int(rows[i])] = metadata_dict_to_node(json.loads(pending[rows[i] - committed][1][2]))
+
+        return VectorStoreQueryResult(
+            nodes=[nodes[int(rows[i])] for i in top],
+            similarities=[float(scores[i]) for i in top],
+            ids=[nodes[int(rows[i])].node_id for i in top],
+        )
+
+    async def aquery(self, query, **kwargs):
+        return self.query(query, **kwargs)
+
+    def persist(self, persist_path, fs=None):
+        """
+        Write the compacted store (committed rows minus deletes, plus pending adds) to the
+        `persist_path` dir. Returns the written vectors, memory-mapped.
+        """
+        os.makedirs(persist_path, exist_ok=True)
+        committed = 0 if self._vectors is None else self._vectors.shape[0]
+        keep = np.ones(committed, dtype=bool)
+        keep[list(self._deleted_rows)] = False
+        live = np.flatnonzero(keep)
+        pending = list(self._pending.items())
+        dim = self._vectors.shape[1] if committed else (len(pending[0][1][1]) if pending else 0)
+
+        vectors_path = os.path.join(persist_path, VECTORS_FILE)
+        out = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=(len(live) + len(pending), dim))
+        for i in range(0, len(live), _COPY_ROWS):
+            block = live[i:i + _COPY_ROWS]
+            out[i:i + len(block)] = self._vectors[block]
+        if pending:
+            out[len(live):] = np.stack([vector for _, (_, vector, _) in pending])
+        out.flush()
+        del out
+
+        conn = sqlite3.connect(os.path.join(persist_path, NODES_FILE))
+        conn.execute('CREATE TABLE nodes (row INTEGER PRIMARY KEY, node_id TEXT UNIQUE, ref_doc_id TEXT, node TEXT)')
+        conn.execute('CREATE INDEX nodes_ref_doc_id ON nodes (ref_doc_id)')
+        if committed:
+            # live rows are copied by SQLite, renumbered in order (a live row's new number is its rank)
+            source = self._conn.execute('PRAGMA database_list').fetchone()[2]
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            conn.execute('CREATE TEMP TABLE deleted (row INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT INTO deleted VALUES (?)', ((int(row),) for row in self._deleted_rows))
+            conn.execute(
+                'INSERT INTO nodes SELECT ROW_NUMBER() OVER (ORDER BY row) - 1, node_id, ref_doc_id, node '
+                'FROM source.nodes WHERE row NOT IN (SELECT row FROM temp.deleted) ORDER BY row'
+            )
+            conn.commit()
+            conn.execute('DETACH DATABASE source')
+        conn.executemany(
+            'INSERT INTO nodes VALUES (?, ?, ?, ?)',
+            ((len(live) + i, node_id, ref_doc_id, node) for i, (node_id, (ref_doc_id, _, node)) in enumerate(pending))
+        )
+        conn.commit()
+        conn.close()
+        return np.load(vectors_path, mmap_mode='r')
+
+    def persist_delta(self, persist_path):
+        """
+        Write the store to the `persist_path` dir as links to the committed files plus a
+        delta of the adds and deletes since they were written (see `persist()`)
+        """
+        if self._persist_dir is None:
+            self.persist(persist_path)
+            return
+        os.makedirs(persist_path, exist_ok=True)
+        link_files(self._persist_dir, persist_path, [VECTORS_FILE, NODES_FILE, CENTROIDS_FILE, ROWS_FILE, OFFSETS_FILE])
+
+        pending = list(self._pending.items())
+        if pending:
+            np.save(os.path.join(persist_path, DELTA_VECTORS_FILE), np.stack([vector for _, (_, vector, _) in pending]))
+        conn = sqlite3.connect(os.path.join(persist_path, DELTA_NODES_FILE))
+        conn.execute('CREATE TABLE pending (seq INTEGER PRIMARY KEY, node_id TEXT UNIQUE, ref_doc_id TEXT, node TEXT)')
+        conn.execute('CREATE TABLE deleted (row INTEGER PRIMARY KEY)')
+        conn.executemany(
+            'INSERT INTO pending VALUES (?, ?, ?, ?)',
+            ((i, node_id, ref_doc_id, node) for i, (node_id, (ref_doc_id, _, node)) in enumerate(pending))
+        )
+        conn.executemany('INSERT INTO deleted VALUES (?)', ((int(row),) for row in self._deleted_rows))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,128 @@
+import time
+import warnings
+import threading
+from concurrent.futures import (ThreadPoolExecutor, wait, FIRST_COMPLETED)
+
+from weaviate.batch import Batch
+from llama_index.vector_stores.weaviate_utils import add_node
+
+from globals import (
+    WEAVIATE_BATCH_SIZE, WEAVIATE_BATCH_MIN_SIZE, WEAVIATE_BATCH_MAX_SIZE,
+    WEAVIATE_BATCH_TARGET_SECONDS, WEAVIATE_IMPORT_WORKERS, WEAVIATE_IMPORT_RETRIES
+)
+
+# WEAVIATE BULK IMPORT ---------------------------------------------------------
+#
+# Imports embedded nodes with the client's batch API, in the same object shape as
+# llama_index's WeaviateVectorStore (so the index queries them as usual). Batches are
+# sent by a pool of workers, each with its own Batch buffer over the client's shared,
+# pooled HTTP session. The batch size adapts to the observed latency: it grows while
+# batches complete faster than the target time, and shrinks in proportion when they
+# are slower. Only the objects that failed (per-object errors, or every object of a
+# batch whose request failed) are retried.
+
+class _BatchSizer:
+    """Latency-driven batch size: additive increase, proportional decrease"""
+    def __init__(self, size, min_size, max_size, target_seconds):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self._lock = threading.Lock()
+
+    def observe(self, n_objects, seconds):
+        with self._lock:
+            if seconds <= self.target_seconds:
+                self.size = min(self.max_size, self.size + max(1, self.size // 4))
+            else:
+                self.size = max(self.min_size, int(n_objects * self.target_seconds / seconds))
+
+class WeaviateBulkImporter:
+    def __init__(
+        self, client, class_name, text_key='content',
+        batch_size=WEAVIATE_BATCH_SIZE, min_batch_size=WEAVIATE_BATCH_MIN_SIZE, max_batch_size=WEAVIATE_BATCH_MAX_SIZE,
+        target_seconds=WEAVIATE_BATCH_TARGET_SECONDS, num_workers=WEAVIATE_IMPORT_WORKERS, max_retries=WEAVIATE_IMPORT_RETRIES
+    ):
+        self.client = client
+        self.class_name = class_name
+        self.text_key = text_key
+        self.sizer = _BatchSizer(batch_size, min_batch_size, max_batch_size, target_seconds)
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self._local = threading.local()
+
+    def _batch(self):
+        # one manual-mode Batch buffer per worker thread, over the shared connection
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            batch = Batch(self.client._connection)
+            batch.configure(batch_size=None, dynamic=False, callback=None, timeout_retries=1, connection_error_retries=1)
+            self._local.batch = batch
+        return batch
+
+    def _send(self, nodes):
+        """Send one batch; returns (nodes that failed, seconds taken, or None if the request failed)"""
+        batch = self._batch()
+        for node in nodes:
+            add_node(self.client, node, self.class_name, batch=batch, text_key=self.text_key)
+        t_start = time.time()
+        try:
+            results = batch.create_objects()
+        except Exception as ex:
+            print('---- Weaviate Import ----', '\n', f'Batch of {len(nodes)} failed: {ex}')
+            # drop the unsent buffer, the whole batch is retried
+            batch.empty_objects()
+            return list(nodes), None
+        seconds = time.time() - t_start
+        failed_ids = {
+            str(result.get('id')) for result in results
+            if result.get('result', {}).get('errors')
+        }
+        return [node for node in nodes if node.node_id in failed_ids], seconds
+
+    def import_nodes(self, nodes):
+        """Import embedded `nodes`. Returns a dict of import stats."""
+        t_start = time.time()
+        stats = {'objects': len(nodes), 'imported': 0, 'failed': 0, 'retried': 0, 'batches': 0}
+        pending = list(nodes)
+        for attempt in range(self.max_retries + 1):
+            if not pending:
+                break
+            if attempt:
+                stats['retried'] += len(pending)
+                time.sleep(min(2 ** attempt, 30))
+            failed = []
+            # batches are deliberately sent manually, by our own workers (the filter is
+            # set once here, not by each worker, as warning filters are process-wide)
+            with warnings.catch_warnings(), ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                warnings.filterwarnings('ignore', message='Dep002: You are batching manually', category=DeprecationWarning)
+                in_flight = set()
+                sizes = {}
+                queue = pending
+                while queue or in_flight:
+                    # the batch size is read as each batch is cut, so it tracks the latest latency
+                    while queue and len(in_flight) < self.num_workers:
+                        size = self.sizer.size
+                        chunk, queue = queue[:size], queue[size:]
+                        future = executor.submit(self._send, chunk)
+                        sizes[future] = len(chunk)
+                        in_flight.add(future)
+                        stats['batches'] += 1
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch_failed, seconds = future.result()
+                        failed.extend(batch_failed)
+                        # a failed request says nothing about how long a batch takes
+                        if seconds is not None:
+                            self.sizer.observe(sizes.pop(future), seconds)
+            pending = failed
+
+        stats['failed'] = len(pending)
+        stats['imported'] = len(nodes) - len(pending)
+        stats['seconds'] = time.time() - t_start
+        stats['objects_per_second'] = stats['imported'] / stats['seconds'] if stats['seconds'] else 0.0
+        stats['final_batch_size'] = self.sizer.size
+        print('---- Weaviate Import ----', '\n',
+              f"{stats['imported']}/{stats['objects']} objects in {stats['batches']} batches, "
+              f"{stats['objects_per_second']:.1f} objects/s ({stats['retried']} retried, {stats['failed']} failed)")
+        return stats
@@ -6,6 +6,33 @@ _DB_NAME = 'gptdb.sqlite3'
 
 DB_FILE = '{}/{}/{}'.format(_BASE_DB_PATH, _DB_PATH, _DB_NAME)
 DB_TABLE = 'data'
+DATA_TABLE_PREFIX = 'data_'     # + content hash: one table per uploaded dataset
+DATA_DB_READERS = 8             # pooled read-only connections (WAL mode)
+DATA_DB_BUSY_TIMEOUT = 30       # seconds a connection waits for a lock
+DATA_DB_MAX_TABLES = 20         # least recently used dataset tables are dropped beyond this...
+DATA_TABLE_MIN_IDLE = 60*60     # ...once unused for this many seconds
+DATA_TABLE_TOUCH_INTERVAL = 60  # seconds between usage records of a table in use
+
+INDEX_ADVISOR_MIN_QUERIES = 2                 # queries wanting the same index before it is built
+INDEX_ADVISOR_MIN_ROWS = 10000                # smaller tables are scanned, not indexed
+INDEX_ADVISOR_MAX_COLUMNS = 4                 # widest (covering) index built
+INDEX_ADVISOR_UNUSED_SECONDS = 7*24*60*60     # advisor indexes no query used for this long are dropped
+
+SQL_PLAN_CACHE_MAX_ENTRIES = 5000   # cached question -> SQL plans (least recently used are evicted)
+SQL_TIME_BUDGET = 60                # seconds a Data Chat question may take (LLM calls incl.) before its SQL is stopped
+SQL_PROGRESS_OPS = 10000            # SQLite VM instructions between budget checks
+SQL_PAGE_ROWS = 100                 # result rows shown (and fetched) per page
+PROFILE_TOP_VALUES = 3              # most frequent values of a column given to the LLM
+PROFILE_MAX_DISTINCT = 10000        # distinct values counted per column while profiling
+SCHEMA_LINK_MIN_COLUMNS = 30        # narrower tables are given to the LLM whole...
+SCHEMA_LINK_TOP_COLUMNS = 15        # ...wider ones as the columns most similar to the question
+SCHEMA_LINK_KEY_COLUMNS = 5         # + up to this many key columns (and those the question names)
+SQLITE_BULK_CACHE_KB = 64*1024  # SQLite page cache while loading uploaded data
+CSV_CHUNK_ROWS = 50000          # CSV rows read and inserted at a time
+CSV_SCHEMA_SAMPLE_ROWS = 1000   # first CSV rows the table schema is inferred from
+DATA_PREVIEW_ROWS = 100         # rows shown by 'Show Data'
+EXCEL_MAX_WORKERS = None        # sheet conversion processes (None = one per CPU)
+EXCEL_CACHE_MAX_FILES = 20      # converted workbooks kept (least recently used are dropped)
 
 # curl https://api.openai.com/v1/models -H "Content-Type: application/json" -H "Authorization: Bearer %OPENAI_API_KEY%"
 # Actual model names used in app for selectors
@@ -40,7 +67,64 @@ LANG_MODEL_PRICING = {
     'gpt-3.5-turbo-instruct': {'input': 0.0015, 'output': 0.002},   # per 1000 tokens
 }
 
-VECTOR_STORE = 'Weaviate' # 'Weaviate' | 'Local'
+VECTOR_STORE = 'Weaviate' # 'Weaviate' | 'Local' | 'Numpy' (memory-mapped local store)
+
+DOCS_DIR = 'docs'
+STORAGE_DIR = './storage'
+CACHE_DIR = './storage/cache'
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 20
+
+EMBED_MODEL = 'openai'       # 'openai' | 'local' (offline stand-in, for testing)
+EMBED_BATCH_SIZE = 100       # chunks per embedding request
+EMBED_MAX_CONCURRENCY = 4    # embedding requests in flight
+
+ANN_MIN_VECTORS = 10000      # Numpy store: build an IVF index once there are this many chunks
+ANN_KMEANS_ITERATIONS = 10
+ANN_NPROBE = 8               # IVF lists scanned per query (0 = exact search)
+INDEX_DELTA_MIN_CHUNKS = 2000    # scraped pages are appended to the index (Numpy, Local) as a delta...
+INDEX_DELTA_MAX_FRACTION = 0.1   # ...merged in (retraining the ANN index) beyond this many chunks, or fraction of it
+
+WEAVIATE_BULK_IMPORT = True         # index into Weaviate with the batch importer (else via llama_index)
+WEAVIATE_BATCH_SIZE = 100           # initial objects per batch, adjusted to the observed latency
+WEAVIATE_BATCH_MIN_SIZE = 10
+WEAVIATE_BATCH_MAX_SIZE = 1000
+WEAVIATE_BATCH_TARGET_SECONDS = 2.0 # batch latency the batch size is tuned to
+WEAVIATE_IMPORT_WORKERS = 4         # batches in flight
+WEAVIATE_IMPORT_RETRIES = 3         # retries of failed objects
+
+BM25_K1 = 1.2                # BM25 term frequency saturation
+BM25_B = 0.75                # BM25 document length normalization
+HYBRID_CANDIDATES = 10       # chunks taken from each of the vector and BM25 results
+HYBRID_TOP_K = 2             # fused chunks sent to the LLM
+PAGE_TOP_K = 4               # chunks of a scraped page sent to the LLM, for questions about the page
+RRF_K = 60                   # reciprocal rank fusion constant
+
+SEMANTIC_CACHE_THRESHOLD = 0.95          # min cosine similarity for questions to share an answer
+SEMANTIC_CACHE_TTL = 24*60*60            # seconds
+SEMANTIC_CACHE_MAX_ENTRIES = 2000        # least recently used answers are evicted beyond this
+
+HISTORY_TOKEN_BUDGET = 1500         # max prompt tokens of conversation history (incl. summary)
+HISTORY_SUMMARY_TOKENS = 300        # of which the running summary of older turns may use
+
+LOADER_MAX_WORKERS = None # None = one worker process per CPU
+PDF_PAGES_PER_TASK = 64   # large PDFs are parsed in page ranges of this size
+
+SCRAPER_MAX_CONCURRENCY = 16 # downloads in flight, over all hosts
+SCRAPER_HOST_RATE = 1.0      # requests per second to any one host
+SCRAPER_HOST_BURST = 2       # requests a host may get at once before the rate applies
+SCRAPER_MAX_WORKERS = None   # article parsing processes (None = one per CPU)
+SCRAPER_CACHE_TTL = 6*60*60              # seconds a scraped page is used without revalidating it
+SCRAPER_CACHE_MAX_BYTES = 256*1024*1024  # least recently used pages are evicted beyond this (gzipped HTML)
+
+# Publish date fallbacks, when newspaper finds none (see scraper_dates.py)
+DATE_SELECTORS = [
+    ('p.newsdate', None),                                       # site-specific: date in the element text
+    ('meta[property="article:published_time"]', 'content'),    # or in an attribute
+    ('time[datetime]', 'datetime'),
+]
+DATE_STRATEGIES = ['selectors', 'url', 'htmldate', 'text', 'htmldate_extensive']  # cheapest first
+DATE_TEXT_SCAN_CHARS = 2000  # article text searched by the 'text' strategy
 
 SAMPLE_QUESTIONS = [
     "None",
@@ -0,0 +1,134 @@
+import time
+import asyncio
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+from globals import (
+    SCRAPER_MAX_CONCURRENCY, SCRAPER_HOST_RATE, SCRAPER_HOST_BURST, SCRAPER_MAX_WORKERS
+)
+from common import (HEADERS, REQUEST_TIMEOUT, article_record, articles_dict)
+from scraper_cache import (shared_page_cache, content_hash)
+from scraper_dates import default_date_extractor
+
+# CONCURRENT ARTICLE SCRAPER ---------------------------------------------------
+#
+# Async replacement for `common.scrape_articles`. Downloads run concurrently up to a
+# global cap, and politeness is per host: each host has a token bucket (a sustained
+# request rate with a small burst), so URLs spread over many sites don't wait on each
+# other. Parsing and newspaper's nlp() are CPU-bound, so they run in a worker pool
+# while other downloads continue. Returns the same `articles_dict` shape, in input
+# order, skipping URLs that fail (as `scrape_articles` does).
+#
+# Pages go through the on-disk page cache (see scraper_cache.py): fresh pages are not
+# requested at all, stale ones are revalidated with a conditional request, and pages
+# whose content was seen before are not parsed again.
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, up to `burst` saved up"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# PARSER (runs in worker processes) --------------------------------------------
+
+def _parse_article(url, html, report_date_stats=False):
+    """
+    The article record of the page. With `report_date_stats` (in a worker process), also
+    the publish date strategy counts of this parse, for the parent to merge.
+    """
+    import newspaper
+    stats = default_date_extractor().stats
+    before = stats.counts()
+    article = newspaper.Article(url=url, language='en')
+    article.download(input_html=html)
+    article.parse()
+    article.nlp()
+    return article_record(article), stats.counts(since=before) if report_date_stats else None
+
+# SCRAPER ----------------------------------------------------------------------
+
+async def _fetch(session, url, semaphore, buckets, host_rate, host_burst, headers=None):
+    """(status, html, etag, last modified) of `url`; status 304 (and no html) if not modified"""
+    host = urlsplit(url).netloc.lower()
+    bucket = buckets.setdefault(host, TokenBucket(host_rate, host_burst))
+    await bucket.acquire()
+    async with semaphore:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return 304, None, response.headers.get('ETag'), response.headers.get('Last-Modified')
+            response.raise_for_status()
+            html = await response.text(errors='replace')
+            return response.status, html, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+async def _scrape_one(session, url, semaphore, buckets, host_rate, host_burst, executor, cache):
+    try:
+        page = cache.lookup(url) if cache else None
+        if page and page.fresh:
+            return page.record
+
+        status, html, etag, last_modified = await _fetch(
+            session, url, semaphore, buckets, host_rate, host_burst,
+            headers=page.conditional_headers() if page else None
+        )
+        if status == 304 and page:
+            cache.revalidate(url, etag, last_modified)
+            return page.record
+
+        # the same content may have been parsed for another URL
+        record = cache.record(content_hash(html)) if cache else None
+        if record is None:
+            # worker processes record date strategy stats in their own extractor, so they are sent back
+            record, date_stats = await asyncio.get_running_loop().run_in_executor(
+                executor, _parse_article, url, html, executor is not None
+            )
+            if date_stats:
+                default_date_extractor().stats.merge(date_stats)
+        record = {**record, 'url': url}
+        if cache:
+            cache.store(url, html, record, etag, last_modified)
+        return record
+    except Exception as e:
+        print('!!Newspaper Exception!!', '\n', e)
+        return None
+
+async def scrape_articles_async(
+    source_urls, max_concurrency=SCRAPER_MAX_CONCURRENCY, host_rate=SCRAPER_HOST_RATE,
+    host_burst=SCRAPER_HOST_BURST, max_workers=SCRAPER_MAX_WORKERS, cache=None
+):
+    """`cache`: a PageCache (None = the shared page cache, False = no caching)"""
+    urls = [url.strip() for url in source_urls]
+    cache = shared_page_cache() if cache is None else cache
+    semaphore = asyncio.Semaphore(max_concurrency)
+    buckets = {}
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    # a single page isn't worth starting worker processes for
+    executor = ProcessPoolExecutor(max_workers=max_workers) if len(urls) > 1 else None
+    try:
+        async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout) as session:
+            records = await asyncio.gather(*[
+                _scrape_one(session, url, semaphore, buckets, host_rate, host_burst, executor, cache) for url in urls
+            ])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return articles_dict([record for record in records if record is not None])
+
+def scrape_articles_concurrent(source_urls, **kwargs):
+    """Synchronous entry point (e.g. for Streamlit scripts, which don't run an event loop)"""
+    return asyncio.run(scrape_articles_async(source_urls, **kwargs))
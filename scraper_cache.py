@@ -0,0 +1,178 @@
+import os
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+from functools import lru_cache
+
+from globals import (CACHE_DIR, SCRAPER_CACHE_TTL, SCRAPER_CACHE_MAX_BYTES)
+
+# SCRAPED PAGE CACHE -----------------------------------------------------------
+#
+# On-disk HTTP cache for scraped URLs. Fetched HTML is stored content-addressed (gzipped,
+# by sha256), and so are the article fields extracted from it, so a page is parsed and
+# nlp()'d once however many URLs serve it. Within the TTL a URL is served from the cache
+# without a request; after it, the page is revalidated with a conditional request
+# (ETag / Last-Modified), so an unchanged page costs a 304. The total size of stored
+# HTML is bounded by evicting the least recently used URLs.
+
+_HTML_DIR = os.path.join(CACHE_DIR, 'http')
+
+def content_hash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+def _encode_record(record):
+    return json.dumps({**record, 'date': record['date'].isoformat() if record.get('date') else None})
+
+def _decode_record(data):
+    record = json.loads(data)
+    record['date'] = datetime.datetime.fromisoformat(record['date']) if record['date'] else None
+    return record
+
+class CachedPage:
+    def __init__(self, url, content_hash, etag, last_modified, fetched, record, ttl):
+        self.url = url
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.record = record
+        self.ttl = ttl
+
+    @property
+    def fresh(self):
+        return time.time() - self.fetched < self.ttl
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+class PageCache:
+    def __init__(
+        self, path=os.path.join(CACHE_DIR, 'pages.sqlite3'), html_dir=_HTML_DIR,
+        ttl=SCRAPER_CACHE_TTL, max_bytes=SCRAPER_CACHE_MAX_BYTES
+    ):
+        os.makedirs(html_dir, exist_ok=True)
+        self.html_dir = html_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, etag TEXT, last_modified TEXT, '
+            'fetched REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS contents ('
+            'content_hash TEXT PRIMARY KEY, size INTEGER NOT NULL, record TEXT)'
+        )
+        self._conn.commit()
+
+    def _html_path(self, content_hash):
+        return os.path.join(self.html_dir, f'{content_hash}.html.gz')
+
+    def lookup(self, url):
+        """The cached page for `url` (fresh or not), or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT p.content_hash, p.etag, p.last_modified, p.fetched, c.record FROM pages p '
+                'JOIN contents c ON c.content_hash = p.content_hash WHERE p.url = ?', (url,)
+            ).fetchone()
+            if row is None or row[4] is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE pages SET last_used = ? WHERE url = ?', (time.time(), url))
+            self._conn.commit()
+        page = CachedPage(url, row[0], row[1], row[2], row[3], _decode_record(row[4]), self.ttl)
+        if page.fresh:
+            self.hits += 1
+        return page
+
+    def html(self, content_hash):
+        with gzip.open(self._html_path(content_hash), 'rt', encoding='utf-8') as f:
+            return f.read()
+
+    def record(self, content_hash):
+        """Article fields extracted from this content before (by any URL), or None"""
+        with self._lock:
+            row = self._conn.execute('SELECT record FROM contents WHERE content_hash = ?', (content_hash,)).fetchone()
+        return _decode_record(row[0]) if row and row[0] else None
+
+    def revalidate(self, url, etag=None, last_modified=None):
+        """The server answered 304 Not Modified: the cached page is fresh again"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'UPDATE pages SET fetched = ?, last_used = ?, etag = COALESCE(?, etag), '
+                'last_modified = COALESCE(?, last_modified) WHERE url = ?', (now, now, etag, last_modified, url)
+            )
+            self._conn.commit()
+            self.revalidated += 1
+
+    def store(self, url, html, record, etag=None, last_modified=None):
+        now = time.time()
+        hash_ = content_hash(html)
+        path = self._html_path(hash_)
+        if not os.path.isfile(path):
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                f.write(html)
+            os.replace(tmp, path)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO contents (content_hash, size, record) VALUES (?, ?, ?)',
+                (hash_, os.path.getsize(path), _encode_record(record))
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages (url, content_hash, etag, last_modified, fetched, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (url, hash_, etag, last_modified, now, now)
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self):
+        # least recently used URLs go first, until the stored HTML fits in max_bytes
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(c.size), 0) FROM pages p JOIN contents c ON c.content_hash = p.content_hash'
+        ).fetchone()[0]
+        if total > self.max_bytes:
+            for url, size in self._conn.execute(
+                'SELECT p.url, c.size FROM pages p JOIN contents c ON c.content_hash = p.content_hash ORDER BY p.last_used'
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+                total -= size
+        # contents no URL refers to any more
+        orphans = [hash_ for (hash_,) in self._conn.execute(
+            'SELECT content_hash FROM contents WHERE content_hash NOT IN (SELECT content_hash FROM pages)'
+        )]
+        for hash_ in orphans:
+            self._conn.execute('DELETE FROM contents WHERE content_hash = ?', (hash_,))
+            try:
+                os.remove(self._html_path(hash_))
+            except FileNotFoundError:
+                pass
+        self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM pages')
+            self._evict()
+
+@lru_cache(maxsize=None)
+def shared_page_cache():
+    """The process-wide page cache (its files are shared by all processes)"""
+    return PageCache()
@@ -0,0 +1,139 @@
+import re
+import time
+import threading
+from functools import lru_cache
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+import htmldate
+import datefinder
+
+from globals import (DATE_SELECTORS, DATE_STRATEGIES, DATE_TEXT_SCAN_CHARS)
+from common import parse_date_str
+
+# PUBLISH DATE EXTRACTION ------------------------------------------------------
+#
+# Fallback for pages where newspaper finds no publish date. The HTML is parsed into
+# one lxml tree (or newspaper's own tree is reused) and every strategy works on it.
+# Strategies run cheapest first and stop at the first date found:
+#
+#   selectors           configurable CSS selectors (site-specific ones, like p.newsdate)
+#   url                 a /yyyy/mm/dd/ date in the URL
+#   htmldate            htmldate's fast search (headers, JSON-LD, common date elements)
+#   text                datefinder over the start of the article text
+#   htmldate_extensive  htmldate's extensive search (free-text patterns over the page)
+#
+# Per-strategy attempts, hits and time are recorded, to keep the order honest. Pages
+# parsed in worker processes send their counts back with the article, to be merged
+# into the parent's stats (see scraper_async.py).
+
+_URL_DATE_RE = re.compile(r'/((?:19|20)\d{2})[/-](0?[1-9]|1[0-2])[/-](0?[1-9]|[12]\d|3[01])(?:/|$|[^\d])')
+
+class DateStrategyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = {}
+        self.hits = {}
+        self.seconds = {}
+
+    def record(self, strategy, hit, seconds):
+        with self._lock:
+            self.attempts[strategy] = self.attempts.get(strategy, 0) + 1
+            self.hits[strategy] = self.hits.get(strategy, 0) + int(hit)
+            self.seconds[strategy] = self.seconds.get(strategy, 0.0) + seconds
+
+    def counts(self, since=None):
+        """{strategy: (attempts, hits, seconds)}, less the `since` counts (an earlier `counts()`)"""
+        since = since or {}
+        with self._lock:
+            counts = {
+                strategy: (attempts, self.hits[strategy], self.seconds[strategy])
+                for strategy, attempts in self.attempts.items()
+            }
+        return {
+            strategy: tuple(n - before for n, before in zip(values, since.get(strategy, (0, 0, 0.0))))
+            for strategy, values in counts.items()
+            if values[0] > since.get(strategy, (0, 0, 0.0))[0]
+        }
+
+    def merge(self, counts):
+        """Add `counts` (e.g. recorded in a worker process) to these stats"""
+        with self._lock:
+            for strategy, (attempts, hits, seconds) in counts.items():
+                self.attempts[strategy] = self.attempts.get(strategy, 0) + attempts
+                self.hits[strategy] = self.hits.get(strategy, 0) + hits
+                self.seconds[strategy] = self.seconds.get(strategy, 0.0) + seconds
+
+    def report(self):
+        """Per-strategy attempts, hits, hit rate and mean time (ms)"""
+        with self._lock:
+            return [
+                {
+                    'strategy': strategy, 'attempts': attempts, 'hits': self.hits[strategy],
+                    'hit_rate': round(self.hits[strategy] / attempts, 3),
+                    'mean_ms': round(self.seconds[strategy] * 1000 / attempts, 3),
+                }
+                for strategy, attempts in self.attempts.items()
+            ]
+
+class DateExtractor:
+    def __init__(self, selectors=DATE_SELECTORS, strategies=DATE_STRATEGIES, text_scan_chars=DATE_TEXT_SCAN_CHARS):
+        # selectors are compiled to XPath once
+        self.selectors = [(CSSSelector(css), attribute) for css, attribute in selectors]
+        self.strategies = list(strategies)
+        self.text_scan_chars = text_scan_chars
+        self.stats = DateStrategyStats()
+
+    # STRATEGIES ---------------------------------------------------------------
+
+    def _selectors(self, tree, url, text):
+        for selector, attribute in self.selectors:
+            for element in selector(tree):
+                value = element.get(attribute) if attribute else element.text_content()
+                date = parse_date_str(value.strip() if value else None)
+                if date:
+                    return date
+        return None
+
+    def _url(self, tree, url, text):
+        match = _URL_DATE_RE.search(url or '')
+        return parse_date_str('-'.join(match.groups())) if match else None
+
+    def _htmldate(self, tree, url, text, extensive=False):
+        # htmldate copies a tree that is passed in before pruning it, so ours is left intact
+        return parse_date_str(htmldate.find_date(tree, extensive_search=extensive, original_date=True))
+
+    def _htmldate_extensive(self, tree, url, text):
+        return self._htmldate(tree, url, text, extensive=True)
+
+    def _text(self, tree, url, text):
+        if not text:
+            return None
+        try:
+            return next(datefinder.find_dates(text[:self.text_scan_chars]), None)
+        except Exception:
+            return None
+
+    # EXTRACTION ---------------------------------------------------------------
+
+    def extract(self, html=None, text=None, url=None, tree=None):
+        """The publish date (datetime) of a page, or None. Pass `tree` to reuse an already parsed page."""
+        if tree is None:
+            if not html:
+                return None
+            tree = lxml.html.fromstring(html)
+        for strategy in self.strategies:
+            t_start = time.perf_counter()
+            try:
+                date = getattr(self, f'_{strategy}')(tree, url, text)
+            except Exception:
+                date = None
+            self.stats.record(strategy, date is not None, time.perf_counter() - t_start)
+            if date is not None:
+                return date
+        return None
+
+@lru_cache(maxsize=None)
+def default_date_extractor():
+    """The process-wide extractor (its stats cover every page scraped in the process)"""
+    return DateExtractor()
@@ -0,0 +1,90 @@
+import inspect
+import threading
+import functools
+from concurrent.futures import Future
+
+# SINGLE-FLIGHT REQUEST COALESCING ---------------------------------------------
+#
+# st.cache_data only helps once a result is cached: sessions that ask the same question
+# at the same time each run the (slow, paid) LLM call. A SingleFlight lets the first
+# caller for a key run it while concurrent callers with the same key wait on its future.
+# Process-wide, since Streamlit serves all sessions of a process from one module.
+#
+# If the leader is interrupted (e.g. a Streamlit rerun stops its script, or a stream is
+# closed early), waiting callers retry, and one of them becomes the new leader. If the
+# call itself fails, the waiting callers get the same exception.
+
+class _Abandoned(Exception):
+    pass
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}    # key -> Future
+
+    def join(self, key):
+        """The (future, leader) for `key`: the leader must `finish()` the call"""
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.suppressed += 1
+                print('---- Single Flight ----', '\n',
+                      f'{self.name}: joined an in-flight call ({self.suppressed} duplicate calls suppressed)')
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # interrupted rather than failed: the waiters run it themselves
+            future.set_exception(_Abandoned())
+
+    def lead_or_wait(self, key):
+        """(future, None) if the caller leads the call for `key`, else (None, the leader's result)"""
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                return future, None
+            try:
+                return None, future.result()
+            except _Abandoned:
+                continue
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)`, or wait for the result of an identical call in flight"""
+        future, result = self.lead_or_wait(key)
+        if future is None:
+            return result
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as ex:
+            self.finish(key, future, error=ex)
+            raise
+        self.finish(key, future, result=result)
+        return result
+
+def call_key(fn, *args, **kwargs):
+    """Key of a call to `fn`: its argument values (defaults applied), in parameter order"""
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return tuple(bound.arguments.values())
+
+def single_flight(flight):
+    """Decorator: coalesce concurrent calls with equal arguments through `flight`"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return flight.do(call_key(fn, *args, **kwargs), fn, *args, **kwargs)
+        return wrapper
+    return decorator
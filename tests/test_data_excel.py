@@ -0,0 +1,40 @@
+import io
+import zipfile
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import openpyxl
+
+from data_excel import (workbook_sheets, load_sheet)
+
+def _workbook():
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = 'Sales'
+    sheet.append(['id', 'price', 'paid', 'day', 'note'])
+    sheet.append([1, 1.5, True, dt.datetime(2020, 1, 2), 'héllo'])
+    sheet.append([2, None, False, None, None])
+    sheet.append([3, '2.5', True, dt.datetime(2021, 5, 6), '日本'])
+    # as an uploaded file, it has getbuffer()
+    upload = io.BytesIO()
+    workbook.save(upload)
+    return upload
+
+def test_sheets_are_cached_as_typed_columns(tmp_path):
+    upload = _workbook()
+    sheets = workbook_sheets(upload, 'hash', cache_dir=str(tmp_path))
+    assert sheets[0]['rows'] == 3
+
+    # no object arrays: loading never unpickles
+    with zipfile.ZipFile(tmp_path / 'hash' / sheets[0]['file']) as npz:
+        for name in npz.namelist():
+            with npz.open(name) as f:
+                assert not np.lib.format.read_array(f, allow_pickle=False).dtype.hasobject
+
+    df = load_sheet(upload, 'hash', 'Sales', cache_dir=str(tmp_path))
+    assert df['id'].dtype == np.int64
+    assert df['price'].tolist()[::2] == [1.5, 2.5] and np.isnan(df['price'][1])
+    assert df['paid'].dtype == bool
+    assert df['day'].dtype.kind == 'M' and pd.isna(df['day'][1])
+    assert df['note'].tolist()[::2] == ['héllo', '日本'] and pd.isna(df['note'][1])
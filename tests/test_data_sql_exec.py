@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+from common import AppError
+from data_sql_exec import (query_budget, install_progress_handler, fetch_page, count_rows)
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (n INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(n,) for n in range(25)])
+    install_progress_handler(conn, every=100)
+    yield conn
+    conn.close()
+
+def test_pages_and_count(conn):
+    sql = 'SELECT n, n * 2 AS twice FROM t WHERE n >= 3 ORDER BY n;'
+    assert count_rows(conn, sql) == 22
+    columns, rows = fetch_page(conn, sql, page=2, page_size=10)
+    assert columns == ['n', 'twice']
+    assert rows == [(23, 46), (24, 48)]
+    assert fetch_page(conn, sql, page=3, page_size=10)[1] == []
+
+def test_count_is_bounded_by_the_query_budget(conn):
+    # a cartesian join far too large to count in the budget
+    sql = 'SELECT * FROM t a, t b, t c, t d, t e, t f'
+    with pytest.raises(AppError) as ex:
+        with query_budget(seconds=0.2):
+            count_rows(conn, sql)
+    assert ex.value.status_code == 408
@@ -0,0 +1,31 @@
+import sqlite3
+
+import numpy as np
+
+from docs_answer_cache import SemanticAnswerCache
+
+def test_answers_are_partitioned_by_retrieval_settings(tmp_path):
+    cache = SemanticAnswerCache(str(tmp_path / 'answers.sqlite3'))
+    cache.store('model', 'index', 'dense:nprobe=0', 'what is x?', [1.0, 0.0], 'dense answer')
+
+    assert cache.lookup('model', 'index', 'dense:nprobe=0', [1.0, 0.0])[0] == 'dense answer'
+    assert cache.lookup('model', 'index', 'hybrid:nprobe=0', [1.0, 0.0]) is None
+    assert cache.lookup('model', 'index', 'dense:nprobe=8', [1.0, 0.0]) is None
+
+def test_answers_cached_without_retrieval_settings_are_not_returned(tmp_path):
+    path = str(tmp_path / 'answers.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE answers (id INTEGER PRIMARY KEY, model TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+        'question TEXT NOT NULL, embedding BLOB NOT NULL, answer TEXT NOT NULL, '
+        'created REAL NOT NULL, last_used REAL NOT NULL)'
+    )
+    conn.commit()
+    conn.close()
+
+    cache = SemanticAnswerCache(path)
+    cache._conn.execute(
+        "INSERT INTO answers (model, fingerprint, question, embedding, answer, created, last_used) "
+        "VALUES ('model', 'index', 'q', ?, 'old answer', 1e12, 1e12)", (np.asarray([1.0, 0.0], dtype=np.float32).tobytes(),)
+    )
+    assert cache.lookup('model', 'index', 'dense:nprobe=0', [1.0, 0.0]) is None
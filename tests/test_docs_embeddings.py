@@ -0,0 +1,46 @@
+from llama_index.callbacks import CallbackManager
+
+from docs_embeddings import (EmbeddingCache, CacheAwareTokenCountingHandler, get_embed_model)
+
+def _embed_model(tmp_path):
+    counter = CacheAwareTokenCountingHandler(tokenizer=str.split)
+    embed_model = get_embed_model('local', EmbeddingCache(str(tmp_path / 'embeddings.sqlite3')))
+    embed_model.callback_manager = CallbackManager([counter])
+    return embed_model, counter
+
+def test_cached_texts_are_not_embedded_again(tmp_path):
+    embed_model, counter = _embed_model(tmp_path)
+
+    first = embed_model.get_text_embedding_batch(['alpha beta', 'gamma delta epsilon'])
+    assert len(counter.embedding_token_counts) == 2
+    assert counter.embedding_cache_hit_counts == []
+
+    counter.reset_counts()
+    second = embed_model.get_text_embedding_batch(['gamma delta epsilon', 'zeta', 'alpha beta'])
+    assert second[0] == first[1] and second[2] == first[0]
+    # only the new text is embedded; the others are hits, and their tokens saved
+    assert [ev.prompt for ev in counter.embedding_token_counts] == ['zeta']
+    assert sorted(ev.prompt for ev in counter.embedding_cache_hit_counts) == ['alpha beta', 'gamma delta epsilon']
+    assert counter.embedding_tokens_saved == 5
+    assert counter.embedding_cache_hit_rate == 2 / 3
+
+def test_cache_persists_across_models(tmp_path):
+    embed_model, _ = _embed_model(tmp_path)
+    embed_model.get_text_embedding_batch(['alpha beta'])
+    embed_model.get_query_embedding('what is alpha?')
+
+    # e.g. after a restart
+    embed_model, counter = _embed_model(tmp_path)
+    embed_model.get_text_embedding_batch(['alpha beta'])
+    embed_model.get_query_embedding('what is alpha?')
+    assert counter.embedding_token_counts == []
+    assert len(counter.embedding_cache_hit_counts) == 2
+
+def test_queries_are_cached_apart_from_texts(tmp_path):
+    embed_model, counter = _embed_model(tmp_path)
+    embed_model.get_text_embedding_batch(['alpha beta'])
+    counter.reset_counts()
+
+    embed_model.get_query_embedding('alpha beta')
+    assert len(counter.embedding_token_counts) == 1
+    assert counter.embedding_cache_hit_counts == []
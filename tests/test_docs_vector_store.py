@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+from llama_index.schema import (TextNode, NodeRelationship, RelatedNodeInfo)
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from docs_ann import build_ann_index
+from docs_vector_store import (NumpyVectorStore, VECTORS_FILE)
+
+def _node(i, dim=8):
+    vector = np.zeros(dim, dtype=np.float32)
+    vector[i % dim] = 1.0
+    vector[(i + 1) % dim] = i / 100
+    node = TextNode(id_=f'n{i}', text=f'chunk {i}', embedding=vector.tolist())
+    node.relationships = {NodeRelationship.SOURCE: RelatedNodeInfo(node_id=f'n{i}')}
+    return node
+
+def _ids_by_row(store):
+    return [node_id for (node_id,) in store._conn.execute('SELECT node_id FROM nodes ORDER BY row')]
+
+def test_persist_compacts_deletes_and_appends_adds(tmp_path):
+    store = NumpyVectorStore()
+    store.add([_node(i) for i in range(10)])
+    store.persist(str(tmp_path / 'v1'))
+
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path / 'v1'))
+    for i in (0, 4, 9):
+        store.delete(f'n{i}')
+    store.add([_node(10), _node(11)])
+    vectors = store.persist(str(tmp_path / 'v2'))
+
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path / 'v2'))
+    assert _ids_by_row(store) == [f'n{i}' for i in (1, 2, 3, 5, 6, 7, 8, 10, 11)]
+    assert vectors.shape == (9, 8)
+    # each row's vector is its node's
+    for row, node_id in enumerate(_ids_by_row(store)):
+        expected = _node(int(node_id[1:])).get_embedding()
+        assert np.allclose(vectors[row], np.asarray(expected) / np.linalg.norm(expected))
+
+    result = store.query(VectorStoreQuery(query_embedding=_node(5).get_embedding(), similarity_top_k=1))
+    assert result.ids == ['n5']
+
+def test_delta_is_read_back_and_scanned_next_to_the_ann_index(tmp_path):
+    store = NumpyVectorStore()
+    store.add([_node(i, dim=16) for i in range(200)])
+    vectors = store.persist(str(tmp_path / 'v1'))
+    build_ann_index(vectors, str(tmp_path / 'v1'), min_vectors=100)
+
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path / 'v1'))
+    store.delete('n3')
+    store.add([_node(300, dim=16)])
+    store.persist_delta(str(tmp_path / 'v2'))
+
+    # the committed files are shared, not copied
+    assert os.path.samefile(tmp_path / 'v1' / VECTORS_FILE, tmp_path / 'v2' / VECTORS_FILE)
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path / 'v2'))
+    assert store.ann_index is not None
+    assert store.num_vectors() == 200 and store.num_delta() == 2
+    for nprobe in (0, 4):
+        new = store.query(VectorStoreQuery(query_embedding=_node(300, dim=16).get_embedding(), similarity_top_k=1), nprobe=nprobe)
+        assert new.ids == ['n300']
+        deleted = store.query(VectorStoreQuery(query_embedding=_node(3, dim=16).get_embedding(), similarity_top_k=20), nprobe=nprobe)
+        assert 'n3' not in deleted.ids
@@ -0,0 +1,153 @@
+import json
+import uuid
+import warnings
+import threading
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+
+import pytest
+import weaviate
+from llama_index.schema import TextNode
+
+import docs_weaviate_ingest
+from docs_weaviate_ingest import WeaviateBulkImporter
+
+# A stub of the Weaviate REST endpoints the client and the importer use. The first
+# `slow_requests` batches take `slow_seconds`; objects in `flaky_ids` fail the first
+# time they are sent, objects in `failing_ids` every time.
+
+class _StubWeaviate(ThreadingHTTPServer):
+    def __init__(self, flaky_ids=(), failing_ids=(), slow_requests=0, slow_seconds=0.0):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.flaky_ids = set(flaky_ids)
+        self.failing_ids = set(failing_ids)
+        self.slow_requests = slow_requests
+        self.slow_seconds = slow_seconds
+        self.lock = threading.Lock()
+        self.batch_sizes = []     # objects per /v1/batch/objects request, in order
+        self.sent = []            # object ids, in the order they were received
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/v1/meta':
+            self._reply(200, {'version': '1.22.5', 'modules': {}})
+        elif self.path == '/v1/.well-known/ready':
+            self._reply(200, {})
+        else:
+            self._reply(404, {})
+
+    def do_POST(self):
+        if self.path != '/v1/batch/objects':
+            self._reply(404, {})
+            return
+        objects = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['objects']
+        server = self.server
+        with server.lock:
+            request = len(server.batch_sizes)
+            server.batch_sizes.append(len(objects))
+            results = []
+            for obj in objects:
+                first_time = obj['id'] not in server.sent
+                server.sent.append(obj['id'])
+                fails = obj['id'] in server.failing_ids or (first_time and obj['id'] in server.flaky_ids)
+                results.append({**obj, 'result': {'errors': {'error': [{'message': 'stub failure'}]}} if fails else {}})
+        if request < server.slow_requests:
+            threading.Event().wait(server.slow_seconds)
+        self._reply(200, results)
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def _start(**kwargs):
+        server = _StubWeaviate(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield _start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff(monkeypatch):
+    monkeypatch.setattr(docs_weaviate_ingest.time, 'sleep', lambda seconds: None)
+
+def _nodes(n):
+    return [
+        TextNode(id_=str(uuid.UUID(int=i + 1)), text=f'chunk {i}', embedding=[0.1, 0.2, 0.3])
+        for i in range(n)
+    ]
+
+def test_only_failed_objects_are_resent(stub):
+    nodes = _nodes(60)
+    flaky = {node.node_id for node in nodes[::7]}
+    server = stub(flaky_ids=flaky)
+    importer = WeaviateBulkImporter(weaviate.Client(server.url), 'Documents', batch_size=25, num_workers=2)
+
+    stats = importer.import_nodes(nodes)
+
+    resent = {object_id for object_id in server.sent if server.sent.count(object_id) > 1}
+    assert resent == flaky
+    assert len(server.sent) == len(nodes) + len(flaky)
+    assert stats['imported'] == len(nodes)
+    assert stats['failed'] == 0
+    assert stats['retried'] == len(flaky)
+
+def test_objects_failing_every_attempt_are_reported(stub):
+    nodes = _nodes(10)
+    server = stub(failing_ids={nodes[0].node_id})
+    importer = WeaviateBulkImporter(weaviate.Client(server.url), 'Documents', batch_size=10, max_retries=2)
+
+    stats = importer.import_nodes(nodes)
+
+    # sent once, then retried max_retries times, alone
+    assert server.sent.count(nodes[0].node_id) == 3
+    assert server.batch_sizes == [10, 1, 1]
+    assert stats['failed'] == 1
+    assert stats['imported'] == len(nodes) - 1
+
+def test_batch_size_shrinks_when_slow_then_grows(stub):
+    server = stub(slow_requests=2, slow_seconds=0.5)
+    importer = WeaviateBulkImporter(
+        weaviate.Client(server.url), 'Documents',
+        batch_size=40, min_batch_size=5, max_batch_size=1000, target_seconds=0.2, num_workers=1
+    )
+
+    stats = importer.import_nodes(_nodes(300))
+
+    sizes = server.batch_sizes
+    assert sizes[0] == 40
+    # slow batches shrink the size in proportion to how much slower than the target they were
+    assert sizes[1] < sizes[0] and sizes[2] < sizes[1]
+    # fast batches grow it again
+    assert sizes[-2] > sizes[2]
+    assert all(later >= earlier for earlier, later in zip(sizes[2:-1], sizes[3:-1]))
+    assert stats['imported'] == 300
+    assert stats['final_batch_size'] > sizes[2]
+
+def test_manual_batching_warning_is_only_silenced_during_the_import(stub):
+    server = stub()
+    importer = WeaviateBulkImporter(weaviate.Client(server.url), 'Documents', batch_size=5)
+    filters = list(warnings.filters)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        importer.import_nodes(_nodes(10))
+    assert not [w for w in caught if 'Dep002' in str(w.message)]
+    assert warnings.filters == filters
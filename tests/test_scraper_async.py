@@ -0,0 +1,71 @@
+import time
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from scraper_async import (TokenBucket, _fetch)
+
+# Requests go to a local aiohttp server, which records when each one arrived. It is
+# reached as two hosts (127.0.0.1 and localhost), each with its own token bucket.
+
+async def _serve(arrivals):
+    async def page(request):
+        arrivals.append((request.host.split(':')[0], time.monotonic()))
+        return web.Response(text='<html><body>page</body></html>', content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/{name}', page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+async def _fetch_all(urls, host_rate, host_burst, max_concurrency=10):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    buckets = {}
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[
+            _fetch(session, url, semaphore, buckets, host_rate, host_burst) for url in urls
+        ])
+
+def _arrival_times(host_urls, host_rate, host_burst):
+    async def run():
+        arrivals = []
+        runner, port = await _serve(arrivals)
+        try:
+            urls = [f'http://{host}:{port}/{i}' for host, n in host_urls.items() for i in range(n)]
+            results = await _fetch_all(urls, host_rate, host_burst)
+        finally:
+            await runner.cleanup()
+        assert all(status == 200 for status, *_ in results)
+        return {host: sorted(at for h, at in arrivals if h == host) for host in host_urls}
+    return asyncio.run(run())
+
+def test_requests_to_a_host_are_spaced_by_its_rate():
+    times = _arrival_times({'127.0.0.1': 6}, host_rate=10, host_burst=2)['127.0.0.1']
+
+    # the burst goes out at once, then one request per 1/rate seconds
+    assert times[1] - times[0] < 0.05
+    gaps = [later - earlier for earlier, later in zip(times[1:], times[2:])]
+    assert all(gap > 0.07 for gap in gaps)
+    assert times[-1] - times[0] >= 0.35
+
+def test_hosts_are_rate_limited_independently():
+    times = _arrival_times({'127.0.0.1': 4, 'localhost': 4}, host_rate=5, host_burst=1)
+
+    # each host takes (n - burst) / rate seconds, and the two run side by side
+    for host_times in times.values():
+        assert 0.55 <= host_times[-1] - host_times[0] < 0.9
+    assert abs(times['127.0.0.1'][0] - times['localhost'][0]) < 0.1
+
+def test_token_bucket_saves_up_to_burst():
+    async def run():
+        bucket = TokenBucket(rate=20, burst=3)
+        await asyncio.sleep(0.3)        # would be 6 tokens without the burst cap
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - start
+    assert 0.04 <= asyncio.run(run()) < 0.1